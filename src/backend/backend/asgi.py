@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Optional in-process escalation scheduler
+from main.scheduler import autostart  # noqa: E402
+
+autostart()
@@ -50,6 +50,15 @@ REST_FRAMEWORK = {
     ],
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 20,
+    # Reverse proxies in front of the app that append to X-Forwarded-For.
+    # The throttles count requests by the address the outermost one saw.
+    "NUM_PROXIES": int(os.getenv("NUM_PROXIES", "0")),
+    # Sliding windows of the login endpoints' throttles (see main/throttles.py)
+    "DEFAULT_THROTTLE_RATES": {
+        "auth_ip": os.getenv("AUTH_IP_RATE", "60/min"),
+        "auth_account": os.getenv("AUTH_ACCOUNT_RATE", "10/min"),
+        "auth_session": os.getenv("AUTH_SESSION_RATE", "10/min"),
+    },
 }
 
 SIMPLE_JWT = {
@@ -130,6 +139,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Per-process memory cache; point this at a shared backend such as Redis
+# when running more than one process.
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -183,9 +204,29 @@ CORS_ALLOW_ALL_ORIGINS = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Limits of the attachment upload views, see main/uploads.py
+ATTACHMENT_MAX_FILE_SIZE = 25 * 1024 * 1024
+ATTACHMENT_MAX_REQUEST_SIZE = 100 * 1024 * 1024
+# Processes rendering attachment thumbnails, 0 renders them in the request
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '2'))
+
+# Processes rendering Google Authenticator QR codes, 0 renders them in the
+# request
+QR_CODE_WORKERS = int(os.getenv('QR_CODE_WORKERS', '2'))
+
+# Threads writing notifications in the background, 0 writes them after
+# the request's transaction commits
+NOTIFICATION_WORKERS = int(os.getenv('NOTIFICATION_WORKERS', '1'))
+
+# Publish/subscribe backend of the live update streams, see main/events.py.
+# The local broker only reaches streams served by the same process.
+EVENT_BROKER = 'main.events.LocalBroker'
+
 # Google OAuth Settings
 GOOGLE_OAUTH2_CLIENT_ID = os.getenv('GOOGLE_OAUTH2_CLIENT_ID')
 GOOGLE_OAUTH2_CLIENT_SECRET = os.getenv('GOOGLE_OAUTH2_CLIENT_SECRET')
+# Signing keys of Google ID tokens, cached by main/google_tokens.py
+GOOGLE_OAUTH2_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
 
 # OTP Settings
 OTP_TOTP_ISSUER = 'GovSol'
@@ -195,6 +236,9 @@ OTP_LOGIN_URL = '/auth/login/'
 TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
 TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER')
+# main.otp_delivery.ConsoleSMSBackend or FileSMSBackend print SMS instead
+SMS_BACKEND = os.getenv('SMS_BACKEND', 'main.otp_delivery.TwilioSMSBackend')
+SMS_FILE_PATH = os.path.join(BASE_DIR, 'sent_sms.log')
 
 # Email Settings (for Email OTP)
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -204,3 +248,20 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+
+# Threads sending OTP emails and SMS in the background, see
+# main/otp_delivery.py. 0 sends them in the request.
+OTP_DELIVERY_WORKERS = int(os.getenv('OTP_DELIVERY_WORKERS', '2'))
+
+# Threads writing login attempts that do not open a session, see
+# main/login_audit.py. 0 writes them in the request.
+LOGIN_AUDIT_WORKERS = int(os.getenv('LOGIN_AUDIT_WORKERS', '1'))
+
+# Escalation scheduler: run it on a background thread of the web process
+# instead of as `manage.py escalate_issues --scheduler`. Only the first
+# process on a host to lock ESCALATION_SCHEDULER_LOCK_FILE runs it, so with
+# several hosts enable it on one of them only.
+ESCALATION_SCHEDULER_IN_PROCESS = os.getenv('ESCALATION_SCHEDULER_IN_PROCESS') == 'True'
+ESCALATION_SCHEDULER_LOCK_FILE = os.getenv(
+    'ESCALATION_SCHEDULER_LOCK_FILE', os.path.join(BASE_DIR, 'escalation_scheduler.lock')
+)
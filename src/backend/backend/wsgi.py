@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# Optional in-process escalation scheduler
+from main.scheduler import autostart  # noqa: E402
+
+autostart()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django import forms
+from . import routing, search
 from .models import (
     User, Province, District, DSDivision, GramaNiladhariDivision,
     Issue, IssueAttachment, IssueResponse, ResponseAttachment,
@@ -122,11 +123,14 @@ class UserAdmin(BaseUserAdmin):
     
     def approve_users(self, request, queryset):
         updated = queryset.update(is_approved=True)
+        # queryset.update() skips the post_save receiver that keeps routing current
+        routing.invalidate()
         self.message_user(request, f'{updated} users approved successfully.')
     approve_users.short_description = "Approve selected users"
     
     def reject_users(self, request, queryset):
         updated = queryset.update(is_approved=False)
+        routing.invalidate()
         self.message_user(request, f'{updated} users rejected.')
     reject_users.short_description = "Reject selected users"
 
@@ -232,14 +236,21 @@ class PublicCommentAdmin(admin.ModelAdmin):
     
     def approve_comments(self, request, queryset):
         updated = queryset.update(is_approved=True)
+        self.reindex_issues(queryset)
         self.message_user(request, f'{updated} comments approved successfully.')
     approve_comments.short_description = "Approve selected comments"
     
     def reject_comments(self, request, queryset):
         updated = queryset.update(is_approved=False)
+        self.reindex_issues(queryset)
         self.message_user(request, f'{updated} comments rejected.')
     reject_comments.short_description = "Reject selected comments"
 
+    def reindex_issues(self, queryset):
+        # queryset.update() skips the post_save receivers that keep search current
+        for issue_id in set(queryset.values_list('issue_id', flat=True)):
+            search.schedule_index(issue_id)
+
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
@@ -0,0 +1,276 @@
+"""
+Metadata of uploaded attachments.
+
+describe_upload() reads a new upload once, when its attachment row is first
+saved, and returns its size, a MIME type sniffed from its content, the
+pixel dimensions of images and MP4/QuickTime videos, and its SHA-256. The
+serializers render attachments from these stored values without touching
+the storage.
+
+render_thumbnails() writes the downscaled JPEG variants of an image, or of
+a poster frame of a video, that list pages show instead of the original.
+It runs in the worker processes of thumbnails.py, so nothing in this
+module may depend on Django.
+"""
+
+import hashlib
+import mimetypes
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm")
+
+# (offset, magic bytes, MIME type)
+SIGNATURES = (
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"AVI ", "video/x-msvideo"),
+    (0, b"\x1a\x45\xdf\xa3", "video/webm"),
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", "video/x-ms-wmv"),
+    (0, b"FLV", "video/x-flv"),
+    (0, b"%PDF-", "application/pdf"),
+)
+
+# Major brands of ISO-BMFF files (HEIF and AVIF photos, MP4 and QuickTime
+# videos) other than plain MP4
+BRANDS = {
+    b"heic": "image/heic",
+    b"heix": "image/heic",
+    b"heim": "image/heic",
+    b"heis": "image/heic",
+    b"mif1": "image/heif",
+    b"msf1": "image/heif",
+    b"avif": "image/avif",
+    b"avis": "image/avif",
+    b"qt  ": "video/quicktime",
+}
+
+# Sizes of the BMP info header versions
+BMP_HEADER_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+# Bytes of a file read to sniff its type
+HEAD_SIZE = 32
+
+# Largest moov box read when looking for a video's dimensions
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+
+# Thumbnail variants and the longest side of each, in pixels
+THUMBNAIL_SIZES = (("small", 160), ("medium", 480), ("preview", 1280))
+THUMBNAIL_QUALITY = 82
+# Offset of the poster frame of a video, in seconds
+POSTER_OFFSET = 1
+POSTER_TIMEOUT = 60
+
+
+def is_bmp(head):
+    """Whether a file starting with ``head`` has a BMP file and info header"""
+    if head[:2] != b"BM" or len(head) < 18:
+        return False
+    reserved, header_size = struct.unpack("<I4xI", head[6:18])
+    return reserved == 0 and header_size in BMP_HEADER_SIZES
+
+
+def sniff_mime_type(head, name):
+    """MIME type from the first bytes of a file, or else from its name"""
+    if head[4:8] == b"ftyp":
+        return BRANDS.get(head[8:12], "video/mp4")
+    if is_bmp(head):
+        return "image/bmp"
+    for offset, magic, mime_type in SIGNATURES:
+        if head[offset : offset + len(magic)] == magic:
+            return mime_type
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def get_media_type(mime_type, name):
+    """Classify an attachment as image, video or document"""
+    if mime_type:
+        if mime_type.startswith("image/"):
+            return "image"
+        if mime_type.startswith("video/"):
+            return "video"
+        return "document"
+    # Rows saved before MIME types were recorded
+    name = (name or "").lower()
+    if name.endswith(IMAGE_EXTENSIONS):
+        return "image"
+    if name.endswith(VIDEO_EXTENSIONS):
+        return "video"
+    return "document"
+
+
+def get_image_size(file):
+    try:
+        with Image.open(file) as image:
+            return image.size
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None
+
+
+def iter_boxes(file, end):
+    """Yield (type, payload start, payload end) of the ISO-BMFF boxes up to ``end``"""
+    position = file.tell()
+    while position + 8 <= end:
+        header = file.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack(">I4s", header)
+        start = position + 8
+        if size == 1:
+            size = struct.unpack(">Q", file.read(8))[0]
+            start += 8
+        elif size == 0:
+            size = end - position
+        if size < start - position:
+            return
+        yield box_type, start, position + size
+        position += size
+        file.seek(position)
+
+
+def get_video_size(file, file_size):
+    """Width and height of the first video track of an MP4/QuickTime file"""
+    try:
+        file.seek(0)
+        for box_type, start, end in iter_boxes(file, file_size):
+            if box_type != b"moov" or end - start > MAX_MOOV_SIZE:
+                continue
+            file.seek(start)
+            for trak_type, trak_start, trak_end in iter_boxes(file, end):
+                if trak_type != b"trak":
+                    continue
+                file.seek(trak_start)
+                for box, box_start, box_end in iter_boxes(file, trak_end):
+                    if box == b"tkhd" and box_end - box_start >= 84:
+                        # Width and height are 16.16 fixed point at the end
+                        file.seek(box_end - 8)
+                        width, height = struct.unpack(">II", file.read(8))
+                        if width and height:
+                            return width >> 16, height >> 16
+                file.seek(trak_end)
+            return None
+    except (OSError, struct.error):
+        return None
+    return None
+
+
+def describe_upload(file):
+    """Size, MIME type, dimensions and checksum of an uploaded file"""
+    # Uploads streamed through HashingUploadHandler are already hashed
+    checksum = getattr(file, "sha256", None)
+    if checksum:
+        file.seek(0)
+        head = file.read(HEAD_SIZE)
+    else:
+        hasher = hashlib.sha256()
+        head = b""
+        for chunk in file.chunks():
+            if len(head) < HEAD_SIZE:
+                head += chunk[: HEAD_SIZE - len(head)]
+            hasher.update(chunk)
+        checksum = hasher.hexdigest()
+
+    metadata = {
+        "file_size": file.size,
+        "mime_type": sniff_mime_type(head, file.name),
+        "width": None,
+        "height": None,
+        "checksum": checksum,
+    }
+
+    dimensions = None
+    if metadata["mime_type"].startswith("image/"):
+        file.seek(0)
+        dimensions = get_image_size(file)
+    elif metadata["mime_type"] in ("video/mp4", "video/quicktime"):
+        dimensions = get_video_size(file, file.size)
+    if dimensions:
+        metadata["width"], metadata["height"] = dimensions
+
+    file.seek(0)
+    return metadata
+
+
+def extract_poster_frame(source, destination):
+    """
+    Write a frame from the start of a video to ``destination`` with ffmpeg.
+    Returns False when ffmpeg is not installed or cannot decode the video.
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return False
+    # Very short clips have no frame at POSTER_OFFSET, fall back to the first
+    for offset in (POSTER_OFFSET, 0):
+        try:
+            subprocess.run(
+                [ffmpeg, "-v", "error", "-y", "-ss", str(offset), "-i", source]
+                + ["-frames:v", "1", destination],
+                check=True,
+                capture_output=True,
+                timeout=POSTER_TIMEOUT,
+            )
+        except (OSError, subprocess.SubprocessError):
+            continue
+        if os.path.exists(destination) and os.path.getsize(destination):
+            return True
+    return False
+
+
+def write_thumbnails(image, destination, stem):
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        # JPEG has no alpha, and dropping it would turn transparency black
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    names = {}
+    for variant, size in THUMBNAIL_SIZES:
+        name = f"{stem}-{variant}.jpg"
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+        thumbnail.save(
+            os.path.join(destination, name),
+            "JPEG",
+            quality=THUMBNAIL_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+        names[variant] = name
+    return names
+
+
+def render_thumbnails(source, mime_type, destination, stem):
+    """
+    Write the thumbnail variants of the file at path ``source`` into the
+    directory ``destination`` as ``<stem>-<variant>.jpg``. Returns a dict of
+    variant to file name, empty when the file cannot be rendered.
+    """
+    os.makedirs(destination, exist_ok=True)
+    try:
+        if mime_type.startswith("image/"):
+            with Image.open(source) as image:
+                # Decode only as much of a large JPEG as the largest variant needs
+                image.draft("RGB", (THUMBNAIL_SIZES[-1][1],) * 2)
+                return write_thumbnails(image, destination, stem)
+        if mime_type.startswith("video/"):
+            with tempfile.TemporaryDirectory() as directory:
+                poster = os.path.join(directory, "poster.jpg")
+                if extract_poster_frame(source, poster):
+                    with Image.open(poster) as image:
+                        return write_thumbnails(image, destination, stem)
+    except (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError):
+        pass
+    return {}
@@ -1,37 +1,23 @@
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from django.contrib.auth import authenticate
-from django.conf import settings
-from django.core.mail import send_mail
 from django.utils import timezone
-from google.oauth2 import id_token
-from google.auth.transport import requests
-import qrcode
-import io
-import base64
-from twilio.rest import Client
 import random
 import string
 
+from . import google_tokens, login_audit, otp_delivery, qr_codes
 from .models import User, GoogleAuthUser, OTPVerification, LoginAttempt
 from .serializers import UserSerializer
+from .throttles import AccountThrottle, IPThrottle, SessionThrottle
+from .utils import get_client_ip
 from rest_framework_simplejwt.tokens import RefreshToken
 
 
-def get_client_ip(request):
-    """Get client IP address from request"""
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
-
-
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([IPThrottle])
 def google_auth(request):
     """
     Handle Google OAuth authentication
@@ -45,26 +31,15 @@ def google_auth(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Verify Google ID token
-        idinfo = id_token.verify_oauth2_token(
-            token, 
-            requests.Request(), 
-            settings.GOOGLE_OAUTH2_CLIENT_ID
-        )
+        # Verify Google ID token against the cached signing keys
+        idinfo = google_tokens.verify_google_token(token)
 
         google_id = idinfo['sub']
         email = idinfo['email']
         name = idinfo.get('name', '')
         picture = idinfo.get('picture', '')
 
-        # Log login attempt
-        login_attempt = LoginAttempt.objects.create(
-            email=email,
-            google_id=google_id,
-            ip_address=get_client_ip(request),
-            is_successful=False,
-            otp_verified=False
-        )
+        ip_address = get_client_ip(request)
 
         # Check if user exists with Google auth
         try:
@@ -74,6 +49,7 @@ def google_auth(request):
             # Check if Google user has set up a password
             if not user.has_usable_password():
                 # First time Google user - require password setup
+                login_attempt = login_audit.open_session(email, ip_address, google_id)
                 return Response({
                     'message': 'Password setup required for your Google account',
                     'user': {
@@ -94,6 +70,7 @@ def google_auth(request):
             try:
                 existing_user = User.objects.get(email=email)
                 print(f"DEBUG: Found existing user: {existing_user.username}")  # Debug log
+                login_audit.record(email, ip_address, google_id)
                 
                 # If user exists but wants to use Google sign-up, 
                 # provide their existing username for traditional login
@@ -138,6 +115,7 @@ def google_auth(request):
                     google_id=google_id,
                     google_email=email
                 )
+                login_attempt = login_audit.open_session(email, ip_address, google_id)
                 
                 return Response({
                     'message': 'Account created - Complete your profile setup',
@@ -155,9 +133,9 @@ def google_auth(request):
                     'session_id': login_attempt.id
                 }, status=status.HTTP_200_OK)
 
-        # Update login attempt
-        login_attempt.is_successful = True
-        login_attempt.save()
+        login_attempt = login_audit.open_session(
+            email, ip_address, google_id, is_successful=True
+        )
 
         # Return user info and request OTP setup/verification
         return Response({
@@ -232,69 +210,33 @@ def setup_otp(request):
         )
 
         if otp_type == 'email':
-            # Send email OTP
-            try:
-                send_mail(
-                    'GovSol - Your OTP Code',
-                    f'Your OTP code is: {otp_verification.otp_code}. This code will expire in 10 minutes.',
-                    settings.DEFAULT_FROM_EMAIL,
-                    [user.email],
-                    fail_silently=False,
-                )
-                return Response({
-                    'message': 'OTP sent to your email',
-                    'otp_id': otp_verification.id
-                }, status=status.HTTP_200_OK)
-            except Exception as e:
-                return Response(
-                    {'error': f'Failed to send email: {str(e)}'}, 
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            # Sent in the background, see otp_delivery.py
+            otp_delivery.send_otp(otp_verification)
+            return Response({
+                'message': 'OTP sent to your email',
+                'otp_id': otp_verification.id
+            }, status=status.HTTP_200_OK)
 
         elif otp_type == 'sms':
-            # Send SMS OTP
             if not user.phone:
                 return Response(
                     {'error': 'Phone number not provided'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            
-            try:
-                client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-                message = client.messages.create(
-                    body=f'Your GovSol OTP code is: {otp_verification.otp_code}',
-                    from_=settings.TWILIO_PHONE_NUMBER,
-                    to=user.phone
-                )
-                return Response({
-                    'message': 'OTP sent to your phone',
-                    'otp_id': otp_verification.id
-                }, status=status.HTTP_200_OK)
-            except Exception as e:
-                return Response(
-                    {'error': f'Failed to send SMS: {str(e)}'}, 
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+
+            otp_delivery.send_otp(otp_verification)
+            return Response({
+                'message': 'OTP sent to your phone',
+                'otp_id': otp_verification.id
+            }, status=status.HTTP_200_OK)
 
         elif otp_type == 'google_auth':
-            # Generate QR code for Google Authenticator
-            qr_uri = otp_verification.get_qr_code_url()
-            
-            # Generate QR code image
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(qr_uri)
-            qr.make(fit=True)
-            
-            img = qr.make_image(fill_color="black", back_color="white")
-            buffer = io.BytesIO()
-            img.save(buffer, format='PNG')
-            buffer.seek(0)
-            
-            qr_code_base64 = base64.b64encode(buffer.getvalue()).decode()
-            
+            # Rendered in the QR code pool (see qr_codes.py)
+            qr_code = qr_codes.get_qr_code(otp_verification.get_qr_code_url())
+
             return Response({
                 'message': 'Scan QR code with Google Authenticator',
-                'qr_code': f'data:image/png;base64,{qr_code_base64}',
+                'qr_code': qr_code,
                 'secret_key': otp_verification.secret_key,
                 'otp_id': otp_verification.id
             }, status=status.HTTP_200_OK)
@@ -314,6 +256,7 @@ def setup_otp(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([IPThrottle, SessionThrottle])
 def verify_otp(request):
     """
     Verify OTP and complete login
@@ -368,9 +311,12 @@ def verify_otp(request):
 
         # Verify OTP
         if otp_verification.verify_otp(otp_code):
-            # Mark login attempt as OTP verified
-            login_attempt.otp_verified = True
-            login_attempt.save()
+            # Mark login attempt as OTP verified, once
+            if not login_audit.mark_otp_verified(login_attempt):
+                return Response(
+                    {'error': 'Invalid session'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             
             # Generate JWT tokens
             user = otp_verification.user
@@ -428,25 +374,13 @@ def resend_otp(request):
         
         # Generate new OTP
         otp_verification.otp_code = ''.join(random.choices(string.digits, k=6))
-        otp_verification.expires_at = timezone.now() + timezone.timedelta(minutes=10)
+        otp_verification.expires_at = timezone.now() + timezone.timedelta(
+            minutes=OTPVerification.get_expiry_minutes(otp_verification.otp_type)
+        )
         otp_verification.is_used = False
         otp_verification.save()
 
-        if otp_verification.otp_type == 'email':
-            send_mail(
-                'GovSol - Your New OTP Code',
-                f'Your new OTP code is: {otp_verification.otp_code}. This code will expire in 10 minutes.',
-                settings.DEFAULT_FROM_EMAIL,
-                [otp_verification.user.email],
-                fail_silently=False,
-            )
-        elif otp_verification.otp_type == 'sms':
-            client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-            client.messages.create(
-                body=f'Your new GovSol OTP code is: {otp_verification.otp_code}',
-                from_=settings.TWILIO_PHONE_NUMBER,
-                to=otp_verification.user.phone
-            )
+        otp_delivery.send_otp(otp_verification, resend=True)
 
         return Response({
             'message': 'New OTP sent successfully'
@@ -506,8 +440,7 @@ def setup_password(request):
         user.save()
 
         # Mark login attempt as successful now that password is set
-        login_attempt.is_successful = True
-        login_attempt.save()
+        login_audit.mark_successful(login_attempt)
 
         return Response({
             'message': 'Password set successfully. Please complete 2FA setup.',
@@ -530,6 +463,7 @@ def setup_password(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([IPThrottle, SessionThrottle])
 def verify_password(request):
     """
     Verify password for existing users linking Google account
@@ -578,8 +512,7 @@ def verify_password(request):
         )
 
         # Update login attempt
-        login_attempt.is_successful = True
-        login_attempt.save()
+        login_audit.mark_successful(login_attempt)
 
         return Response({
             'message': 'Password verified and Google account linked. Please complete 2FA setup.',
@@ -676,6 +609,7 @@ def update_username(request):
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
+@throttle_classes([IPThrottle, AccountThrottle])
 def check_email_exists(request):
     """Check if email exists and return username if found"""
     email = request.data.get('email', '').strip().lower()
@@ -0,0 +1,267 @@
+"""
+In-memory snapshot of the administrative division hierarchy.
+
+The Province -> District -> DS division -> GN division tree is read by the
+issue form on every keystroke but changes almost never. get_tree() builds
+a read-only snapshot of the serialized rows once per process and serves
+the division list and search endpoints from it, together with an ETag and
+Last-Modified time for conditional requests.
+
+Name search uses DivisionSearchIndex: a sorted list of names and word
+suffixes for prefix matches, and an n-gram index for substring and fuzzy
+matches, over the names in all three languages.
+
+Saving or deleting a division calls invalidate() (see signals.py), which
+bumps a version in the default cache so that every process sharing that
+cache rebuilds its snapshot on the next request.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+import uuid
+from bisect import bisect_left
+from collections import Counter
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import District, DSDivision, GramaNiladhariDivision, Province
+from .serializers import (
+    DistrictSerializer,
+    DSDivisionSerializer,
+    GramaNiladhariDivisionSerializer,
+    ProvinceSerializer,
+)
+
+
+VERSION_CACHE_KEY = "divisions:version"
+
+SEARCH_FIELDS = ("name_en", "name_si", "name_ta")
+DIVISION_TYPES = ("province", "district", "ds_division", "gn_division")
+
+# Match ranks, best first
+PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(4)
+
+# Queries shorter than this are not matched fuzzily
+FUZZY_MIN_LENGTH = 4
+# Share of the query's trigrams a fuzzy match must contain
+FUZZY_THRESHOLD = 0.6
+
+WORD_START = re.compile(r"(?<=[\s\-/(),.])\w")
+
+_lock = threading.Lock()
+_tree = None
+
+
+def serialize(serializer_class, queryset):
+    return tuple(dict(row) for row in serializer_class(queryset, many=True).data)
+
+
+def group_by(rows, field):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[field], []).append(row)
+    return {key: tuple(group) for key, group in groups.items()}
+
+
+def normalize(text):
+    return unicodedata.normalize("NFC", text).casefold()
+
+
+def ngrams(text, size):
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+class DivisionSearchIndex:
+    """Ranked prefix, substring and fuzzy name search over division rows"""
+
+    def __init__(self, entries):
+        # entries are (division type, row) pairs
+        self.entries = entries
+        self.names = []
+        # Sorted (name or word suffix, entry id, rank) per division type
+        prefixes = {division_type: [] for division_type in DIVISION_TYPES}
+        self.grams = {}
+
+        for entry_id, (division_type, row) in enumerate(entries):
+            names = tuple({normalize(row[field]) for field in SEARCH_FIELDS})
+            self.names.append(names)
+            for name in names:
+                prefixes[division_type].append((name, entry_id, PREFIX))
+                for match in WORD_START.finditer(name):
+                    prefixes[division_type].append(
+                        (name[match.start() :], entry_id, WORD_PREFIX)
+                    )
+                # Pad with spaces so that fuzzy matches favour the right ends
+                for gram in ngrams(f" {name} ", 2) | ngrams(f" {name} ", 3):
+                    self.grams.setdefault(gram, set()).add(entry_id)
+
+        self.prefixes = {}
+        for division_type, type_prefixes in prefixes.items():
+            type_prefixes.sort()
+            keys = [text for text, entry_id, rank in type_prefixes]
+            self.prefixes[division_type] = (keys, type_prefixes)
+
+    def search(self, query, division_type="all", limit=5):
+        """
+        Yield (division type, row) for up to ``limit`` best matches of each
+        type, in DIVISION_TYPES order.
+        """
+        query = normalize(query.strip())
+        if not query:
+            return
+        types = DIVISION_TYPES if division_type == "all" else (division_type,)
+        # entry id -> (rank, tie breaker), lower is better
+        matches = {}
+
+        # Prefixes come out in alphabetical order, so stop once a type has
+        # enough whole-name prefix matches
+        for entry_type in types:
+            keys, prefixes = self.prefixes[entry_type]
+            prefix_matches = 0
+            for i in range(bisect_left(keys, query), len(keys)):
+                text, entry_id, rank = prefixes[i]
+                if not text.startswith(query) or prefix_matches >= limit:
+                    break
+                if entry_id not in matches or rank < matches[entry_id][0]:
+                    if rank == PREFIX:
+                        prefix_matches += 1
+                    matches[entry_id] = (rank, i)
+
+        if not self.has_enough(matches, types, limit):
+            postings = sorted(
+                (
+                    self.grams.get(gram, set())
+                    for gram in ngrams(query, 3 if len(query) >= 3 else 2)
+                ),
+                key=len,
+            )
+            if postings and postings[0]:
+                # A query no longer than the n-gram size is its only n-gram,
+                # so its posting list needs no checking
+                exact = len(postings) == 1 and len(query) <= 3
+                for entry_id in set.intersection(*postings):
+                    if entry_id not in matches and (
+                        exact or any(query in name for name in self.names[entry_id])
+                    ):
+                        row = self.entries[entry_id][1]
+                        matches[entry_id] = (SUBSTRING, len(row["name_en"]))
+
+        if len(query) >= FUZZY_MIN_LENGTH and not self.has_enough(
+            matches, types, limit
+        ):
+            grams = ngrams(f" {query}", 3)
+            shared = Counter()
+            for gram in grams:
+                shared.update(self.grams.get(gram, ()))
+            needed = FUZZY_THRESHOLD * len(grams)
+            for entry_id, count in shared.items():
+                if count >= needed and entry_id not in matches:
+                    matches[entry_id] = (FUZZY, -count)
+
+        ranked = {division_type: [] for division_type in types}
+        for entry_id, (rank, tie_breaker) in matches.items():
+            entry_type = self.entries[entry_id][0]
+            if entry_type in ranked:
+                ranked[entry_type].append((rank, tie_breaker, entry_id))
+        for entry_type in types:
+            for rank, tie_breaker, entry_id in sorted(ranked[entry_type])[:limit]:
+                yield self.entries[entry_id]
+
+    def has_enough(self, matches, types, limit):
+        found = Counter(self.entries[entry_id][0] for entry_id in matches)
+        return all(found[t] >= limit for t in types)
+
+
+class DivisionTree:
+    """Serialized division rows, ordered by English name. Do not modify them."""
+
+    def __init__(self, version):
+        self.version = version
+        self.provinces = serialize(
+            ProvinceSerializer, Province.objects.order_by("name_en")
+        )
+        self.districts = serialize(
+            DistrictSerializer,
+            District.objects.select_related("province").order_by("name_en"),
+        )
+        self.ds_divisions = serialize(
+            DSDivisionSerializer,
+            DSDivision.objects.select_related("district__province").order_by(
+                "name_en"
+            ),
+        )
+        self.gn_divisions = serialize(
+            GramaNiladhariDivisionSerializer,
+            GramaNiladhariDivision.objects.select_related(
+                "ds_division__district__province"
+            ).order_by("name_en"),
+        )
+
+        self.children = {
+            "province": group_by(self.districts, "province"),
+            "district": group_by(self.ds_divisions, "district"),
+            "ds_division": group_by(self.gn_divisions, "ds_division"),
+        }
+        self.ids = {
+            "province": {row["id"] for row in self.provinces},
+            "district": {row["id"] for row in self.districts},
+            "ds_division": {row["id"] for row in self.ds_divisions},
+        }
+        self.search_index = DivisionSearchIndex(
+            [
+                (division_type, row)
+                for division_type, rows in (
+                    ("province", self.provinces),
+                    ("district", self.districts),
+                    ("ds_division", self.ds_divisions),
+                    ("gn_division", self.gn_divisions),
+                )
+                for row in rows
+            ]
+        )
+
+        content = json.dumps(
+            [self.provinces, self.districts, self.ds_divisions, self.gn_divisions],
+            cls=DjangoJSONEncoder,
+        )
+        self.etag = f'"{hashlib.sha1(content.encode()).hexdigest()}"'
+        self.last_modified = timezone.now().replace(microsecond=0)
+
+    def search(self, query, division_type="all", limit=5):
+        return self.search_index.search(query, division_type, limit)
+
+
+def get_tree():
+    global _tree
+    version = cache.get(VERSION_CACHE_KEY)
+    tree = _tree
+    if tree is None or version is None or tree.version != version:
+        with _lock:
+            version = cache.get(VERSION_CACHE_KEY)
+            if version is None:
+                version = uuid.uuid4().hex
+                cache.set(VERSION_CACHE_KEY, version, None)
+            if _tree is None or _tree.version != version:
+                _tree = DivisionTree(version)
+            tree = _tree
+    return tree
+
+
+def invalidate():
+    """Make every process rebuild its snapshot on its next request"""
+    global _tree
+    _tree = None
+    cache.delete(VERSION_CACHE_KEY)
+
+
+def get_etag(request, *args, **kwargs):
+    return get_tree().etag
+
+
+def get_last_modified(request, *args, **kwargs):
+    return get_tree().last_modified
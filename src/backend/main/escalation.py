@@ -0,0 +1,158 @@
+"""
+Set-based escalation of overdue issues.
+
+The escalate_issues command used to look up a handler, insert an
+IssueEscalation and save the issue one row at a time. escalate_overdue()
+resolves the next-level handlers from the routing table, plans each move
+with the state machine (see state_machine.py) and writes the results in
+chunked transactions.
+
+Each issue is moved with a conditional UPDATE of only the changed fields,
+guarded by the version it was read with. An issue that an official
+responded to, or another escalation process moved, in the meantime is
+skipped rather than overwritten or escalated twice, without holding row
+locks across the batch.
+
+The reporter and the new handler of each escalated issue are notified,
+and the current handler of an issue that could not be escalated gets a
+reminder that it is overdue.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import events, notifications, routing, state_machine, stats
+from .models import Issue, IssueEscalation
+
+
+ISSUE_FIELDS = [
+    "id",
+    "reference_number",
+    "current_handler",
+    "current_level",
+    "escalation_count",
+    "province",
+    "district",
+    "ds_division",
+    # Guards the conditional updates
+    "version",
+    # Read so the dashboard counters can be moved without another query
+    "status",
+    "grama_niladhari_division",
+    "reporter_user",
+]
+
+
+def get_overdue_issues(now=None):
+    return Issue.objects.filter(
+        status__in=state_machine.AUTO_ESCALATION_STATUSES,
+        next_escalation_date__lte=now or timezone.now(),
+        current_level__in=state_machine.AUTO_ESCALATION_LEVELS,
+    )
+
+
+def escalate_overdue(now=None, batch_size=500, log=None, issue_ids=None):
+    """
+    Escalate every overdue issue to its next level, or only the overdue
+    issues among ``issue_ids`` when given.
+
+    Issues with no approved official at the next level are retried after
+    state_machine.RETRY_DELAY. Issues changed by another writer since they
+    were read are left alone. ``log`` is called with a line per escalated,
+    deferred or skipped issue. Returns counts of escalated, deferred and
+    conflicting issues and of batches.
+    """
+    now = now or timezone.now()
+    overdue = get_overdue_issues(now)
+    if issue_ids is not None:
+        overdue = overdue.filter(id__in=issue_ids)
+    issues = list(overdue.only(*ISSUE_FIELDS).order_by("id"))
+
+    windows = state_machine.get_escalation_windows()
+
+    result = {"escalated": 0, "deferred": 0, "conflicts": 0, "batches": 0}
+    for start in range(0, len(issues), batch_size):
+        escalations = []
+        escalated = []
+        deferred = []
+        conflicts = 0
+
+        batch = issues[start : start + batch_size]
+        handler_ids = {
+            issue.id: routing.pick_handler(
+                state_machine.get_next_level(issue.current_level), issue
+            )
+            for issue in batch
+        }
+        planned = state_machine.plan_many(
+            [issue for issue in batch if handler_ids[issue.id] is not None],
+            state_machine.AUTO_ESCALATE,
+            now,
+            windows,
+            handler_ids,
+        ) + state_machine.plan_many(
+            [issue for issue in batch if handler_ids[issue.id] is None],
+            state_machine.DEFER,
+            now,
+            windows,
+        )
+
+        with transaction.atomic():
+            for issue, changes in planned:
+                current_level = issue.current_level
+                from_user_id = issue.current_handler_id
+
+                if not state_machine.write(issue, changes):
+                    # Changed since it was read, it is rescheduled by its new
+                    # deadline if it is still overdue
+                    conflicts += 1
+                    if log:
+                        log(f"Skipped {issue.reference_number}, changed meanwhile")
+                    continue
+
+                next_level = state_machine.get_next_level(current_level)
+                if handler_ids[issue.id] is None:
+                    deferred.append(issue)
+                    if log:
+                        log(
+                            f"No user found at level {next_level} for issue "
+                            f"{issue.reference_number}"
+                        )
+                    continue
+
+                escalations.append(
+                    IssueEscalation(
+                        issue_id=issue.id,
+                        from_user_id=from_user_id,
+                        to_user_id=handler_ids[issue.id],
+                        from_level=current_level,
+                        to_level=next_level,
+                        reason="Auto-escalated due to no response within deadline",
+                    )
+                )
+                escalated.append(issue)
+                if log:
+                    log(
+                        f"Escalated {issue.reference_number} from {current_level} "
+                        f"to {next_level}"
+                    )
+
+            IssueEscalation.objects.bulk_create(escalations)
+            # update() skips post_save, so move the dashboard counters here
+            stats.record_changes(escalated)
+            notifications.notify_many(
+                "issue_escalated", [issue.id for issue in escalated]
+            )
+            notifications.notify_many("reminder", [issue.id for issue in deferred])
+            # bulk_create() and update() skip the signals live updates are
+            # published from
+            for issue, escalation in zip(escalated, escalations):
+                events.publish_status(issue)
+                events.publish_escalation(issue, escalation)
+
+        result["escalated"] += len(escalated)
+        result["deferred"] += len(deferred)
+        result["conflicts"] += conflicts
+        result["batches"] += 1
+
+    return result
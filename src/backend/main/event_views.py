@@ -0,0 +1,106 @@
+"""
+Server-sent event streams of live issue updates.
+
+GET /api/issues/<id>/events/ streams the status, response and escalation
+events of one issue to anyone who can view it. GET /api/events/ streams
+the events of every issue the signed-in user reported or handles; since
+EventSource cannot send headers, it also accepts the access token as a
+``token`` query parameter.
+
+The streams are async views and need the ASGI server (backend/asgi.py),
+where each open stream costs a coroutine rather than a worker. A stream
+ends after STREAM_DURATION and the browser reconnects with Last-Event-ID,
+which replays anything it missed from the broker's history.
+"""
+
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from . import events
+from .models import Issue
+
+
+# Seconds between keep-alive comments, so proxies do not drop idle streams
+KEEPALIVE_INTERVAL = 15
+# Seconds a stream stays open before the client is made to reconnect
+STREAM_DURATION = 300
+# Reconnection delay suggested to EventSource, in milliseconds
+RETRY_DELAY = 3000
+
+
+def get_last_event_id(request):
+    value = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def stream(topics, last_event_id):
+    broker = events.get_broker()
+    subscription = broker.subscribe(topics, last_event_id)
+    try:
+        yield f"retry: {RETRY_DELAY}\n\n"
+        deadline = time.monotonic() + STREAM_DURATION
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = await subscription.get(min(KEEPALIVE_INTERVAL, remaining))
+            if message is events.OVERFLOW:
+                break
+            yield message if message is not None else ": keepalive\n\n"
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def event_stream_response(request, topics):
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI the stream would tie up a worker and arrive all at once
+        return JsonResponse(
+            {"error": "Live updates are only served by the ASGI server"}, status=501
+        )
+    response = StreamingHttpResponse(
+        stream(topics, get_last_event_id(request)), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@sync_to_async
+def authenticate(request):
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    if header is not None:
+        raw_token = authentication.get_raw_token(header)
+    else:
+        raw_token = request.GET.get("token")
+    if not raw_token:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (AuthenticationFailed, InvalidToken, TokenError):
+        return None
+
+
+@require_GET
+async def issue_events(request, issue_id):
+    if not await Issue.objects.filter(pk=issue_id).aexists():
+        return JsonResponse({"error": "Issue not found"}, status=404)
+    return event_stream_response(request, [events.issue_topic(issue_id)])
+
+
+@require_GET
+async def user_events(request):
+    user = await authenticate(request)
+    if user is None:
+        return JsonResponse(
+            {"error": "Authentication credentials were not provided"}, status=401
+        )
+    return event_stream_response(request, [events.user_topic(user.pk)])
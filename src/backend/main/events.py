@@ -0,0 +1,209 @@
+"""
+Live issue events for the server-sent event streams in event_views.py.
+
+Signal receivers publish an event after commit whenever an issue changes
+status, gets a response or is escalated (see signals.py and
+escalation.py). Each event goes to the topic of the issue and to the
+topics of its reporter and current handler, and every stream subscribed
+to one of those topics receives it.
+
+The broker is chosen with the EVENT_BROKER setting. LocalBroker keeps the
+subscribers and a short per-topic history in memory, so it only reaches
+streams served by the same process; deployments with several ASGI
+workers can plug in a shared broker with the same publish() and
+subscribe() interface.
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+
+# Returned by Subscription.get() when the subscriber fell too far behind
+OVERFLOW = object()
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def issue_topic(issue_id):
+    return f"issue:{issue_id}"
+
+
+def user_topic(user_id):
+    return f"user:{user_id}"
+
+
+def format_event(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n"
+
+
+class Subscription:
+    """A stream's queue of formatted events, read on its event loop"""
+
+    def __init__(self, topics, loop, size):
+        self.topics = topics
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.overflowed = False
+
+    def deliver(self, message):
+        # Called from whichever thread published the event
+        self.loop.call_soon_threadsafe(self.put, message)
+
+    def put(self, message):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The client reconnects and catches up from the history
+            self.overflowed = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+
+    async def get(self, timeout):
+        """The next message, or None when none arrives within ``timeout``"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LocalBroker:
+    """In-process publish/subscribe with a short replay history per topic"""
+
+    def __init__(self, history_size=50, max_topics=10000, queue_size=100):
+        self.history_size = history_size
+        self.max_topics = max_topics
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.subscribers = {}
+        # topic -> deque of (event id, message), least recently used first
+        self.history = OrderedDict()
+
+    def publish(self, topics, event_type, data):
+        data = json.dumps(data, cls=DjangoJSONEncoder)
+        with self.lock:
+            event_id = next(self.ids)
+            message = format_event(event_id, event_type, data)
+            subscribers = set()
+            for topic in topics:
+                history = self.history.get(topic)
+                if history is None:
+                    history = self.history[topic] = deque(maxlen=self.history_size)
+                    if len(self.history) > self.max_topics:
+                        self.history.popitem(last=False)
+                else:
+                    self.history.move_to_end(topic)
+                history.append((event_id, message))
+                subscribers.update(self.subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.deliver(message)
+        return event_id
+
+    def subscribe(self, topics, last_event_id=None):
+        """
+        Subscribe the running event loop to ``topics``. Events published
+        after ``last_event_id`` that are still in the history are queued
+        straight away.
+        """
+        subscription = Subscription(topics, asyncio.get_running_loop(), self.queue_size)
+        with self.lock:
+            if last_event_id is not None:
+                missed = sorted(
+                    {
+                        (event_id, message)
+                        for topic in topics
+                        for event_id, message in self.history.get(topic, ())
+                        if event_id > last_event_id
+                    }
+                )
+                # Leave room in the queue for new events
+                for event_id, message in missed[-(self.queue_size // 2) :]:
+                    subscription.put(message)
+            for topic in topics:
+                self.subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                subscribers = self.subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[topic]
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.EVENT_BROKER)()
+    return _broker
+
+
+def get_issue_topics(issue, user_ids=()):
+    topics = [issue_topic(issue.pk)]
+    for user_id in (issue.reporter_user_id, issue.current_handler_id, *user_ids):
+        if user_id is not None and user_topic(user_id) not in topics:
+            topics.append(user_topic(user_id))
+    return topics
+
+
+def publish_issue_event(issue, event_type, data, user_ids=()):
+    """
+    Publish an event about ``issue`` once the current transaction commits,
+    to the issue, its reporter and handler and any other ``user_ids``
+    """
+    topics = get_issue_topics(issue, user_ids)
+    data = {"issue": issue.pk, "reference_number": issue.reference_number, **data}
+    transaction.on_commit(lambda: get_broker().publish(topics, event_type, data))
+
+
+def publish_status(issue):
+    publish_issue_event(
+        issue,
+        "status",
+        {
+            "status": issue.status,
+            "current_level": issue.current_level,
+            "updated_at": issue.updated_at,
+        },
+    )
+
+
+def publish_response(response):
+    publish_issue_event(
+        response.issue,
+        "response",
+        {
+            "response": response.pk,
+            "response_type": response.response_type,
+            "created_at": response.created_at,
+        },
+    )
+
+
+def publish_escalation(issue, escalation):
+    publish_issue_event(
+        issue,
+        "escalation",
+        {
+            "from_level": escalation.from_level,
+            "to_level": escalation.to_level,
+            "escalated_at": escalation.escalated_at,
+        },
+        # The issue may not have been handed to the new handler yet
+        user_ids=[escalation.to_user_id],
+    )
@@ -0,0 +1,105 @@
+"""
+A stand-in for Google's ID token signing keys, for tests and offline
+benchmarks.
+
+KeyServer generates RSA keys, serves their public halves on a local port
+in the {key id: PEM} format of Google's certificate endpoint, and signs
+ID tokens with them. Point GOOGLE_OAUTH2_CERTS_URL (or a TokenVerifier)
+at ``server.url`` and the whole google_auth path runs without a network.
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from google.auth import crypt, jwt
+
+
+class KeyServer:
+    def __init__(self, key_count=2, bits=2048, max_age=3600):
+        self.bits = bits
+        self.max_age = max_age
+        self.signers = {}
+        self.certs = {}
+        # Certificate requests served so far
+        self.requests = 0
+        for _ in range(key_count):
+            self.add_key()
+        self.server = None
+        self.thread = None
+
+    def add_key(self):
+        key_id = uuid.uuid4().hex
+        public_key, private_key = rsa.newkeys(self.bits)
+        self.signers[key_id] = crypt.RSASigner.from_string(
+            private_key.save_pkcs1(), key_id=key_id
+        )
+        self.certs[key_id] = public_key.save_pkcs1().decode("ascii")
+        return key_id
+
+    def rotate(self):
+        """Start signing with a new key and retire the oldest one"""
+        oldest = next(iter(self.certs))
+        key_id = self.add_key()
+        del self.certs[oldest]
+        del self.signers[oldest]
+        return key_id
+
+    def sign(self, audience, key_id=None, lifetime=3600, **claims):
+        """An ID token for ``audience`` signed with ``key_id`` or the newest key"""
+        key_id = key_id or list(self.signers)[-1]
+        now = int(time.time())
+        payload = {
+            "iss": "https://accounts.google.com",
+            "aud": audience,
+            "sub": "1234567890",
+            "email": "citizen@example.com",
+            "email_verified": True,
+            "iat": now,
+            "exp": now + lifetime,
+        }
+        payload.update(claims)
+        return jwt.encode(self.signers[key_id], payload).decode("ascii")
+
+    def start(self):
+        key_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                key_server.requests += 1
+                body = json.dumps(key_server.certs).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header(
+                    "Cache-Control", f"public, max-age={key_server.max_age}"
+                )
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/oauth2/v1/certs"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
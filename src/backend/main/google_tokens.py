@@ -0,0 +1,162 @@
+"""
+Verification of Google ID tokens against a cached set of signing keys.
+
+google_auth used to call id_token.verify_oauth2_token() with a new
+transport per login, which downloads Google's signing certificates
+before checking the token. TokenVerifier keeps the certificates in
+memory for as long as Google's Cache-Control header allows (or
+CERTS_TTL), fetches them again through one reused transport when they
+expire or a token names a key it has not seen, and checks signatures
+locally with google.auth.jwt. If a refresh fails, the keys already held
+keep being used.
+
+Tokens that verified are remembered until they expire, so a client
+retrying a login with the same credential is not verified twice.
+
+The certificate URL is the GOOGLE_OAUTH2_CERTS_URL setting. See
+google_keyserver.py for a local stand-in used by the tests and
+``manage.py benchmark_google_auth``.
+"""
+
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from google.auth import exceptions, jwt
+from google.auth.transport import requests
+
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+# Seconds the certificates are kept when the response does not say
+CERTS_TTL = 3600
+# Seconds between refreshes caused by unknown key ids, so tokens with made
+# up key ids cannot make every request fetch the certificates
+MIN_REFRESH_INTERVAL = 60
+# Verified tokens remembered at most
+VERIFIED_CACHE_SIZE = 1024
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_key_id(token):
+    """The ``kid`` in the header of ``token``, without verifying anything"""
+    if isinstance(token, bytes):
+        token = token.decode("ascii", "replace")
+    header = token.split(".", 1)[0]
+    try:
+        decoded = base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))
+        return json.loads(decoded).get("kid")
+    except (ValueError, AttributeError):
+        raise ValueError("Malformed token header") from None
+
+
+class CertificateCache:
+    def __init__(self, url, request=None):
+        self.url = url
+        self.request = request or requests.Request()
+        self.lock = threading.Lock()
+        self.certs = {}
+        self.expires_at = 0
+        self.fetched_at = None
+
+    def fetch(self):
+        response = self.request(self.url, method="GET")
+        if response.status != 200:
+            raise exceptions.TransportError(
+                f"Could not fetch certificates at {self.url}"
+            )
+        match = MAX_AGE.search(response.headers.get("cache-control", ""))
+        ttl = int(match.group(1)) if match else CERTS_TTL
+        return json.loads(response.data.decode("utf-8")), ttl
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now < self.expires_at:
+                return
+            recently = self.fetched_at and now - self.fetched_at < MIN_REFRESH_INTERVAL
+            if force and recently:
+                return
+            try:
+                certs, ttl = self.fetch()
+            except exceptions.TransportError:
+                if not self.certs:
+                    raise
+                # Keep using the keys we have and try again shortly
+                self.expires_at = now + MIN_REFRESH_INTERVAL
+                return
+            self.certs = certs
+            self.fetched_at = now
+            self.expires_at = now + ttl
+
+    def get(self, key_id):
+        """The certificates to check a token signed with ``key_id`` against"""
+        if time.monotonic() >= self.expires_at:
+            self.refresh()
+        if key_id is not None and key_id not in self.certs:
+            # Google rotates its keys, and may have started signing with a
+            # new one
+            self.refresh(force=True)
+        return self.certs
+
+
+class TokenVerifier:
+    def __init__(self, audience, certs_url, request=None):
+        self.audience = audience
+        self.certificates = CertificateCache(certs_url, request)
+        self.lock = threading.Lock()
+        # sha256 of the token -> its claims, oldest first
+        self.verified = OrderedDict()
+
+    def verify(self, token):
+        """
+        The claims of a Google ID token for this audience. Raises
+        ValueError if it is malformed, expired, wrongly signed or issued by
+        someone other than Google.
+        """
+        if isinstance(token, str):
+            token = token.encode("utf-8")
+        key = hashlib.sha256(token).digest()
+        with self.lock:
+            claims = self.verified.get(key)
+        if claims is not None and claims["exp"] > time.time():
+            return dict(claims)
+
+        certs = self.certificates.get(get_key_id(token))
+        claims = jwt.decode(token, certs=certs, audience=self.audience)
+        if claims.get("iss") not in GOOGLE_ISSUERS:
+            raise ValueError(f"Wrong issuer, expected one of {GOOGLE_ISSUERS}")
+
+        with self.lock:
+            self.verified[key] = claims
+            self.verified.move_to_end(key)
+            while len(self.verified) > VERIFIED_CACHE_SIZE:
+                self.verified.popitem(last=False)
+        return dict(claims)
+
+
+def get_verifier():
+    global _verifier
+    verifier = _verifier
+    if (
+        verifier is None
+        or verifier.audience != settings.GOOGLE_OAUTH2_CLIENT_ID
+        or verifier.certificates.url != settings.GOOGLE_OAUTH2_CERTS_URL
+    ):
+        with _verifier_lock:
+            _verifier = verifier = TokenVerifier(
+                settings.GOOGLE_OAUTH2_CLIENT_ID, settings.GOOGLE_OAUTH2_CERTS_URL
+            )
+    return verifier
+
+
+def verify_google_token(token):
+    return get_verifier().verify(token)
@@ -0,0 +1,161 @@
+"""
+Login attempt audit log and its retention.
+
+A LoginAttempt row doubles as the login session of the Google sign-in
+flow: its id is the session_id the client passes to the password and OTP
+steps, so google_auth inserts it, once, with its final state, and the
+later steps flip single columns with conditional UPDATEs.
+
+Only attempts that do not open a session are batched. Session rows cannot
+be, because their id has to be in the response, which a queued row does
+not have yet. That leaves one kind of row: a Google sign-up for an email
+that already has an account, which google_auth hands to record(). It
+queues the row for a background worker that writes each batch with one
+bulk_create. With LOGIN_AUDIT_WORKERS = 0 it is written in the request.
+No other view writes LoginAttempt rows; UserLoginView and the other
+password and OTP checks leave failures to the throttles (throttles.py)
+rather than the audit log.
+
+Raw attempts are only needed for a while. compact() folds those from
+before the retention period (the ``login_attempt_retention_days``
+SystemSetting, RETENTION_DAYS by default) into one LoginAttemptSummary
+row per day and IP address and deletes them. Run it daily with
+``manage.py compact_login_attempts``.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import system_settings
+from .models import LoginAttempt, LoginAttemptSummary
+from .workers import BackgroundWorker
+
+RETENTION_DAYS = 30
+RETENTION_DAYS_KEY = "login_attempt_retention_days"
+
+
+def write(attempts):
+    LoginAttempt.objects.bulk_create(attempts)
+
+
+worker = BackgroundWorker(
+    "login-audit", write, batch_size=500, threads=max(settings.LOGIN_AUDIT_WORKERS, 1)
+)
+
+
+def record(email, ip_address, google_id=None, is_successful=False):
+    """Log an attempt that does not open a session"""
+    attempt = LoginAttempt(
+        email=email,
+        google_id=google_id,
+        ip_address=ip_address,
+        is_successful=is_successful,
+    )
+    if not settings.LOGIN_AUDIT_WORKERS:
+        write([attempt])
+        return
+    worker.put(attempt)
+
+
+def flush():
+    worker.flush()
+
+
+def open_session(email, ip_address, google_id, is_successful=False):
+    """Log an attempt whose id is handed to the client as its session_id"""
+    return LoginAttempt.objects.create(
+        email=email,
+        google_id=google_id,
+        ip_address=ip_address,
+        is_successful=is_successful,
+    )
+
+
+def mark_successful(attempt):
+    LoginAttempt.objects.filter(id=attempt.id).update(is_successful=True)
+    attempt.is_successful = True
+
+
+def mark_otp_verified(attempt):
+    """Close the session, returning False if it was already closed"""
+    closed = LoginAttempt.objects.filter(id=attempt.id, otp_verified=False).update(
+        otp_verified=True
+    )
+    attempt.otp_verified = True
+    return bool(closed)
+
+
+def get_retention_days():
+    return system_settings.get_int(RETENTION_DAYS_KEY, RETENTION_DAYS, 1)
+
+
+def get_cutoff(days):
+    """Start of the first day whose attempts are kept"""
+    day = timezone.localdate() - timedelta(days=days)
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def compact(days=None):
+    """
+    Fold attempts from before the last ``days`` days into daily per-IP
+    summaries and delete them. Returns the number of attempts folded.
+    """
+    if days is None:
+        days = get_retention_days()
+    attempts = LoginAttempt.objects.filter(attempt_time__lt=get_cutoff(days))
+
+    with transaction.atomic():
+        # Leave alone attempts written while this runs
+        last_id = attempts.aggregate(last_id=Max("id"))["last_id"]
+        if last_id is None:
+            return 0
+        attempts = attempts.filter(id__lte=last_id)
+        totals = (
+            attempts.annotate(day=TruncDate("attempt_time"))
+            .values("day", "ip_address")
+            .annotate(
+                attempts=Count("id"),
+                successful=Count("id", filter=Q(is_successful=True)),
+                otp_verified=Count("id", filter=Q(otp_verified=True)),
+            )
+            .order_by()
+        )
+        totals = {(row["day"], row["ip_address"]): row for row in totals}
+
+        # A day may already have been partly folded by an earlier run
+        summaries = {
+            (summary.day, summary.ip_address): summary
+            for summary in LoginAttemptSummary.objects.select_for_update().filter(
+                day__in={day for day, ip_address in totals}
+            )
+        }
+        created = []
+        for key, row in totals.items():
+            summary = summaries.get(key)
+            if summary is None:
+                created.append(
+                    LoginAttemptSummary(
+                        day=row["day"],
+                        ip_address=row["ip_address"],
+                        attempts=row["attempts"],
+                        successful=row["successful"],
+                        otp_verified=row["otp_verified"],
+                    )
+                )
+                continue
+            summary.attempts += row["attempts"]
+            summary.successful += row["successful"]
+            summary.otp_verified += row["otp_verified"]
+        LoginAttemptSummary.objects.bulk_create(created, batch_size=500)
+        updated = [summary for key, summary in summaries.items() if key in totals]
+        LoginAttemptSummary.objects.bulk_update(
+            updated, ["attempts", "successful", "otp_verified"], batch_size=500
+        )
+        # Nothing refers to attempts, so this is a single DELETE
+        deleted, _ = attempts.delete()
+    return deleted
@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from google.auth.transport import requests
+from google.oauth2 import id_token
+
+from main.google_keyserver import KeyServer
+from main.google_tokens import TokenVerifier
+
+
+AUDIENCE = 'benchmark-client-id'
+
+
+class Command(BaseCommand):
+    help = 'Time Google ID token verification offline, against a local stand-in key server'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tokens',
+            type=int,
+            default=500,
+            help='Number of distinct tokens to verify (default: 500)',
+        )
+        parser.add_argument(
+            '--bits',
+            type=int,
+            default=2048,
+            help='Size of the generated signing keys (default: 2048)',
+        )
+
+    def time(self, label, verify, tokens):
+        started = time.perf_counter()
+        for token in tokens:
+            verify(token)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label}: {len(tokens)} tokens in {elapsed:.3f}s "
+            f"({elapsed / len(tokens) * 1000:.2f} ms per token)"
+        )
+
+    def handle(self, *args, **options):
+        if options['tokens'] < 1:
+            raise CommandError("--tokens must be at least 1")
+
+        self.stdout.write("Generating signing keys...")
+        with KeyServer(bits=options['bits']) as server:
+            tokens = [
+                server.sign(AUDIENCE, sub=str(i)) for i in range(options['tokens'])
+            ]
+
+            def verify_uncached(token):
+                # What google_auth did before: a new transport and a
+                # certificate download per token
+                id_token.verify_token(
+                    token, requests.Request(), AUDIENCE, certs_url=server.url
+                )
+
+            self.time("Uncached", verify_uncached, tokens)
+            fetched = server.requests
+
+            verifier = TokenVerifier(AUDIENCE, server.url)
+            self.time("Cached keys", verifier.verify, tokens)
+            self.time("Repeated tokens", verifier.verify, tokens)
+
+            self.stdout.write(
+                f"Certificate requests: {fetched} uncached, "
+                f"{server.requests - fetched} cached"
+            )
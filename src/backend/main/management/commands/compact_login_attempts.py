@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from main import login_audit
+
+
+class Command(BaseCommand):
+    help = 'Fold login attempts past the retention period into daily per-IP summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='Days of raw attempts to keep (default: the '
+                 'login_attempt_retention_days setting, or 30)',
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is not None and days < 1:
+            raise CommandError("--days must be at least 1")
+        folded = login_audit.compact(days)
+        self.stdout.write(self.style.SUCCESS(f"Folded {folded} login attempts into summaries"))
@@ -1,9 +1,12 @@
-from django.core.management.base import BaseCommand
-from django.utils import timezone
-from django.db.models import Q
-from main.models import Issue, User, IssueEscalation
+import time
 from datetime import timedelta
 
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from main.escalation import escalate_overdue, get_overdue_issues
+from main.scheduler import EscalationScheduler, acquire_lock
+from main.state_machine import get_next_level
+
 
 class Command(BaseCommand):
     help = 'Escalate issues that have exceeded their response deadline'
@@ -14,113 +17,74 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be escalated without actually escalating',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of issues written per transaction (default: 500)',
+        )
+        parser.add_argument(
+            '--scheduler',
+            action='store_true',
+            help='Keep running and escalate each issue as soon as its deadline passes',
+        )
+        parser.add_argument(
+            '--resync-interval',
+            type=int,
+            default=300,
+            help='Seconds between checks for deadlines changed by other processes (default: 300)',
+        )
 
     def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        if options['resync_interval'] < 1:
+            raise CommandError("--resync-interval must be at least 1")
+
         dry_run = options['dry_run']
         now = timezone.now()
         
         # Find issues that need escalation
-        issues_to_escalate = Issue.objects.filter(
-            Q(status='pending') | Q(status='in_progress'),
-            next_escalation_date__lte=now,
-            current_level__in=['grama_niladhari', 'divisional_secretary', 'district_secretary', 'provincial_ministry']
-        )
+        issues_to_escalate = get_overdue_issues(now)
         
         if dry_run:
             self.stdout.write(f"Would escalate {issues_to_escalate.count()} issues:")
             for issue in issues_to_escalate:
-                self.stdout.write(f"  - {issue.reference_number}: {issue.current_level} -> {self.get_next_level(issue.current_level)}")
+                self.stdout.write(f"  - {issue.reference_number}: {issue.current_level} -> {get_next_level(issue.current_level)}")
             return
-        
-        escalated_count = 0
-        
-        for issue in issues_to_escalate:
-            if self.escalate_issue(issue):
-                escalated_count += 1
-        
-        self.stdout.write(
-            self.style.SUCCESS(f'Successfully escalated {escalated_count} issues')
-        )
 
-    def get_next_level(self, current_level):
-        """Get the next escalation level"""
-        hierarchy = {
-            'grama_niladhari': 'divisional_secretary',
-            'divisional_secretary': 'district_secretary',
-            'district_secretary': 'provincial_ministry',
-            'provincial_ministry': 'national_ministry',
-            'national_ministry': 'prime_minister'
-        }
-        return hierarchy.get(current_level, current_level)
+        log = self.stdout.write if options['verbosity'] >= 2 else None
+
+        if options['scheduler']:
+            if not acquire_lock():
+                raise CommandError("Another process is running the escalation scheduler")
+            self.stdout.write("Escalation scheduler started")
+            scheduler = EscalationScheduler(
+                batch_size=options['batch_size'],
+                resync_interval=timedelta(seconds=options['resync_interval']),
+                log=log,
+            )
+            try:
+                scheduler.run()
+            except KeyboardInterrupt:
+                scheduler.stop()
+            return
+
+        started = time.monotonic()
+        result = escalate_overdue(now, batch_size=options['batch_size'], log=log)
+        elapsed = time.monotonic() - started
 
-    def escalate_issue(self, issue):
-        """Escalate an issue to the next level"""
-        try:
-            current_handler = issue.current_handler
-            current_level = issue.current_level
-            next_level = self.get_next_level(current_level)
-            
-            if next_level == current_level:
-                # Already at the highest level
-                self.stdout.write(f"Issue {issue.reference_number} is already at the highest level")
-                return False
-            
-            # Find appropriate user at next level
-            next_users = User.objects.filter(
-                user_type=next_level,
-                is_approved=True
+        if result['conflicts']:
+            self.stdout.write(
+                f"{result['conflicts']} issues were changed by another writer and were skipped"
             )
-            
-            # Filter by jurisdiction for lower levels
-            if next_level in ['divisional_secretary', 'district_secretary', 'provincial_ministry']:
-                if next_level == 'divisional_secretary':
-                    next_users = next_users.filter(
-                        province=issue.province,
-                        district=issue.district,
-                        ds_division=issue.ds_division
-                    )
-                elif next_level == 'district_secretary':
-                    next_users = next_users.filter(
-                        province=issue.province,
-                        district=issue.district
-                    )
-                elif next_level == 'provincial_ministry':
-                    next_users = next_users.filter(province=issue.province)
-            
-            next_user = next_users.first()
-            
-            if not next_user:
-                self.stdout.write(f"No user found at level {next_level} for issue {issue.reference_number}")
-                # Set escalation date to retry later
-                issue.next_escalation_date = timezone.now() + timedelta(hours=6)
-                issue.save()
-                return False
-            
-            # Create escalation record
-            IssueEscalation.objects.create(
-                issue=issue,
-                from_user=current_handler,
-                to_user=next_user,
-                from_level=current_level,
-                to_level=next_level,
-                reason=f"Auto-escalated due to no response within deadline"
+        if result['deferred']:
+            self.stdout.write(
+                f"{result['deferred']} issues had no handler at the next level and will be retried"
             )
-            
-            # Update issue
-            issue.current_handler = next_user
-            issue.current_level = next_level
-            issue.escalation_count += 1
-            issue.status = 'escalated' if next_level != 'prime_minister' else 'pending'
-            
-            # Set next escalation date (3 days for most levels, 7 days for national/PM)
-            escalation_days = 7 if next_level in ['national_ministry', 'prime_minister'] else 3
-            issue.next_escalation_date = timezone.now() + timedelta(days=escalation_days)
-            
-            issue.save()
-            
-            self.stdout.write(f"Escalated {issue.reference_number} from {current_level} to {next_level}")
-            return True
-            
-        except Exception as e:
-            self.stdout.write(f"Error escalating issue {issue.reference_number}: {str(e)}")
-            return False
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Successfully escalated {result['escalated']} issues "
+                f"in {result['batches']} batches ({elapsed:.2f}s)"
+            )
+        )
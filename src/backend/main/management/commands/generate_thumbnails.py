@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from main import thumbnails
+from main.models import AttachmentBlob, IssueAttachment, ResponseAttachment
+
+
+class Command(BaseCommand):
+    help = 'Render missing thumbnails of image and video attachments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Render the thumbnails of every blob again',
+        )
+        parser.add_argument(
+            '--legacy',
+            action='store_true',
+            help='First move attachments uploaded before blobs into blobs',
+        )
+
+    def handle(self, *args, **options):
+        adopted = set()
+        if options['legacy']:
+            moved = missing = 0
+            for model in (IssueAttachment, ResponseAttachment):
+                for attachment in model.objects.filter(blob=None).iterator():
+                    blob = thumbnails.adopt(attachment)
+                    if blob is None:
+                        missing += 1
+                        continue
+                    moved += 1
+                    if blob.ref_count == 1:
+                        adopted.add(blob.pk)
+            self.stdout.write(f"Moved {moved} legacy attachments into blobs")
+            if missing:
+                self.stdout.write(self.style.WARNING(f"{missing} legacy files are missing"))
+
+        blobs = AttachmentBlob.objects.filter(
+            Q(mime_type__startswith='image/') | Q(mime_type__startswith='video/')
+        )
+        if not options['all']:
+            # Blobs created above are already being rendered, see signals.py
+            blobs = blobs.filter(thumbnails={}).exclude(pk__in=adopted)
+
+        rendered = failed = 0
+        for blob in blobs.iterator():
+            if thumbnails.generate(blob):
+                rendered += 1
+            else:
+                failed += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Rendered thumbnails of {rendered} files"))
+        if failed:
+            self.stdout.write(self.style.WARNING(f"Could not render {failed} files"))
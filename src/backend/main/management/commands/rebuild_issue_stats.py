@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from main import stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the dashboard issue counters from the issue table'
+
+    def handle(self, *args, **options):
+        created = stats.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} issue counters"))
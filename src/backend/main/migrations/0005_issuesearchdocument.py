@@ -0,0 +1,112 @@
+# Generated by Django 5.2.5 on 2025-09-08 10:12
+
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+FTS_TABLE = 'main_issuesearchdocument_fts'
+PG_DOCUMENT_VECTOR = (
+    "(setweight(to_tsvector('simple', reference || ' ' || title), 'A') || "
+    "setweight(to_tsvector('simple', body), 'B'))"
+)
+
+
+def fts5_tokenchars():
+    # unicode61 splits words on Sinhala and Tamil vowel signs and on the zero
+    # width (non-)joiner, so declare them as token characters.
+    marks = [
+        chr(code)
+        for code in list(range(0x0B80, 0x0C00)) + list(range(0x0D80, 0x0E00))
+        if unicodedata.category(chr(code)) in ('Mn', 'Mc')
+    ]
+    return ''.join(marks) + '\u200c\u200d'
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                return
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "reference, title, body, "
+            "content='main_issuesearchdocument', content_rowid='issue_id', "
+            f"tokenize=\"unicode61 remove_diacritics 2 tokenchars '{fts5_tokenchars()}'\")"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER main_issuesearchdocument_ai AFTER INSERT ON main_issuesearchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}(rowid, reference, title, body) "
+            "VALUES (new.issue_id, new.reference, new.title, new.body); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER main_issuesearchdocument_ad AFTER DELETE ON main_issuesearchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, reference, title, body) "
+            "VALUES ('delete', old.issue_id, old.reference, old.title, old.body); END"
+        )
+        schema_editor.execute(
+            "CREATE TRIGGER main_issuesearchdocument_au AFTER UPDATE ON main_issuesearchdocument BEGIN "
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, reference, title, body) "
+            "VALUES ('delete', old.issue_id, old.reference, old.title, old.body); "
+            f"INSERT INTO {FTS_TABLE}(rowid, reference, title, body) "
+            "VALUES (new.issue_id, new.reference, new.title, new.body); END"
+        )
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute(
+            "CREATE INDEX main_issuesearchdocument_fts ON main_issuesearchdocument "
+            f"USING GIN ({PG_DOCUMENT_VECTOR})"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        for trigger in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS main_issuesearchdocument_{trigger}")
+        schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+    elif connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS main_issuesearchdocument_fts")
+
+
+def index_existing_issues(apps, schema_editor):
+    Issue = apps.get_model('main', 'Issue')
+    IssueSearchDocument = apps.get_model('main', 'IssueSearchDocument')
+    for issue in Issue.objects.iterator():
+        parts = [issue.description]
+        parts.extend(issue.responses.values_list('message', flat=True))
+        parts.extend(
+            issue.public_comments.filter(is_approved=True).values_list('comment', flat=True)
+        )
+        IssueSearchDocument.objects.create(
+            issue=issue,
+            language=issue.language,
+            reference=issue.reference_number,
+            title=issue.title,
+            body='\n'.join(parts),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_loginattempt_alter_user_user_type_googleauthuser_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IssueSearchDocument',
+            fields=[
+                ('issue', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='main.issue')),
+                ('language', models.CharField(choices=[('en', 'English'), ('si', 'Sinhala'), ('ta', 'Tamil')], default='en', max_length=2)),
+                ('reference', models.CharField(max_length=20)),
+                ('title', models.CharField(max_length=300)),
+                ('body', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(index_existing_issues, migrations.RunPython.noop),
+    ]
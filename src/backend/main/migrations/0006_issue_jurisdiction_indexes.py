@@ -0,0 +1,45 @@
+# Generated by Django 5.2.5 on 2025-09-08 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_issuesearchdocument'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['province', 'district', 'ds_division', 'grama_niladhari_division', 'current_level', '-created_at'], name='issue_gn_level_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['province', 'district', 'ds_division', 'current_level', '-created_at'], name='issue_ds_level_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['province', 'district', 'current_level', '-created_at'], name='issue_dist_level_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['province', 'current_level', '-created_at'], name='issue_prov_level_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['current_level', '-created_at'], name='issue_level_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['-created_at'], name='issue_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['reporter_user', '-created_at'], name='issue_reporter_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(condition=models.Q(('next_escalation_date__isnull', False)), fields=['status', 'next_escalation_date'], name='issue_escalation_due_idx'),
+        ),
+    ]
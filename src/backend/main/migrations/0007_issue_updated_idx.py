@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2025-09-08 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_issue_jurisdiction_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='issue',
+            index=models.Index(fields=['updated_at'], name='issue_updated_idx'),
+        ),
+    ]
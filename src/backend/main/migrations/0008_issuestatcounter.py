@@ -0,0 +1,59 @@
+# Generated by Django 5.2.5 on 2025-09-09 09:30
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+SCOPES = (
+    ('province', 'province_id'),
+    ('district', 'district_id'),
+    ('ds_division', 'ds_division_id'),
+    ('gn_division', 'grama_niladhari_division_id'),
+    ('handler', 'current_handler_id'),
+    ('reporter', 'reporter_user_id'),
+)
+
+
+def count_existing_issues(apps, schema_editor):
+    Issue = apps.get_model('main', 'Issue')
+    IssueStatCounter = apps.get_model('main', 'IssueStatCounter')
+    counters = [
+        IssueStatCounter(scope='all', scope_id=0, status=row['status'], count=row['n'])
+        for row in Issue.objects.order_by().values('status').annotate(n=Count('id'))
+    ]
+    for scope, attname in SCOPES:
+        rows = (
+            Issue.objects.filter(**{f'{attname}__isnull': False})
+            .order_by()
+            .values(attname, 'status')
+            .annotate(n=Count('id'))
+        )
+        counters.extend(
+            IssueStatCounter(scope=scope, scope_id=row[attname], status=row['status'], count=row['n'])
+            for row in rows
+        )
+    IssueStatCounter.objects.bulk_create(counters, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_issue_updated_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IssueStatCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=20)),
+                ('scope_id', models.BigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('in_progress', 'In Progress'), ('resolved', 'Resolved'), ('escalated', 'Escalated'), ('closed', 'Closed')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('scope', 'scope_id', 'status'), name='issue_stat_counter_key')],
+            },
+        ),
+        migrations.RunPython(count_existing_issues, migrations.RunPython.noop),
+    ]
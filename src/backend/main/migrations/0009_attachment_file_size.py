@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2025-09-09 15:20
+
+from django.db import migrations, models
+
+
+def record_file_sizes(apps, schema_editor):
+    for model_name in ('IssueAttachment', 'ResponseAttachment'):
+        model = apps.get_model('main', model_name)
+        for attachment in model.objects.filter(file_size__isnull=True).iterator():
+            try:
+                attachment.file_size = attachment.file.size
+            except (OSError, ValueError):
+                # File missing from storage
+                continue
+            attachment.save(update_fields=['file_size'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_issuestatcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issueattachment',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='responseattachment',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(record_file_sizes, migrations.RunPython.noop),
+    ]
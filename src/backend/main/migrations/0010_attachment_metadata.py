@@ -0,0 +1,106 @@
+# Generated by Django 5.2.5 on 2025-09-10 10:05
+
+from django.db import migrations, models
+
+import hashlib
+
+from main.attachments import get_image_size, get_video_size, sniff_mime_type
+
+
+def describe_upload(file):
+    """
+    describe_upload() as of this migration, kept here so later changes to
+    main.attachments do not change what it does
+    """
+    checksum = hashlib.sha256()
+    head = b''
+    for chunk in file.chunks():
+        if len(head) < 32:
+            head += chunk[:32 - len(head)]
+        checksum.update(chunk)
+
+    metadata = {
+        'file_size': file.size,
+        'mime_type': sniff_mime_type(head, file.name),
+        'width': None,
+        'height': None,
+        'checksum': checksum.hexdigest(),
+    }
+
+    dimensions = None
+    if metadata['mime_type'].startswith('image/'):
+        file.seek(0)
+        dimensions = get_image_size(file)
+    elif metadata['mime_type'] in ('video/mp4', 'video/quicktime'):
+        dimensions = get_video_size(file, file.size)
+    if dimensions:
+        metadata['width'], metadata['height'] = dimensions
+
+    file.seek(0)
+    return metadata
+
+
+def describe_existing_files(apps, schema_editor):
+    for model_name in ('IssueAttachment', 'ResponseAttachment'):
+        model = apps.get_model('main', model_name)
+        for attachment in model.objects.filter(checksum='').iterator():
+            try:
+                with attachment.file.open('rb'):
+                    metadata = describe_upload(attachment.file)
+            except (OSError, ValueError):
+                # File missing from storage
+                continue
+            for field, value in metadata.items():
+                setattr(attachment, field, value)
+            attachment.save(update_fields=list(metadata))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_attachment_file_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issueattachment',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='SHA-256', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='issueattachment',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='issueattachment',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='issueattachment',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='responseattachment',
+            name='checksum',
+            field=models.CharField(blank=True, help_text='SHA-256', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='responseattachment',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='responseattachment',
+            name='mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='responseattachment',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(describe_existing_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2025-09-10 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_attachmentblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attachmentblob',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2025-09-12 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_notification_unread_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issue',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.5 on 2025-09-13 10:15
+
+import main.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_issue_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='issue',
+            name='max_pending_extensions',
+            field=models.IntegerField(default=main.models.get_max_pending_extensions),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2025-09-14 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_alter_issue_max_pending_extensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoginAttemptSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('ip_address', models.GenericIPAddressField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('successful', models.IntegerField(default=0)),
+                ('otp_verified', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='loginattempt',
+            index=models.Index(fields=['attempt_time'], name='login_attempt_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='loginattemptsummary',
+            constraint=models.UniqueConstraint(fields=('day', 'ip_address'), name='login_attempt_summary_key'),
+        ),
+    ]
@@ -1,11 +1,17 @@
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 from datetime import timedelta
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, pre_save
+import os
 import pyotp
 import random
 import string
 
+from .attachments import describe_upload
+
 # TODO: Create project models
 
 
@@ -101,6 +107,88 @@ class User(AbstractUser):
         return f"{self.username} ({self.user_type})"
 
 
+class IssueQuerySet(models.QuerySet):
+    def for_list(self):
+        """Load everything IssueListSerializer renders in a fixed number of queries"""
+        response_count = (
+            IssueResponse.objects.filter(issue=models.OuterRef("pk"))
+            .order_by()
+            .values("issue")
+            .annotate(count=models.Count("id"))
+            .values("count")
+        )
+        return (
+            self.select_related(
+                "province",
+                "district",
+                "ds_division",
+                "grama_niladhari_division",
+                "current_handler",
+            )
+            .annotate(
+                response_count=Coalesce(models.Subquery(response_count), 0)
+            )
+            .prefetch_related(
+                models.Prefetch(
+                    "attachments",
+                    queryset=IssueAttachment.objects.select_related("blob"),
+                )
+            )
+        )
+
+    def for_detail(self):
+        """Load an issue and its whole timeline for IssueDetailSerializer"""
+        return self.select_related(
+            "province",
+            "district",
+            "ds_division",
+            "grama_niladhari_division",
+            "current_handler",
+        ).prefetch_related(
+            models.Prefetch(
+                "attachments",
+                queryset=IssueAttachment.objects.select_related("blob"),
+            ),
+            models.Prefetch(
+                "responses",
+                queryset=IssueResponse.objects.select_related(
+                    "responder"
+                ).prefetch_related(
+                    models.Prefetch(
+                        "attachments",
+                        queryset=ResponseAttachment.objects.select_related("blob"),
+                    )
+                ),
+            ),
+            models.Prefetch(
+                "escalations",
+                queryset=IssueEscalation.objects.select_related(
+                    "from_user", "to_user"
+                ),
+            ),
+            "public_comments",
+        )
+
+    def update_if_current(self, issue, **changes):
+        """
+        Write ``changes`` to the row of ``issue`` with one UPDATE, provided
+        it still has the version ``issue`` was loaded with. Returns whether
+        it did; nothing is written when another writer got there first.
+        """
+        return bool(
+            self.filter(pk=issue.pk, version=issue.version).update(
+                version=models.F("version") + 1, **changes
+            )
+        )
+
+
+def get_max_pending_extensions():
+    """Extension limit of a new issue, the max_pending_extensions setting"""
+    from . import system_settings
+
+    return system_settings.get_int("max_pending_extensions", 2, 0)
+
+
 class Issue(models.Model):
     ISSUE_STATUS = (
         ("pending", "Pending"),
@@ -192,7 +280,7 @@ class Issue(models.Model):
     escalation_count = models.IntegerField(default=0)
     next_escalation_date = models.DateTimeField(null=True, blank=True)
     pending_extension_count = models.IntegerField(default=0)
-    max_pending_extensions = models.IntegerField(default=2)
+    max_pending_extensions = models.IntegerField(default=get_max_pending_extensions)
 
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
@@ -202,6 +290,36 @@ class Issue(models.Model):
     # Reference number
     reference_number = models.CharField(max_length=20, unique=True, blank=True)
 
+    # Bumped by every write, so that concurrent state changes can be
+    # applied as conditional UPDATEs instead of under row locks
+    version = models.PositiveIntegerField(default=0)
+
+    objects = IssueQuerySet.as_manager()
+
+    # Fields IssueStatCounter rows are keyed by, see main/stats.py
+    COUNTED_FIELDS = (
+        "status",
+        "province_id",
+        "district_id",
+        "ds_division_id",
+        "grama_niladhari_division_id",
+        "current_handler_id",
+        "reporter_user_id",
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the counted values as loaded, for the escalation engine,
+        # whose conditional UPDATEs only apply to rows unchanged since then.
+        # save() reads them again from the locked row (see stats.py).
+        instance._counted_values = {
+            name: value
+            for name, value in zip(field_names, values)
+            if name in cls.COUNTED_FIELDS
+        }
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.reference_number:
             import uuid
@@ -211,15 +329,213 @@ class Issue(models.Model):
             )
 
         if not self.next_escalation_date and self.status == "pending":
-            self.next_escalation_date = timezone.now() + timedelta(days=3)
+            from .state_machine import get_escalation_window
 
-        super().save(*args, **kwargs)
+            self.next_escalation_date = timezone.now() + timedelta(
+                days=get_escalation_window(self.current_level)
+            )
+
+        if not self._state.adding:
+            self.version += 1
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "version"}
+        # Holds the row locked by pre_save until the counters are moved
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def update_if_current(self, **changes):
+        """
+        Apply a state change with a single UPDATE of the changed fields,
+        unless the issue has been written since this instance was loaded.
+        Sends pre_save and post_save like save(update_fields=...) does.
+        Returns False, leaving the instance unchanged, on a conflict.
+        """
+        changes.setdefault("updated_at", timezone.now())
+        update_fields = frozenset(changes)
+        with transaction.atomic():
+            pre_save.send(
+                sender=Issue,
+                instance=self,
+                raw=False,
+                using=self._state.db,
+                update_fields=update_fields,
+            )
+            if not Issue.objects.update_if_current(self, **changes):
+                return False
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.version += 1
+            post_save.send(
+                sender=Issue,
+                instance=self,
+                created=False,
+                raw=False,
+                using=self._state.db,
+                update_fields=update_fields,
+            )
+        return True
 
     def __str__(self):
         return f"{self.reference_number} - {self.title[:50]}"
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # Official views filter by a prefix of the jurisdiction plus the
+            # issue level, newest first
+            models.Index(
+                fields=[
+                    "province",
+                    "district",
+                    "ds_division",
+                    "grama_niladhari_division",
+                    "current_level",
+                    "-created_at",
+                ],
+                name="issue_gn_level_created_idx",
+            ),
+            models.Index(
+                fields=[
+                    "province",
+                    "district",
+                    "ds_division",
+                    "current_level",
+                    "-created_at",
+                ],
+                name="issue_ds_level_created_idx",
+            ),
+            models.Index(
+                fields=["province", "district", "current_level", "-created_at"],
+                name="issue_dist_level_created_idx",
+            ),
+            models.Index(
+                fields=["province", "current_level", "-created_at"],
+                name="issue_prov_level_created_idx",
+            ),
+            models.Index(
+                fields=["current_level", "-created_at"],
+                name="issue_level_created_idx",
+            ),
+            # Public feed
+            models.Index(fields=["-created_at"], name="issue_created_idx"),
+            # Citizens' own issues
+            models.Index(
+                fields=["reporter_user", "-created_at"],
+                name="issue_reporter_created_idx",
+            ),
+            # Issues waiting for escalation. The condition is on the deadline
+            # rather than the status because SQLite can only prove it for
+            # bound parameters when it is an IS NOT NULL test.
+            models.Index(
+                fields=["status", "next_escalation_date"],
+                condition=models.Q(next_escalation_date__isnull=False),
+                name="issue_escalation_due_idx",
+            ),
+            # Incremental resync of the escalation scheduler
+            models.Index(fields=["updated_at"], name="issue_updated_idx"),
+        ]
+
+
+def blob_name(checksum, name):
+    """Content-addressed name of an attachment blob, below its upload_to"""
+    extension = os.path.splitext(name)[1].lower()
+    return f"{checksum[:2]}/{checksum}{extension}"
+
+
+class AttachmentBlobManager(models.Manager):
+    def store(self, upload):
+        """
+        Return the blob holding the content of ``upload``, taking a
+        reference to it. The file is only written to storage the first time
+        its content is seen.
+        """
+        metadata = describe_upload(upload)
+        with transaction.atomic():
+            blob = (
+                self.select_for_update().filter(checksum=metadata["checksum"]).first()
+            )
+            if blob is None:
+                blob = self.model(ref_count=1, **metadata)
+                name = blob_name(blob.checksum, upload.name)
+                path = blob.file.field.generate_filename(blob, name)
+                saved = not blob.file.storage.exists(path)
+                if saved:
+                    blob.file.save(name, upload, save=False)
+                else:
+                    # Left behind by a rolled back upload of the same content
+                    blob.file = path
+                try:
+                    with transaction.atomic():
+                        blob.save()
+                    return blob
+                except IntegrityError:
+                    # Stored concurrently by another request
+                    ours = blob.file.name
+                    blob = self.select_for_update().get(checksum=blob.checksum)
+                    if saved and ours != blob.file.name:
+                        # Our copy was written under another name, and
+                        # nothing refers to it
+                        blob.file.storage.delete(ours)
+            self.filter(pk=blob.pk).update(ref_count=F("ref_count") + 1)
+            blob.ref_count += 1
+        return blob
+
+    def release(self, blob_id):
+        """Drop a reference, deleting the blob and its file with the last one"""
+        with transaction.atomic():
+            blob = self.select_for_update().filter(pk=blob_id).first()
+            if blob is None:
+                return
+            if blob.ref_count > 1:
+                self.filter(pk=blob_id).update(ref_count=F("ref_count") - 1)
+                return
+            name, storage = blob.file.name, blob.file.storage
+            thumbnails = list(blob.thumbnails.values())
+            blob.delete()
+
+        def delete_file():
+            # Unless the same content was uploaded again in the meantime
+            if not self.filter(file=name).exists():
+                for file_name in [name] + thumbnails:
+                    storage.delete(file_name)
+
+        transaction.on_commit(delete_file)
+
+
+class AttachmentBlob(models.Model):
+    """
+    An uploaded file, stored once per distinct content however many
+    attachments refer to it
+    """
+
+    checksum = models.CharField(max_length=64, unique=True, help_text="SHA-256")
+    file = models.FileField(upload_to="blobs/")
+    file_size = models.PositiveBigIntegerField()
+    mime_type = models.CharField(max_length=100, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    # Variant name -> storage name, filled in by thumbnails.py
+    thumbnails = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = AttachmentBlobManager()
+
+    def __str__(self):
+        return f"{self.checksum} ({self.ref_count} references)"
+
+
+def store_upload(attachment):
+    """
+    Store a newly uploaded attachment file as a blob and copy its metadata
+    onto the attachment row
+    """
+    if attachment.file and not attachment.file._committed:
+        blob = AttachmentBlob.objects.store(attachment.file.file)
+        attachment.blob = blob
+        attachment.file = blob.file.name
+        for field in ("file_size", "mime_type", "width", "height", "checksum"):
+            setattr(attachment, field, getattr(blob, field))
 
 
 class IssueAttachment(models.Model):
@@ -233,10 +549,29 @@ class IssueAttachment(models.Model):
         Issue, on_delete=models.CASCADE, related_name="attachments"
     )
     file = models.FileField(upload_to="issue_attachments/")
+    # Shared storage of the file, null for files uploaded before blobs
+    blob = models.ForeignKey(
+        "AttachmentBlob",
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    # Recorded on upload so rendering an attachment never touches the storage
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, help_text="SHA-256")
     attachment_type = models.CharField(max_length=10, choices=ATTACHMENT_TYPES)
     description = models.CharField(max_length=200, blank=True, null=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            store_upload(self)
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.issue.reference_number} - {self.attachment_type}"
 
@@ -276,9 +611,26 @@ class ResponseAttachment(models.Model):
         IssueResponse, on_delete=models.CASCADE, related_name="attachments"
     )
     file = models.FileField(upload_to="response_attachments/")
+    blob = models.ForeignKey(
+        "AttachmentBlob",
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    checksum = models.CharField(max_length=64, blank=True, help_text="SHA-256")
     description = models.CharField(max_length=200, blank=True, null=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            store_upload(self)
+            super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Response {self.response.id} - Attachment"
 
@@ -338,6 +690,51 @@ class PublicComment(models.Model):
         ordering = ["-created_at"]
 
 
+class IssueSearchDocument(models.Model):
+    """Searchable text of an issue and its public timeline, see main/search.py"""
+
+    issue = models.OneToOneField(
+        Issue,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="search_document",
+    )
+    language = models.CharField(
+        max_length=2, choices=Issue.LANGUAGE_CHOICES, default="en"
+    )
+    reference = models.CharField(max_length=20)
+    title = models.CharField(max_length=300)
+    # Description, response messages and approved public comments
+    body = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Search document for {self.reference}"
+
+
+class IssueStatCounter(models.Model):
+    """
+    Number of issues with a status in one scope (a division, a handler, a
+    reporter or "all"), kept up to date by main/stats.py
+    """
+
+    scope = models.CharField(max_length=20)
+    # Id of the division or user, 0 for the "all" scope
+    scope_id = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=Issue.ISSUE_STATUS)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["scope", "scope_id", "status"], name="issue_stat_counter_key"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.scope_id} {self.status}: {self.count}"
+
+
 class Notification(models.Model):
     NOTIFICATION_TYPES = (
         ("new_issue", "New Issue"),
@@ -362,6 +759,16 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # Unread counts and bulk mark-read. Partial rather than on
+            # is_read because Django filters booleans as NOT "is_read" on
+            # SQLite, which a plain index column cannot serve.
+            models.Index(
+                fields=["user", "-created_at"],
+                condition=models.Q(is_read=False),
+                name="notification_unread_idx",
+            ),
+        ]
 
 
 class SystemSettings(models.Model):
@@ -391,6 +798,14 @@ class OTPVerification(models.Model):
         ('sms', 'SMS'),
         ('google_auth', 'Google Authenticator'),
     )
+
+    # Minutes a code stays valid unless the otp_expiry_minutes.<type>
+    # setting says otherwise
+    EXPIRY_MINUTES = {
+        'email': 10,
+        'sms': 10,
+        'google_auth': 5,
+    }
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='otp_verifications')
     otp_type = models.CharField(max_length=20, choices=OTP_TYPES)
@@ -413,12 +828,19 @@ class OTPVerification(models.Model):
                 self.otp_code = ''.join(random.choices(string.digits, k=6))
         
         if not self.expires_at:
-            if self.otp_type == 'google_auth':
-                self.expires_at = timezone.now() + timedelta(minutes=5)  # TOTP expires in 5 minutes
-            else:
-                self.expires_at = timezone.now() + timedelta(minutes=10)  # Email/SMS OTP expires in 10 minutes
+            self.expires_at = timezone.now() + timedelta(
+                minutes=self.get_expiry_minutes(self.otp_type)
+            )
         
         super().save(*args, **kwargs)
+
+    @classmethod
+    def get_expiry_minutes(cls, otp_type):
+        from . import system_settings
+
+        return system_settings.get_int(
+            f'otp_expiry_minutes.{otp_type}', cls.EXPIRY_MINUTES[otp_type], 1
+        )
     
     def is_expired(self):
         return timezone.now() > self.expires_at
@@ -470,3 +892,31 @@ class LoginAttempt(models.Model):
     
     class Meta:
         ordering = ['-attempt_time']
+        indexes = [
+            # Retention compaction (see main/login_audit.py)
+            models.Index(fields=['attempt_time'], name='login_attempt_time_idx'),
+        ]
+
+
+class LoginAttemptSummary(models.Model):
+    """
+    Login attempts from one IP address on one day, folded together once
+    they are past the retention period by main/login_audit.py
+    """
+
+    day = models.DateField()
+    ip_address = models.GenericIPAddressField()
+    attempts = models.IntegerField(default=0)
+    successful = models.IntegerField(default=0)
+    otp_verified = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['-day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'ip_address'], name='login_attempt_summary_key'
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.ip_address} on {self.day}: {self.attempts} attempts"
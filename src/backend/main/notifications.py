@@ -0,0 +1,196 @@
+"""
+Asynchronous notification fan-out.
+
+Code paths that change an issue call notify() (or notify_many() for bulk
+escalations) with the event type. After the transaction commits, the
+event is queued on a background worker, which resolves the recipients of
+a whole batch of events with one issue query and writes their
+Notification rows with one bulk_create.
+
+An event that is already waiting in the queue is not queued again, so a
+request pays for at most one enqueue per issue and event type however
+often it fires, and the recipients get one notification. With
+NOTIFICATION_WORKERS = 0 events are delivered inline after commit.
+
+Unread counts are cached per user and dropped whenever notifications are
+delivered to or marked read by that user.
+"""
+
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Issue, Notification, User
+from .workers import BackgroundWorker
+
+
+Event = namedtuple("Event", ["notification_type", "issue_id", "actor_id"])
+
+# Issue fields holding the recipients of each event type
+RECIPIENTS = {
+    "new_issue": ("current_handler_id",),
+    "issue_response": ("reporter_user_id",),
+    "issue_escalated": ("reporter_user_id", "current_handler_id"),
+    "issue_resolved": ("reporter_user_id",),
+    "reminder": ("current_handler_id",),
+}
+
+MESSAGES = {
+    "new_issue": (
+        "New issue {reference_number}",
+        'The issue "{title}" has been assigned to you.',
+    ),
+    "issue_response": (
+        "Update on {reference_number}",
+        'An official has responded to your issue "{title}".',
+    ),
+    "issue_escalated": (
+        "{reference_number} escalated",
+        'The issue "{title}" has been escalated to the {level} level.',
+    ),
+    "issue_resolved": (
+        "{reference_number} resolved",
+        'Your issue "{title}" has been marked as resolved.',
+    ),
+    "reminder": (
+        "{reference_number} is overdue",
+        'The issue "{title}" has passed its response deadline and is still '
+        "assigned to you.",
+    ),
+}
+
+LEVEL_NAMES = dict(User.USER_TYPES)
+
+UNREAD_COUNT_CACHE_KEY = "notifications:unread:{}"
+UNREAD_COUNT_CACHE_TIMEOUT = 300  # seconds
+
+ISSUE_FIELDS = ["id", "reference_number", "title", "current_level"] + sorted(
+    {field[:-3] for fields in RECIPIENTS.values() for field in fields}
+)
+
+
+def build_notifications(events):
+    """Notification rows for a batch of events, one per event and recipient"""
+    issues = Issue.objects.only(*ISSUE_FIELDS).in_bulk(
+        {event.issue_id for event in events}
+    )
+    notifications = []
+    seen = set()
+    for event in events:
+        issue = issues.get(event.issue_id)
+        if issue is None:
+            continue
+        title, message = MESSAGES[event.notification_type]
+        context = {
+            "reference_number": issue.reference_number,
+            "title": issue.title,
+            "level": LEVEL_NAMES.get(issue.current_level, issue.current_level),
+        }
+        for field in RECIPIENTS[event.notification_type]:
+            user_id = getattr(issue, field)
+            key = (event.notification_type, issue.id, user_id)
+            if user_id is None or user_id == event.actor_id or key in seen:
+                continue
+            seen.add(key)
+            notifications.append(
+                Notification(
+                    user_id=user_id,
+                    notification_type=event.notification_type,
+                    title=title.format(**context),
+                    message=message.format(**context),
+                    issue_id=issue.id,
+                )
+            )
+    return notifications
+
+
+def deliver(events):
+    notifications = Notification.objects.bulk_create(build_notifications(events))
+    invalidate_unread_counts({notification.user_id for notification in notifications})
+    return notifications
+
+
+class NotificationDispatcher:
+    def __init__(self, batch_size=200):
+        self.lock = threading.Lock()
+        # Events queued but not yet picked up by the worker
+        self.pending = set()
+        self.worker = BackgroundWorker(
+            "notifications",
+            self.handle_batch,
+            batch_size=batch_size,
+            threads=max(settings.NOTIFICATION_WORKERS, 1),
+        )
+
+    def enqueue(self, event):
+        """Queue an event unless it is already waiting, returning whether it was"""
+        with self.lock:
+            if event in self.pending:
+                return False
+            self.pending.add(event)
+        self.worker.put(event)
+        return True
+
+    def handle_batch(self, events):
+        with self.lock:
+            self.pending.difference_update(events)
+        deliver(events)
+
+    def flush(self):
+        self.worker.flush()
+
+
+dispatcher = NotificationDispatcher()
+
+
+def dispatch(events):
+    if not settings.NOTIFICATION_WORKERS:
+        deliver(events)
+        return
+    for event in events:
+        dispatcher.enqueue(event)
+
+
+def notify_many(notification_type, issue_ids, actor=None):
+    """Notify the recipients of an event on each of ``issue_ids`` after commit"""
+    actor_id = actor.pk if actor else None
+    events = [Event(notification_type, issue_id, actor_id) for issue_id in issue_ids]
+    if events:
+        transaction.on_commit(lambda: dispatch(events))
+
+
+def notify(notification_type, issue, actor=None):
+    notify_many(notification_type, [issue.pk], actor)
+
+
+def get_unread_count(user):
+    return cache.get_or_set(
+        UNREAD_COUNT_CACHE_KEY.format(user.pk),
+        lambda: Notification.objects.filter(user=user, is_read=False).count(),
+        UNREAD_COUNT_CACHE_TIMEOUT,
+    )
+
+
+def invalidate_unread_counts(user_ids):
+    cache.delete_many([UNREAD_COUNT_CACHE_KEY.format(user_id) for user_id in user_ids])
+
+
+def mark_read(user, ids=None, issue_id=None, before=None):
+    """
+    Mark the user's unread notifications matching every given filter as
+    read with one UPDATE. Returns the number of notifications changed.
+    """
+    notifications = Notification.objects.filter(user=user, is_read=False)
+    if ids is not None:
+        notifications = notifications.filter(id__in=ids)
+    if issue_id is not None:
+        notifications = notifications.filter(issue_id=issue_id)
+    if before is not None:
+        notifications = notifications.filter(created_at__lte=before)
+    updated = notifications.update(is_read=True)
+    if updated:
+        invalidate_unread_counts([user.pk])
+    return updated
@@ -0,0 +1,222 @@
+"""
+Background delivery of OTP codes by email and SMS.
+
+setup_otp and resend_otp used to send the code over SMTP, or through a
+Twilio client created for the call, before answering, so a slow mail
+relay or SMS API held a worker for seconds per login. They now call
+send_otp(), which queues the message once the OTP is committed and
+returns straight away.
+
+OTP_DELIVERY_WORKERS threads send the queued messages. Each thread keeps
+its SMTP connection open between messages, reopening it after
+IDLE_TIMEOUT or a failure, and reuses one SMS backend. A failed send is
+retried after each of RETRY_DELAYS and then given up on; the user can
+ask for the code again. With OTP_DELIVERY_WORKERS = 0 messages are sent
+once, inline, after commit.
+
+Email goes through Django's EMAIL_BACKEND and SMS through SMS_BACKEND:
+TwilioSMSBackend in production, or ConsoleSMSBackend and FileSMSBackend,
+which write the messages to standard output or a file, for development
+and tests.
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils.module_loading import import_string
+from twilio.rest import Client
+
+from .models import OTPVerification
+from .workers import BackgroundWorker
+
+
+logger = logging.getLogger(__name__)
+
+EMAIL = "email"
+SMS = "sms"
+
+# Seconds to wait before each retry of a failed send
+RETRY_DELAYS = [2, 10, 30]
+# Seconds an SMTP connection may sit unused before it is reopened, as
+# servers drop idle clients
+IDLE_TIMEOUT = 60
+
+Message = namedtuple("Message", ["channel", "recipient", "subject", "body", "attempt"])
+
+
+class TwilioSMSBackend:
+    def __init__(self):
+        self.client = Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+
+    def send(self, recipient, body):
+        self.client.messages.create(
+            body=body, from_=settings.TWILIO_PHONE_NUMBER, to=recipient
+        )
+
+
+class ConsoleSMSBackend:
+    """Writes each message to standard output instead of sending it"""
+
+    lock = threading.Lock()
+
+    def write(self, stream, recipient, body):
+        with self.lock:
+            stream.write(f"SMS to {recipient}\n{body}\n{'-' * 79}\n")
+            stream.flush()
+
+    def send(self, recipient, body):
+        self.write(sys.stdout, recipient, body)
+
+
+class FileSMSBackend(ConsoleSMSBackend):
+    """Appends each message to the file at SMS_FILE_PATH"""
+
+    def __init__(self):
+        self.path = settings.SMS_FILE_PATH
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+    def send(self, recipient, body):
+        with open(self.path, "a", encoding="utf-8") as stream:
+            self.write(stream, recipient, body)
+
+
+class OTPDeliveryQueue:
+    def __init__(self, batch_size=50):
+        # The connections of each worker thread
+        self.local = threading.local()
+        self.worker = BackgroundWorker(
+            "otp-delivery",
+            self.handle_batch,
+            batch_size=batch_size,
+            threads=max(settings.OTP_DELIVERY_WORKERS, 1),
+        )
+
+    def get_email_connection(self):
+        connection = getattr(self.local, "email", None)
+        idle = time.monotonic() - getattr(self.local, "email_used", 0)
+        # Also reopened if EMAIL_BACKEND changes, as it does in tests
+        if connection is not None and (
+            idle > IDLE_TIMEOUT or self.local.email_backend != settings.EMAIL_BACKEND
+        ):
+            self.close_email_connection()
+            connection = None
+        if connection is None:
+            connection = self.local.email = get_connection(fail_silently=False)
+            connection.open()
+            self.local.email_backend = settings.EMAIL_BACKEND
+        self.local.email_used = time.monotonic()
+        return connection
+
+    def close_email_connection(self):
+        connection = getattr(self.local, "email", None)
+        self.local.email = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def get_sms_backend(self):
+        # Rebuilt if SMS_BACKEND changes, as it does in tests
+        backend = getattr(self.local, "sms", None)
+        if backend is None or self.local.sms_path != settings.SMS_BACKEND:
+            backend = self.local.sms = import_string(settings.SMS_BACKEND)()
+            self.local.sms_path = settings.SMS_BACKEND
+        return backend
+
+    def send(self, message):
+        if message.channel == EMAIL:
+            EmailMessage(
+                message.subject,
+                message.body,
+                settings.DEFAULT_FROM_EMAIL,
+                [message.recipient],
+                connection=self.get_email_connection(),
+            ).send()
+        else:
+            self.get_sms_backend().send(message.recipient, message.body)
+
+    def deliver(self, message):
+        """Send one message, returning whether it went out"""
+        try:
+            self.send(message)
+        except Exception:
+            logger.exception(
+                "Sending an OTP by %s failed (attempt %d)",
+                message.channel,
+                message.attempt + 1,
+            )
+            # Start the next attempt on fresh connections
+            if message.channel == EMAIL:
+                self.close_email_connection()
+            else:
+                self.local.sms = None
+            return False
+        return True
+
+    def handle_batch(self, messages):
+        for message in messages:
+            if not self.deliver(message):
+                self.retry(message)
+
+    def retry(self, message):
+        if message.attempt >= len(RETRY_DELAYS):
+            logger.error("Giving up on sending an OTP by %s", message.channel)
+            return
+        timer = threading.Timer(
+            RETRY_DELAYS[message.attempt],
+            self.worker.put,
+            [message._replace(attempt=message.attempt + 1)],
+        )
+        timer.daemon = True
+        timer.start()
+
+    def put(self, message):
+        self.worker.put(message)
+
+    def flush(self):
+        self.worker.flush()
+
+
+delivery_queue = OTPDeliveryQueue()
+
+
+def dispatch(message):
+    if not settings.OTP_DELIVERY_WORKERS:
+        try:
+            delivery_queue.deliver(message)
+        finally:
+            # Request threads do not keep connections open
+            delivery_queue.close_email_connection()
+        return
+    delivery_queue.put(message)
+
+
+def build_message(otp, resend=False):
+    minutes = OTPVerification.get_expiry_minutes(otp.otp_type)
+    new = "new " if resend else ""
+    if otp.otp_type == EMAIL:
+        return Message(
+            EMAIL,
+            otp.user.email,
+            f"GovSol - Your {'New ' if resend else ''}OTP Code",
+            f"Your {new}OTP code is: {otp.otp_code}. This code will expire in "
+            f"{minutes} minutes.",
+            0,
+        )
+    return Message(
+        SMS, otp.user.phone, "", f"Your {new}GovSol OTP code is: {otp.otp_code}", 0
+    )
+
+
+def send_otp(otp, resend=False):
+    """Send the code of an email or SMS ``otp`` once it is committed"""
+    message = build_message(otp, resend)
+    transaction.on_commit(lambda: dispatch(message))
@@ -0,0 +1,195 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset pagination on (created_at, id), newest first.
+
+    The cursor holds the position of the last row that was seen, so new rows
+    inserted at the top of the feed never shift the following pages and no
+    COUNT or OFFSET query is issued.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        position, reverse = self.decode_cursor(request)
+
+        if position is None:
+            queryset = queryset.order_by("-created_at", "-id")
+        else:
+            created_at, pk = position
+            if reverse:
+                queryset = queryset.filter(
+                    Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+                ).order_by("created_at", "id")
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+                ).order_by("-created_at", "-id")
+
+        # Fetch one extra row to find out if there is a following page
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[: self.page_size]
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            created_at = datetime.fromisoformat(cursor["t"])
+            pk = int(cursor["i"])
+            reverse = bool(cursor.get("r", False))
+        except (TypeError, ValueError, KeyError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return (created_at, pk), reverse
+
+    def encode_cursor(self, instance, reverse):
+        cursor = {"t": instance.created_at.isoformat(), "i": instance.pk}
+        if reverse:
+            cursor["r"] = True
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class FeedPagination(PageNumberPagination):
+    """
+    Page-number pagination with two opt-in modes for feed-style clients:
+
+    - ``?pagination=cursor`` (or any request carrying a ``cursor``) switches
+      to KeysetPagination, which never counts or offsets. Cursors always list
+      newest first, so asking for another ``ordering`` or for a ``search``,
+      which is ranked by relevance, in this mode is a 400.
+    - ``?count=false`` keeps page numbers but skips the COUNT(*) query; the
+      response then has no ``count`` key.
+    """
+
+    mode_query_param = "pagination"
+    count_query_param = "count"
+    keyset_order_message = (
+        "Cursor pagination lists newest first and cannot be combined with "
+        "ordering or search"
+    )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        self.skip_count = False
+
+        if (
+            request.query_params.get(self.mode_query_param) == "cursor"
+            or KeysetPagination.cursor_query_param in request.query_params
+        ):
+            self.check_keyset_order(request)
+            self.keyset = KeysetPagination()
+            return self.keyset.paginate_queryset(queryset, request, view)
+
+        if request.query_params.get(self.count_query_param, "").lower() in (
+            "false",
+            "0",
+        ):
+            self.skip_count = True
+            return self.paginate_without_count(queryset, request)
+
+        return super().paginate_queryset(queryset, request, view)
+
+    def check_keyset_order(self, request):
+        ordering = request.query_params.get(api_settings.ORDERING_PARAM, "")
+        search = request.query_params.get(api_settings.SEARCH_PARAM, "")
+        if ordering.strip() not in ("", "-created_at") or search.strip():
+            raise ValidationError(self.keyset_order_message)
+
+    def paginate_without_count(self, queryset, request):
+        self.request = request
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            self.page_number = 0
+        if self.page_number < 1:
+            raise NotFound(self.invalid_page_message.format(page_number=""))
+
+        page_size = self.get_page_size(request)
+        offset = (self.page_number - 1) * page_size
+        results = list(queryset[offset : offset + page_size + 1])
+        self.has_next = len(results) > page_size
+        return results[:page_size]
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+
+        if self.skip_count:
+            url = self.request.build_absolute_uri()
+            next_link = None
+            if self.has_next:
+                next_link = replace_query_param(
+                    url, self.page_query_param, self.page_number + 1
+                )
+            previous_link = None
+            if self.page_number > 1:
+                previous_link = replace_query_param(
+                    url, self.page_query_param, self.page_number - 1
+                )
+            return Response(
+                {"next": next_link, "previous": previous_link, "results": data}
+            )
+
+        return super().get_paginated_response(data)
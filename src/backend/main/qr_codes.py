@@ -0,0 +1,88 @@
+"""
+QR codes for Google Authenticator setup.
+
+setup_otp used to draw a PNG of the provisioning URI with qrcode and PIL
+in the request. get_qr_code() instead renders a compact SVG, one path of
+horizontal runs of dark modules, in a pool of QR_CODE_WORKERS processes,
+so a burst of officials setting up their authenticator does not tie up
+the web workers' CPU. With QR_CODE_WORKERS = 0 codes are rendered in the
+request.
+
+Codes are not cached: each one encodes the fresh TOTP secret of a new
+OTPVerification, so it is never asked for twice, and a shared cache is no
+place for the secret anyway.
+
+render_svg() runs in the pool's spawned processes, so this module must
+not need Django to be set up at import.
+"""
+
+import base64
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import qrcode
+from django.conf import settings
+
+# Seconds a request waits for the pool before giving up
+RENDER_TIMEOUT = 10
+# Pixels per module at the image's natural size
+MODULE_SIZE = 8
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.QR_CODE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def render_svg(data, border=4):
+    """An SVG document of the QR code of ``data``"""
+    code = qrcode.QRCode(
+        border=border, error_correction=qrcode.constants.ERROR_CORRECT_M
+    )
+    code.add_data(data)
+    code.make(fit=True)
+    matrix = code.get_matrix()
+
+    # Each run of dark modules in a row is one 1-unit-wide stroke
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if not row[x]:
+                x += 1
+                continue
+            start = x
+            while x < len(row) and row[x]:
+                x += 1
+            runs.append(f"M{start} {y}.5h{x - start}")
+
+    size = len(matrix)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size * MODULE_SIZE}" '
+        f'height="{size * MODULE_SIZE}" viewBox="0 0 {size} {size}" '
+        f'shape-rendering="crispEdges"><rect width="100%" height="100%" '
+        f'fill="#fff"/><path stroke="#000" d="{"".join(runs)}"/></svg>'
+    )
+
+
+def to_data_uri(svg):
+    return "data:image/svg+xml;base64," + base64.b64encode(svg.encode()).decode()
+
+
+def get_qr_code(data):
+    """A data URI of the QR code of ``data``"""
+    if settings.QR_CODE_WORKERS:
+        svg = get_executor().submit(render_svg, data).result(timeout=RENDER_TIMEOUT)
+    else:
+        svg = render_svg(data)
+    return to_data_uri(svg)
@@ -0,0 +1,149 @@
+"""
+In-memory routing table from (level, jurisdiction) to approved officials.
+
+Assigning a new issue or escalating one used to query User for the first
+approved official of a level in the issue's division. The table below is
+built with one query and reused until a User change that affects routing
+invalidates it (see signals.py). invalidate() bumps a version in the
+default cache, so every process sharing that cache rebuilds its table
+before its next pick, and none hands an issue to an official who has been
+deleted or lost approval. With a per-process cache, such as the local
+memory default, other processes pick up changes once their table is
+older than ROUTING_TTL.
+
+When several officials share a jurisdiction, issues are handed out to them
+in turn instead of always to the same one.
+"""
+
+import itertools
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+from .models import User
+
+
+VERSION_CACHE_KEY = "routing:version"
+# Seconds before the table is rebuilt even without a new version
+ROUTING_TTL = 300
+
+ROUTED_LEVELS = [
+    "grama_niladhari",
+    "divisional_secretary",
+    "district_secretary",
+    "provincial_ministry",
+    "national_ministry",
+    "prime_minister",
+]
+
+_lock = threading.Lock()
+_table = None
+
+
+def get_jurisdiction_key(level, obj):
+    """
+    The part of a user's or issue's location that a handler at ``level``
+    must match. Users and issues use the same field names.
+    """
+    if level == "grama_niladhari":
+        return (
+            obj.province_id,
+            obj.district_id,
+            obj.ds_division_id,
+            obj.grama_niladhari_division_id,
+        )
+    if level == "divisional_secretary":
+        return (obj.province_id, obj.district_id, obj.ds_division_id)
+    if level == "district_secretary":
+        return (obj.province_id, obj.district_id)
+    if level == "provincial_ministry":
+        return (obj.province_id,)
+    return ()
+
+
+def get_route(user):
+    """The (level, key) entry ``user`` is listed under, or None"""
+    if not user.is_approved or user.user_type not in ROUTED_LEVELS:
+        return None
+    return (user.user_type, get_jurisdiction_key(user.user_type, user))
+
+
+class RoutingTable:
+    def __init__(self, version):
+        self.version = version
+        self.handlers = {}
+        self.routes = {}
+        self.turns = {}
+        self.built_at = time.monotonic()
+
+        officials = User.objects.filter(
+            user_type__in=ROUTED_LEVELS, is_approved=True
+        ).only(
+            "id",
+            "user_type",
+            "is_approved",
+            "province",
+            "district",
+            "ds_division",
+            "grama_niladhari_division",
+        )
+        for user in officials.order_by("id"):
+            route = get_route(user)
+            self.routes[user.pk] = route
+            self.handlers.setdefault(route, []).append(user.pk)
+        for route in self.handlers:
+            self.turns[route] = itertools.count()
+
+    def is_current(self, version):
+        return (
+            self.version == version and time.monotonic() - self.built_at <= ROUTING_TTL
+        )
+
+    def pick(self, level, key):
+        route = (level, key)
+        handlers = self.handlers.get(route)
+        if not handlers:
+            return None
+        return handlers[next(self.turns[route]) % len(handlers)]
+
+
+def get_table():
+    global _table
+    version = cache.get(VERSION_CACHE_KEY)
+    table = _table
+    if table is None or version is None or not table.is_current(version):
+        with _lock:
+            version = cache.get(VERSION_CACHE_KEY)
+            if version is None:
+                version = uuid.uuid4().hex
+                cache.set(VERSION_CACHE_KEY, version, None)
+            if _table is None or not _table.is_current(version):
+                _table = RoutingTable(version)
+            table = _table
+    return table
+
+
+def invalidate():
+    """Make every process rebuild its table before its next pick"""
+    global _table
+    _table = None
+    cache.delete(VERSION_CACHE_KEY)
+
+
+def is_stale_for(user, deleted=False):
+    """Whether a change to ``user`` makes the current table out of date"""
+    table = _table
+    if table is None:
+        return False
+    route = None if deleted else get_route(user)
+    return table.routes.get(user.pk) != route
+
+
+def pick_handler(level, obj):
+    """
+    Id of an approved official at ``level`` whose jurisdiction covers
+    ``obj`` (an issue), or None if there is none.
+    """
+    return get_table().pick(level, get_jurisdiction_key(level, obj))
@@ -0,0 +1,257 @@
+"""
+Long-running escalation scheduler.
+
+Instead of rescanning the issue table on every cron tick, the scheduler
+keeps a min-heap of upcoming next_escalation_date values and sleeps until
+the earliest one. Every Issue save calls notify_deadline() (see
+signals.py) so a scheduler running in the same process picks up the
+change immediately. Changes made by other processes are picked up by a
+periodic resync that only reads issues updated since the previous sync.
+
+Run it in the foreground with ``manage.py escalate_issues --scheduler``, or
+inside the web process with ESCALATION_SCHEDULER_IN_PROCESS = True. Either
+way it first takes a lock on ESCALATION_SCHEDULER_LOCK_FILE, so only one
+process per host runs a scheduler however many web workers start.
+
+A tick that fails, say because the database is down, is logged and tried
+again after ERROR_BACKOFF, with every deadline read again as the issues
+taken off the heap for that tick may not have been escalated.
+"""
+
+import heapq
+import logging
+import threading
+from datetime import timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import state_machine
+from .escalation import escalate_overdue
+from .models import Issue
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before trying again after a failed tick
+ERROR_BACKOFF = 30
+
+# The scheduler running in this process, if any
+_scheduler = None
+# The open lock file, once this process holds it
+_lock_file = None
+
+
+def is_escalation_due_later(status, current_level, deadline):
+    """Whether an issue in this state will be auto-escalated at ``deadline``"""
+    return deadline is not None and state_machine.escalates_automatically(
+        status, current_level
+    )
+
+
+def notify_deadline(issue_id, status, current_level, deadline):
+    """Tell the in-process scheduler, if there is one, about a changed issue"""
+    if _scheduler is not None:
+        _scheduler.schedule_issue(issue_id, status, current_level, deadline)
+
+
+def forget_issue(issue_id):
+    if _scheduler is not None:
+        _scheduler.schedule(issue_id, None)
+
+
+class EscalationScheduler:
+    def __init__(self, batch_size=500, resync_interval=timedelta(minutes=5), log=None):
+        self.batch_size = batch_size
+        self.resync_interval = resync_interval
+        self.log = log
+        # (deadline, issue_id) entries; an entry is stale once the issue's
+        # deadline in self.deadlines no longer matches it
+        self.heap = []
+        self.deadlines = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.last_sync = None
+
+    def schedule(self, issue_id, deadline):
+        """Set or clear (with ``deadline=None``) the deadline of one issue"""
+        with self.condition:
+            if deadline is None:
+                self.deadlines.pop(issue_id, None)
+                return
+            if self.deadlines.get(issue_id) == deadline:
+                return
+            self.deadlines[issue_id] = deadline
+            heapq.heappush(self.heap, (deadline, issue_id))
+            if self.heap[0] == (deadline, issue_id):
+                # New earliest deadline, wake the loop up to re-arm its timer
+                self.condition.notify()
+
+    def schedule_issue(self, issue_id, status, current_level, deadline):
+        if is_escalation_due_later(status, current_level, deadline):
+            self.schedule(issue_id, deadline)
+        else:
+            self.schedule(issue_id, None)
+
+    def next_deadline(self):
+        with self.condition:
+            self._drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return the ids of issues whose deadline has passed"""
+        due = []
+        with self.condition:
+            self._drop_stale()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, issue_id = heapq.heappop(self.heap)
+                del self.deadlines[issue_id]
+                due.append(issue_id)
+                self._drop_stale()
+        return due
+
+    def _drop_stale(self):
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def load(self, now=None):
+        """Read every pending deadline once, at start-up"""
+        now = now or timezone.now()
+        pending = Issue.objects.filter(
+            status__in=state_machine.AUTO_ESCALATION_STATUSES,
+            next_escalation_date__isnull=False,
+            current_level__in=state_machine.AUTO_ESCALATION_LEVELS,
+        ).values_list("id", "next_escalation_date")
+        for issue_id, deadline in pending.iterator():
+            self.schedule(issue_id, deadline)
+        self.last_sync = now
+
+    def resync(self, now=None):
+        """Pick up deadlines changed by other processes since the last sync"""
+        now = now or timezone.now()
+        # Overlap the window slightly so a row committed while the previous
+        # sync was running is not missed
+        since = self.last_sync - timedelta(seconds=5)
+        changed = Issue.objects.filter(updated_at__gte=since).values_list(
+            "id", "status", "current_level", "next_escalation_date"
+        )
+        self._schedule_rows(changed)
+        self.last_sync = now
+
+    def run_pending(self, now=None):
+        """Escalate the issues that are due and schedule their new deadlines"""
+        now = now or timezone.now()
+        due = self.pop_due(now)
+        escalated = 0
+        for start in range(0, len(due), self.batch_size):
+            issue_ids = due[start : start + self.batch_size]
+            result = escalate_overdue(
+                now, batch_size=self.batch_size, log=self.log, issue_ids=issue_ids
+            )
+            escalated += result["escalated"]
+            self._schedule_rows(
+                Issue.objects.filter(id__in=issue_ids).values_list(
+                    "id", "status", "current_level", "next_escalation_date"
+                )
+            )
+        return escalated
+
+    def _schedule_rows(self, rows):
+        for issue_id, status, current_level, deadline in rows:
+            self.schedule_issue(issue_id, status, current_level, deadline)
+
+    def run(self):
+        """Escalate issues as they fall due until stop() is called"""
+        global _scheduler
+        _scheduler = self
+        loaded = False
+        try:
+            while not self.stopped:
+                try:
+                    if not loaded:
+                        self.load()
+                        loaded = True
+                    self.wait()
+                    if self.stopped:
+                        break
+                    now = timezone.now()
+                    self.run_pending(now)
+                    if now >= self.last_sync + self.resync_interval:
+                        self.resync(now)
+                except Exception:
+                    logger.exception(
+                        "Escalation scheduler tick failed, retrying in %ss",
+                        ERROR_BACKOFF,
+                    )
+                    loaded = False
+                    with self.condition:
+                        if not self.stopped:
+                            self.condition.wait(ERROR_BACKOFF)
+                finally:
+                    close_old_connections()
+        finally:
+            _scheduler = None
+
+    def wait(self):
+        """Sleep until the earliest deadline, the next resync or stop()"""
+        with self.condition:
+            if self.stopped:
+                return
+            now = timezone.now()
+            wake_at = self.last_sync + self.resync_interval
+            deadline = self.next_deadline()
+            if deadline is not None:
+                wake_at = min(wake_at, deadline)
+            timeout = (wake_at - now).total_seconds()
+            if timeout > 0:
+                self.condition.wait(timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+def acquire_lock():
+    """
+    Lock ESCALATION_SCHEDULER_LOCK_FILE for the life of this process,
+    returning False if another process holds it
+    """
+    global _lock_file
+    if _lock_file is not None or fcntl is None:
+        return True
+    lock_file = open(settings.ESCALATION_SCHEDULER_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # Released by the operating system when the process exits
+    _lock_file = lock_file
+    return True
+
+
+def start_background_scheduler():
+    """Run a scheduler on a daemon thread of the current process"""
+    scheduler = EscalationScheduler()
+    thread = threading.Thread(
+        target=scheduler.run, name="escalation-scheduler", daemon=True
+    )
+    thread.start()
+    return scheduler
+
+
+def autostart():
+    """Start the in-process scheduler if the settings ask for it"""
+    if not getattr(settings, "ESCALATION_SCHEDULER_IN_PROCESS", False):
+        return None
+    if not acquire_lock():
+        logger.info("Another process is running the escalation scheduler")
+        return None
+    return start_background_scheduler()
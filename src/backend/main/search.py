@@ -0,0 +1,168 @@
+"""
+Full-text search over issues.
+
+Every issue has an IssueSearchDocument row holding its reference number,
+title and the text of its description, responses and approved public
+comments. The rows are indexed per database backend:
+
+- SQLite: an external-content FTS5 table kept in sync by triggers (see
+  migration 0005) and ranked with bm25().
+- PostgreSQL: a GIN index over a weighted tsvector, ranked with ts_rank().
+
+Other databases, or SQLite builds without FTS5, fall back to the plain
+icontains scan of DRF's SearchFilter.
+
+Sinhala and Tamil words contain combining vowel signs and zero width
+joiners, which generic word splitters treat as separators. Both the FTS5
+tokenizer and tokenize() below keep them inside the word.
+"""
+
+import unicodedata
+
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+from rest_framework.settings import api_settings
+
+from .models import Issue, IssueSearchDocument
+
+
+FTS_TABLE = "main_issuesearchdocument_fts"
+
+# Weighted document used by the PostgreSQL GIN index. It must match the
+# expression in migration 0005 exactly or the index is not used.
+PG_DOCUMENT_VECTOR = (
+    "(setweight(to_tsvector('simple', reference || ' ' || title), 'A') || "
+    "setweight(to_tsvector('simple', body), 'B'))"
+)
+
+TOKEN_CATEGORIES = ("L", "M", "N")
+# Zero width non-joiner and joiner, used inside Sinhala conjuncts
+TOKEN_FORMAT_CHARS = ("\u200c", "\u200d")
+
+_fts_available = {}
+
+
+def tokenize(text):
+    """Split text into lower-cased search tokens"""
+    tokens = []
+    current = []
+    for char in text:
+        if (
+            unicodedata.category(char)[0] in TOKEN_CATEGORIES
+            or char in TOKEN_FORMAT_CHARS
+        ):
+            current.append(char)
+        elif current:
+            tokens.append("".join(current))
+            current = []
+    if current:
+        tokens.append("".join(current))
+    return [token.casefold() for token in tokens]
+
+
+def build_document(issue):
+    """Return the searchable text fields for an issue"""
+    parts = [issue.description]
+    parts.extend(issue.responses.values_list("message", flat=True))
+    parts.extend(
+        issue.public_comments.filter(is_approved=True).values_list(
+            "comment", flat=True
+        )
+    )
+    return {
+        "language": issue.language,
+        "reference": issue.reference_number,
+        "title": issue.title,
+        "body": "\n".join(parts),
+    }
+
+
+def index_issue(issue_id):
+    """Create, refresh or drop the search document for one issue"""
+    issue = Issue.objects.filter(pk=issue_id).first()
+    if issue is None:
+        IssueSearchDocument.objects.filter(pk=issue_id).delete()
+        return
+    IssueSearchDocument.objects.update_or_create(
+        issue=issue, defaults=build_document(issue)
+    )
+
+
+def schedule_index(issue_id):
+    """Reindex an issue once the current transaction commits"""
+    transaction.on_commit(lambda: index_issue(issue_id))
+
+
+def get_backend(using="default"):
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        return "postgresql"
+    if connection.vendor == "sqlite":
+        if using not in _fts_available:
+            with connection.cursor() as cursor:
+                _fts_available[using] = (
+                    FTS_TABLE in connection.introspection.table_names(cursor)
+                )
+        if _fts_available[using]:
+            return "sqlite"
+    return None
+
+
+def search_issues(queryset, tokens):
+    """
+    Filter an Issue queryset to documents matching every token (as a prefix)
+    and annotate ``search_rank``, where lower is better.
+
+    Returns None when the database has no full-text index.
+    """
+    backend = get_backend(queryset.db)
+    table = queryset.model._meta.db_table
+
+    if backend == "sqlite":
+        match = " ".join(f'"{token}"*' for token in tokens)
+        matches = RawSQL(
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", (match,)
+        )
+        rank = RawSQL(
+            f"SELECT bm25({FTS_TABLE}, 10.0, 5.0, 1.0) FROM {FTS_TABLE} "
+            f'WHERE {FTS_TABLE} MATCH %s AND rowid = "{table}"."id"',
+            (match,),
+        )
+    elif backend == "postgresql":
+        match = " & ".join(f"{token}:*" for token in tokens)
+        matches = RawSQL(
+            "SELECT issue_id FROM main_issuesearchdocument "
+            f"WHERE {PG_DOCUMENT_VECTOR} @@ to_tsquery('simple', %s)",
+            (match,),
+        )
+        rank = RawSQL(
+            f"SELECT -ts_rank({PG_DOCUMENT_VECTOR}, to_tsquery('simple', %s)) "
+            f'FROM main_issuesearchdocument WHERE issue_id = "{table}"."id"',
+            (match,),
+        )
+    else:
+        return None
+
+    return queryset.filter(pk__in=matches).annotate(search_rank=rank)
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    SearchFilter backed by the full-text index. Results are ranked by
+    relevance unless the client asks for an explicit ordering, so list it
+    after OrderingFilter in ``filter_backends``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        tokens = tokenize(" ".join(self.get_search_terms(request)))
+        if not tokens:
+            return queryset
+
+        results = search_issues(queryset, tokens)
+        if results is None:
+            return super().filter_queryset(request, queryset, view)
+
+        if request.query_params.get(api_settings.ORDERING_PARAM):
+            return results
+        return results.order_by("search_rank", "-created_at")
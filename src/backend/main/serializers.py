@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
+from . import notifications, routing
+from .attachments import get_media_type
 from .models import (
     User,
     Province,
@@ -224,9 +226,40 @@ class GramaNiladhariDivisionSerializer(serializers.ModelSerializer):
         ]
 
 
-class IssueAttachmentSerializer(serializers.ModelSerializer):
+def build_file_url(request, name, storage):
+    url = storage.url(name)
+    return request.build_absolute_uri(url) if request else url
+
+
+def get_thumbnail_urls(attachment, request):
+    """
+    URLs of the thumbnail variants of an attachment, or None while they are
+    being rendered and for files that have none
+    """
+    blob = attachment.blob
+    if blob is None or not blob.thumbnails:
+        return None
+    storage = blob.file.storage
+    return {
+        variant: build_file_url(request, name, storage)
+        for variant, name in blob.thumbnails.items()
+    }
+
+
+class AttachmentThumbnailMixin:
+    def get_thumbnails(self, obj):
+        return get_thumbnail_urls(obj, self.context.get("request"))
+
+    def get_thumbnail_url(self, obj):
+        thumbnails = get_thumbnail_urls(obj, self.context.get("request"))
+        return thumbnails.get("medium") if thumbnails else None
+
+
+class IssueAttachmentSerializer(AttachmentThumbnailMixin, serializers.ModelSerializer):
     file_url = serializers.SerializerMethodField()
     file_size = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = IssueAttachment
@@ -234,7 +267,13 @@ class IssueAttachmentSerializer(serializers.ModelSerializer):
             "id",
             "file",
             "file_url",
+            "thumbnail_url",
+            "thumbnails",
             "file_size",
+            "mime_type",
+            "width",
+            "height",
+            "checksum",
             "attachment_type",
             "description",
             "uploaded_at",
@@ -248,13 +287,17 @@ class IssueAttachmentSerializer(serializers.ModelSerializer):
 
     def get_file_size(self, obj):
         if obj.file:
-            return obj.file.size
+            return obj.file_size
         return None
 
 
-class ResponseAttachmentSerializer(serializers.ModelSerializer):
+class ResponseAttachmentSerializer(
+    AttachmentThumbnailMixin, serializers.ModelSerializer
+):
     file_url = serializers.SerializerMethodField()
     file_size = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
     attachment_type = serializers.SerializerMethodField()
 
     class Meta:
@@ -263,7 +306,13 @@ class ResponseAttachmentSerializer(serializers.ModelSerializer):
             "id",
             "file",
             "file_url",
+            "thumbnail_url",
+            "thumbnails",
             "file_size",
+            "mime_type",
+            "width",
+            "height",
+            "checksum",
             "attachment_type",
             "description",
             "uploaded_at",
@@ -277,19 +326,12 @@ class ResponseAttachmentSerializer(serializers.ModelSerializer):
 
     def get_file_size(self, obj):
         if obj.file:
-            return obj.file.size
+            return obj.file_size
         return None
 
     def get_attachment_type(self, obj):
         if obj.file:
-            if obj.file.name.lower().endswith(
-                (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
-            ):
-                return "image"
-            elif obj.file.name.lower().endswith(
-                (".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm")
-            ):
-                return "video"
+            return get_media_type(obj.mime_type, obj.file.name)
         return "document"
 
 
@@ -401,6 +443,9 @@ class IssueListSerializer(serializers.ModelSerializer):
         ]
 
     def get_response_count(self, obj):
+        # Annotated by Issue.objects.for_list()
+        if hasattr(obj, "response_count"):
+            return obj.response_count
         return obj.responses.count()
 
     def get_attachments(self, obj):
@@ -409,14 +454,7 @@ class IssueListSerializer(serializers.ModelSerializer):
         for attachment in attachments:
             file_type = "image"
             if attachment.file and attachment.file.name:
-                if attachment.file.name.lower().endswith(
-                    (".mp4", ".avi", ".mov", ".wmv", ".flv", ".webm")
-                ):
-                    file_type = "video"
-                elif not attachment.file.name.lower().endswith(
-                    (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
-                ):
-                    file_type = "document"
+                file_type = get_media_type(attachment.mime_type, attachment.file.name)
 
             request = self.context.get("request")
             file_url = None
@@ -425,10 +463,13 @@ class IssueListSerializer(serializers.ModelSerializer):
             elif attachment.file:
                 file_url = attachment.file.url
 
+            thumbnails = get_thumbnail_urls(attachment, request)
             attachment_data.append(
                 {
                     "id": attachment.id,
                     "file_url": file_url,
+                    "thumbnail_url": thumbnails.get("medium") if thumbnails else None,
+                    "thumbnails": thumbnails,
                     "file_type": file_type,
                     "description": attachment.description or "",
                     "uploaded_at": attachment.uploaded_at,
@@ -654,24 +695,16 @@ class IssueCreateSerializer(serializers.ModelSerializer):
 
         print("Final validated_data:", validated_data)  # Debug
 
-        issue = Issue.objects.create(**validated_data)
+        issue = Issue(**validated_data)
 
-        # Auto-assign to appropriate Grama Niladhari if GN division is provided
-        if issue.grama_niladhari_division:
-            from django.db.models import Q
+        # Auto-assign to appropriate Grama Niladhari if GN division is
+        # provided, before the insert so the issue is written once
+        if issue.grama_niladhari_division_id:
+            issue.current_handler_id = routing.pick_handler("grama_niladhari", issue)
 
-            gn_users = User.objects.filter(
-                user_type="grama_niladhari",
-                is_approved=True,
-                province=issue.province,
-                district=issue.district,
-                ds_division=issue.ds_division,
-                grama_niladhari_division=issue.grama_niladhari_division,
-            )
-
-            if gn_users.exists():
-                issue.current_handler = gn_users.first()
-                issue.save()
+        issue.save()
+        if issue.current_handler_id:
+            notifications.notify("new_issue", issue)
 
         return issue
 
@@ -690,6 +723,23 @@ class NotificationSerializer(serializers.ModelSerializer):
         ]
 
 
+class NotificationMarkReadSerializer(serializers.Serializer):
+    """Which notifications to mark as read; every given filter must match"""
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, max_length=1000
+    )
+    issue = serializers.IntegerField(required=False)
+    before = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError(
+                "Provide ids, issue or before to select notifications."
+            )
+        return attrs
+
+
 class SystemSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = SystemSettings
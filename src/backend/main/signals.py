@@ -0,0 +1,158 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import (
+    divisions,
+    events,
+    notifications,
+    routing,
+    scheduler,
+    search,
+    stats,
+    system_settings,
+    thumbnails,
+)
+from .models import (
+    AttachmentBlob,
+    District,
+    DSDivision,
+    GramaNiladhariDivision,
+    Issue,
+    IssueAttachment,
+    IssueEscalation,
+    IssueResponse,
+    IssueStatCounter,
+    Notification,
+    Province,
+    PublicComment,
+    ResponseAttachment,
+    SystemSettings,
+    User,
+)
+
+
+@receiver(post_save, sender=Issue)
+def reindex_issue(sender, instance, **kwargs):
+    search.schedule_index(instance.pk)
+
+
+@receiver(post_save, sender=Issue)
+def reschedule_escalation(sender, instance, **kwargs):
+    # Covers IssueCreateSerializer.create and the deadline changes made by
+    # IssueResponseView, so an in-process scheduler never waits on a resync
+    state = (
+        instance.pk,
+        instance.status,
+        instance.current_level,
+        instance.next_escalation_date,
+    )
+    transaction.on_commit(lambda: scheduler.notify_deadline(*state))
+
+
+@receiver(post_delete, sender=Issue)
+def unschedule_escalation(sender, instance, **kwargs):
+    issue_id = instance.pk
+    transaction.on_commit(lambda: scheduler.forget_issue(issue_id))
+
+
+@receiver(pre_save, sender=Issue)
+@receiver(pre_delete, sender=Issue)
+def load_counted_values(sender, instance, **kwargs):
+    if not instance._state.adding:
+        stats.load_counted_values(instance)
+
+
+@receiver(post_save, sender=Issue)
+def update_stat_counters(sender, instance, created, **kwargs):
+    stats.record_changes([instance], created=created)
+
+
+@receiver(post_delete, sender=Issue)
+def remove_from_stat_counters(sender, instance, **kwargs):
+    stats.record_deletion(instance)
+
+
+@receiver(post_save, sender=Notification)
+@receiver(post_delete, sender=Notification)
+def invalidate_unread_count(sender, instance, **kwargs):
+    notifications.invalidate_unread_counts([instance.user_id])
+
+
+@receiver(post_save, sender=AttachmentBlob)
+def render_blob_thumbnails(sender, instance, created, **kwargs):
+    if created and thumbnails.has_thumbnails(instance.mime_type):
+        blob_id = instance.pk
+        transaction.on_commit(lambda: thumbnails.schedule(blob_id))
+
+
+@receiver(post_delete, sender=IssueAttachment)
+@receiver(post_delete, sender=ResponseAttachment)
+def release_attachment_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        AttachmentBlob.objects.release(instance.blob_id)
+
+
+@receiver(post_save, sender=Issue)
+def publish_issue_status(sender, instance, **kwargs):
+    events.publish_status(instance)
+
+
+@receiver(post_save, sender=IssueResponse)
+def publish_issue_response(sender, instance, created, **kwargs):
+    if created:
+        events.publish_response(instance)
+
+
+@receiver(post_save, sender=IssueEscalation)
+def publish_issue_escalation(sender, instance, created, **kwargs):
+    # Bulk escalations publish from escalate_overdue()
+    if created:
+        events.publish_escalation(instance.issue, instance)
+
+
+@receiver(post_save, sender=IssueResponse)
+@receiver(post_delete, sender=IssueResponse)
+@receiver(post_save, sender=PublicComment)
+@receiver(post_delete, sender=PublicComment)
+def reindex_issue_timeline(sender, instance, **kwargs):
+    search.schedule_index(instance.issue_id)
+
+
+@receiver(post_save, sender=User)
+def update_routing(sender, instance, **kwargs):
+    # Only approval, type or jurisdiction changes affect routing, so routine
+    # saves such as last_login updates keep the table
+    if routing.is_stale_for(instance):
+        routing.invalidate()
+        transaction.on_commit(routing.invalidate)
+
+
+@receiver(post_delete, sender=User)
+def remove_from_routing(sender, instance, **kwargs):
+    if routing.is_stale_for(instance, deleted=True):
+        routing.invalidate()
+        transaction.on_commit(routing.invalidate)
+    # Deleting a handler sets current_handler to NULL with a plain UPDATE
+    IssueStatCounter.objects.filter(scope="handler", scope_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=Province)
+@receiver(post_delete, sender=Province)
+@receiver(post_save, sender=District)
+@receiver(post_delete, sender=District)
+@receiver(post_save, sender=DSDivision)
+@receiver(post_delete, sender=DSDivision)
+@receiver(post_save, sender=GramaNiladhariDivision)
+@receiver(post_delete, sender=GramaNiladhariDivision)
+def invalidate_division_tree(sender, instance, **kwargs):
+    divisions.invalidate()
+    transaction.on_commit(divisions.invalidate)
+
+
+@receiver(post_save, sender=SystemSettings)
+@receiver(post_delete, sender=SystemSettings)
+def invalidate_system_settings(sender, instance, **kwargs):
+    system_settings.invalidate()
+    # Drop a snapshot read again before the change was committed
+    transaction.on_commit(system_settings.invalidate)
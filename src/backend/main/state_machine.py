@@ -0,0 +1,244 @@
+"""
+The issue state machine shared by the response view and the escalation jobs.
+
+Every way an issue moves is an action: an official responding, asking for
+more time or resolving it, a manual or automatic escalation, or an
+automatic escalation deferred because nobody is available at the next
+level. TRANSITIONS maps each (action, status, level) an action is allowed
+from to the status and level it leads to and how the next deadline is
+set. It is built once at import; anything missing from it is invalid.
+
+plan() and plan_many() turn transitions into the field changes of each
+issue, so a response and a batch of overdue issues get exactly the same
+changes. The request path applies them with Issue.update_if_current(),
+which sends the save signals; bulk jobs use write(), which does not.
+
+Response windows are the ``escalation_days.<level>`` SystemSettings,
+falling back to DEFAULT_ESCALATION_DAYS, and are read from the in-memory
+snapshot in system_settings.py. Extensions are counted in
+pending_extension_count.
+"""
+
+from collections import namedtuple
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import system_settings
+from .models import Issue
+
+
+ESCALATION_HIERARCHY = {
+    "grama_niladhari": "divisional_secretary",
+    "divisional_secretary": "district_secretary",
+    "district_secretary": "provincial_ministry",
+    "provincial_ministry": "national_ministry",
+    "national_ministry": "prime_minister",
+}
+
+LEVELS = [*ESCALATION_HIERARCHY, "prime_minister"]
+
+STATUSES = [value for value, label in Issue.ISSUE_STATUS]
+
+# Levels that escalate automatically once their deadline has passed
+AUTO_ESCALATION_LEVELS = [
+    "grama_niladhari",
+    "divisional_secretary",
+    "district_secretary",
+    "provincial_ministry",
+]
+
+# Statuses whose deadline is watched; an escalated issue waits for its
+# new handler to respond first
+AUTO_ESCALATION_STATUSES = ["pending", "in_progress"]
+
+DEFAULT_ESCALATION_DAYS = {
+    level: 7 if level in ["national_ministry", "prime_minister"] else 3
+    for level in LEVELS
+}
+
+ESCALATION_DAYS_KEY = "escalation_days.{}"
+
+# How long to wait before retrying an issue with no handler at the next level
+RETRY_DELAY = timedelta(hours=6)
+
+# Actions
+RESPOND = "respond"
+PEND = "pend"
+EXTEND = "extend"
+RESOLVE = "resolve"
+ESCALATE = "escalate"
+AUTO_ESCALATE = "auto_escalate"
+DEFER = "defer"
+
+ACTIONS = [RESPOND, PEND, EXTEND, RESOLVE, ESCALATE, AUTO_ESCALATE, DEFER]
+
+# How an action sets next_escalation_date
+WINDOW = "window"  # the response window of the level the issue ends up at
+EXTENSION = "extension"  # the number of days the official asked for
+RETRY = "retry"  # RETRY_DELAY
+# None clears it
+
+Transition = namedtuple("Transition", ["status", "level", "deadline"])
+
+
+class InvalidTransition(Exception):
+    def __init__(self, action, status, level):
+        self.action = action
+        self.status = status
+        self.level = level
+        super().__init__(
+            f"Cannot {action.replace('_', ' ')} an issue that is {status} at "
+            f"level {level}"
+        )
+
+
+def get_next_level(level):
+    """The level above ``level``, or None at the top"""
+    return ESCALATION_HIERARCHY.get(level)
+
+
+def get_escalated_status(level):
+    # Nothing escalates past the top, so the issue simply waits there
+    return "pending" if get_next_level(level) is None else "escalated"
+
+
+def build_transitions():
+    transitions = {}
+    for status in STATUSES:
+        if status == "closed":
+            continue
+        for level in LEVELS:
+            # Responding to a resolved issue reopens it
+            transitions[(RESPOND, status, level)] = Transition(
+                "in_progress", level, WINDOW
+            )
+            transitions[(PEND, status, level)] = Transition("pending", level, WINDOW)
+            transitions[(EXTEND, status, level)] = Transition(
+                "pending", level, EXTENSION
+            )
+            if status != "resolved":
+                transitions[(RESOLVE, status, level)] = Transition(
+                    "resolved", level, None
+                )
+
+            next_level = get_next_level(level)
+            if next_level is None:
+                continue
+            escalation = Transition(
+                get_escalated_status(next_level), next_level, WINDOW
+            )
+            transitions[(ESCALATE, status, level)] = escalation
+            if status in AUTO_ESCALATION_STATUSES and level in AUTO_ESCALATION_LEVELS:
+                transitions[(AUTO_ESCALATE, status, level)] = escalation
+                transitions[(DEFER, status, level)] = Transition(status, level, RETRY)
+    return transitions
+
+
+TRANSITIONS = build_transitions()
+
+
+def get_transition(action, status, level):
+    try:
+        return TRANSITIONS[(action, status, level)]
+    except KeyError:
+        raise InvalidTransition(action, status, level) from None
+
+
+def escalates_automatically(status, level):
+    """Whether an issue in this state is escalated when its deadline passes"""
+    return (AUTO_ESCALATE, status, level) in TRANSITIONS
+
+
+def get_response_action(response_type, additional_days=None):
+    """The action an official's response of ``response_type`` asks for"""
+    if response_type == "resolved":
+        return RESOLVE
+    if response_type == "escalate":
+        return ESCALATE
+    if response_type == "pending":
+        return EXTEND if additional_days else PEND
+    return RESPOND
+
+
+def get_escalation_window(level):
+    """Response window in days of ``level``"""
+    default = DEFAULT_ESCALATION_DAYS.get(level, DEFAULT_ESCALATION_DAYS[LEVELS[0]])
+    return system_settings.get_int(ESCALATION_DAYS_KEY.format(level), default, 1)
+
+
+def get_escalation_windows():
+    """Response window in days of every level"""
+    return {level: get_escalation_window(level) for level in LEVELS}
+
+
+def plan(issue, action, now, windows, handler_id=None, additional_days=None):
+    """
+    The field changes ``action`` makes to ``issue``. ``handler_id`` is the
+    new handler of an escalation or the official resolving the issue, and
+    ``additional_days`` the extension asked for. Raises InvalidTransition
+    if the action is not allowed from the issue's state.
+    """
+    transition = get_transition(action, issue.status, issue.current_level)
+    changes = {"status": transition.status, "updated_at": now}
+
+    if transition.level != issue.current_level:
+        changes["current_level"] = transition.level
+        changes["current_handler_id"] = handler_id
+        changes["escalation_count"] = issue.escalation_count + 1
+    elif action == RESOLVE:
+        changes["resolved_at"] = now
+        changes["current_handler_id"] = handler_id
+    elif action == EXTEND:
+        changes["pending_extension_count"] = issue.pending_extension_count + 1
+
+    if transition.deadline == WINDOW:
+        deadline = now + timedelta(days=windows[transition.level])
+    elif transition.deadline == EXTENSION:
+        deadline = now + timedelta(days=additional_days)
+    elif transition.deadline == RETRY:
+        deadline = now + RETRY_DELAY
+    else:
+        deadline = None
+    changes["next_escalation_date"] = deadline
+    return changes
+
+
+def plan_many(issues, action, now=None, windows=None, handler_ids=None):
+    """
+    (issue, changes) for each of ``issues``, with the new handler of each
+    looked up in ``handler_ids`` by issue id. Raises InvalidTransition if
+    any issue cannot take the action.
+    """
+    now = now or timezone.now()
+    if windows is None:
+        windows = get_escalation_windows()
+    handler_ids = handler_ids or {}
+    return [
+        (issue, plan(issue, action, now, windows, handler_ids.get(issue.id)))
+        for issue in issues
+    ]
+
+
+def apply(issue, action, now=None, windows=None, **kwargs):
+    """
+    Move one issue with Issue.update_if_current(), which sends the save
+    signals. Returns False if the issue changed since it was loaded.
+    """
+    now = now or timezone.now()
+    if windows is None:
+        windows = get_escalation_windows()
+    return issue.update_if_current(**plan(issue, action, now, windows, **kwargs))
+
+
+def write(issue, changes):
+    """
+    Write planned changes with a conditional UPDATE and no save signals,
+    updating the instance if it was still current. Returns whether it was.
+    """
+    if not Issue.objects.update_if_current(issue, **changes):
+        return False
+    for name, value in changes.items():
+        setattr(issue, name, value)
+    issue.version += 1
+    return True
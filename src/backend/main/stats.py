@@ -0,0 +1,162 @@
+"""
+Issue counters for the dashboards.
+
+IssueStatCounter holds the number of issues per status in every scope a
+dashboard shows: all issues, each province, district, DS and GN division,
+each current handler and each reporter. Issue saves and deletes move their
+issue between counters (see signals.py), and the escalation engine records
+its bulk updates with record_changes(), so a dashboard reads a handful of
+counter rows in one query instead of counting issues.
+
+A save reads the values it moves the issue away from out of the issue's
+row, locked until the counters are updated, rather than trusting the
+instance, which may be a stale copy. Counters never go below zero, and
+``manage.py rebuild_issue_stats`` recounts them from the issue table
+should they drift anyway, for example after raw SQL updates.
+"""
+
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest
+
+from .models import Issue, IssueStatCounter
+
+
+# Counter scope for each field in Issue.COUNTED_FIELDS except status
+SCOPES = (
+    ("province", "province_id"),
+    ("district", "district_id"),
+    ("ds_division", "ds_division_id"),
+    ("gn_division", "grama_niladhari_division_id"),
+    ("handler", "current_handler_id"),
+    ("reporter", "reporter_user_id"),
+)
+
+PENDING_STATUSES = ["pending", "in_progress"]
+RESOLVED_STATUSES = ["resolved", "closed"]
+
+
+def get_counted_values(issue):
+    return {name: getattr(issue, name) for name in Issue.COUNTED_FIELDS}
+
+
+def get_keys(values):
+    """The (scope, scope_id, status) counters an issue with ``values`` is in"""
+    status = values["status"]
+    keys = [("all", 0, status)]
+    for scope, attname in SCOPES:
+        if values[attname] is not None:
+            keys.append((scope, values[attname], status))
+    return keys
+
+
+def load_counted_values(issue):
+    """
+    Read the stored values of an issue about to be saved or deleted, locking
+    its row until the transaction ends. The instance may have been loaded
+    before another save of the same issue, or only() or defer() may have
+    left some of them out.
+    """
+    issue._counted_values = (
+        Issue.objects.select_for_update()
+        .filter(pk=issue.pk)
+        .values(*Issue.COUNTED_FIELDS)
+        .first()
+    )
+
+
+def record_changes(issues, created=False):
+    """Move saved ``issues`` from the counters they were in to their new ones"""
+    deltas = Counter()
+    for issue in issues:
+        old = None if created else getattr(issue, "_counted_values", None)
+        new = get_counted_values(issue)
+        if old is not None and old.get("status") is not None:
+            for key in get_keys(old):
+                deltas[key] -= 1
+        for key in get_keys(new):
+            deltas[key] += 1
+        issue._counted_values = new
+    apply_deltas(deltas)
+
+
+def record_deletion(issue):
+    old = getattr(issue, "_counted_values", None)
+    if old is None or old.get("status") is None:
+        return
+    apply_deltas(Counter({key: -1 for key in get_keys(old)}))
+
+
+def apply_deltas(deltas):
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    with transaction.atomic():
+        IssueStatCounter.objects.bulk_create(
+            [
+                IssueStatCounter(scope=scope, scope_id=scope_id, status=status)
+                for (scope, scope_id, status), delta in deltas.items()
+                if delta > 0
+            ],
+            ignore_conflicts=True,
+        )
+        for (scope, scope_id, status), delta in deltas.items():
+            IssueStatCounter.objects.filter(
+                scope=scope, scope_id=scope_id, status=status
+            ).update(count=Greatest(F("count") + delta, 0))
+
+
+def rebuild():
+    """Recount every counter from the issue table"""
+    counters = [
+        IssueStatCounter(scope="all", scope_id=0, status=row["status"], count=row["n"])
+        for row in Issue.objects.order_by().values("status").annotate(n=Count("id"))
+    ]
+    for scope, attname in SCOPES:
+        rows = (
+            Issue.objects.filter(**{f"{attname}__isnull": False})
+            .order_by()
+            .values(attname, "status")
+            .annotate(n=Count("id"))
+        )
+        counters.extend(
+            IssueStatCounter(
+                scope=scope, scope_id=row[attname], status=row["status"], count=row["n"]
+            )
+            for row in rows
+        )
+
+    with transaction.atomic():
+        IssueStatCounter.objects.all().delete()
+        IssueStatCounter.objects.bulk_create(counters, batch_size=1000)
+    return len(counters)
+
+
+def get_dashboard_counts(scope, scope_id=0):
+    """Issue totals for one scope, in a single query"""
+    in_scope = Q(scope=scope, scope_id=scope_id)
+    rows = IssueStatCounter.objects.filter(in_scope)
+    return rows.aggregate(
+        total=Sum("count", filter=in_scope, default=0),
+        pending=Sum(
+            "count", filter=in_scope & Q(status__in=PENDING_STATUSES), default=0
+        ),
+        resolved=Sum(
+            "count", filter=in_scope & Q(status__in=RESOLVED_STATUSES), default=0
+        ),
+        escalated=Sum("count", filter=in_scope & Q(status="escalated"), default=0),
+    )
+
+
+def count_handled(handler_id, scope, scope_id=0):
+    """
+    Issues handled by ``handler_id`` within one scope. No counter holds that
+    intersection, so this counts them, by the indexed handler column.
+    """
+    issues = Issue.objects.filter(current_handler_id=handler_id)
+    if scope != "all":
+        issues = issues.filter(**{dict(SCOPES)[scope]: scope_id})
+    return issues.count()
@@ -0,0 +1,78 @@
+"""
+In-memory snapshot of the SystemSettings table.
+
+Response windows, OTP lifetimes and the pending extension limit are
+tunables that admins edit as SystemSettings rows. They are read on every
+response, escalation batch and OTP request, so rather than a query each
+time, get_snapshot() loads every row with one query and keeps the map
+until a SystemSettings save or delete invalidates it (see signals.py).
+Changes made by other processes are picked up once the snapshot is older
+than SETTINGS_TTL.
+
+get() returns the raw string and get_int() parses it, falling back to the
+caller's default when the row is missing or unusable, so a typo in the
+admin cannot break the code that reads it.
+"""
+
+import logging
+import threading
+import time
+
+from .models import SystemSettings
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the settings are reloaded even without a local invalidation
+SETTINGS_TTL = 60
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+class Snapshot:
+    def __init__(self):
+        self.values = dict(SystemSettings.objects.values_list("key", "value"))
+        self.loaded_at = time.monotonic()
+
+    def is_expired(self):
+        return time.monotonic() - self.loaded_at > SETTINGS_TTL
+
+
+def get_snapshot():
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None or snapshot.is_expired():
+        with _lock:
+            if _snapshot is None or _snapshot.is_expired():
+                _snapshot = Snapshot()
+            snapshot = _snapshot
+    return snapshot
+
+
+def invalidate():
+    global _snapshot
+    _snapshot = None
+
+
+def get(key, default=None):
+    return get_snapshot().values.get(key, default)
+
+
+def get_int(key, default, minimum=None):
+    """
+    The setting ``key`` as an int, or ``default`` when it is not set, not
+    a whole number or below ``minimum``
+    """
+    value = get(key)
+    if value is None:
+        return default
+    try:
+        value = int(value.strip())
+    except ValueError:
+        logger.warning("Ignoring setting %s=%r, not a whole number", key, value)
+        return default
+    if minimum is not None and value < minimum:
+        logger.warning("Ignoring setting %s=%d, below %d", key, value, minimum)
+        return default
+    return value
@@ -1,3 +1,2304 @@
-from django.test import TestCase
+import asyncio
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+import qrcode
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (
+    attachments,
+    divisions,
+    events,
+    google_tokens,
+    login_audit,
+    notifications,
+    otp_delivery,
+    qr_codes,
+    routing,
+    scheduler,
+    state_machine,
+    stats,
+    system_settings,
+    throttles,
+    thumbnails,
+)
+from .escalation import escalate_overdue, get_overdue_issues
+from .google_keyserver import KeyServer
+from .models import (
+    AttachmentBlob,
+    User,
+    Province,
+    District,
+    DSDivision,
+    GoogleAuthUser,
+    GramaNiladhariDivision,
+    Issue,
+    IssueAttachment,
+    IssueEscalation,
+    IssueResponse,
+    LoginAttempt,
+    LoginAttemptSummary,
+    Notification,
+    OTPVerification,
+    PublicComment,
+    ResponseAttachment,
+    SystemSettings,
+)
+from .views import (
+    DashboardRecentIssuesView,
+    IssueListView,
+    MyIssuesView,
+)
+from .workers import BackgroundWorker
+
+
+def create_divisions():
+    province = Province.objects.create(
+        name_en="Southern", name_si="දකුණ", name_ta="தெற்கு"
+    )
+    district = District.objects.create(
+        name_en="Matara", name_si="මාතර", name_ta="மாத்தறை", province=province
+    )
+    ds_division = DSDivision.objects.create(
+        name_en="Weligama", name_si="වැලිගම", name_ta="வெலிகம", district=district
+    )
+    gn_division = GramaNiladhariDivision.objects.create(
+        name_en="Mirissa", name_si="මිරිස්ස", name_ta="மிரிஸ்ஸ", ds_division=ds_division
+    )
+    return province, district, ds_division, gn_division
+
+
+def create_issue(divisions, **kwargs):
+    province, district, ds_division, gn_division = divisions
+    fields = {
+        "reporter_name": "Citizen",
+        "title": "Broken road",
+        "description": "The main road is broken",
+        "province": province,
+        "district": district,
+        "ds_division": ds_division,
+        "grama_niladhari_division": gn_division,
+    }
+    fields.update(kwargs)
+    return Issue.objects.create(**fields)
+
+
+class IssueListQueryTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.divisions = create_divisions()
+        self.handler = User.objects.create_user(
+            username="gn", password="x", user_type="grama_niladhari"
+        )
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+
+    def add_issues(self, count):
+        for _ in range(count):
+            issue = create_issue(
+                self.divisions,
+                reporter_user=self.citizen,
+                current_handler=self.handler,
+            )
+            IssueAttachment.objects.create(
+                issue=issue, file="issue_attachments/a.jpg", attachment_type="image"
+            )
+            IssueAttachment.objects.create(
+                issue=issue, file="issue_attachments/b.mp4", attachment_type="video"
+            )
+            IssueResponse.objects.create(
+                issue=issue,
+                responder=self.handler,
+                response_type="response",
+                message="On it",
+            )
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_issue_list_query_count_is_independent_of_page_size(self):
+        self.add_issues(2)
+        small, response = self.count_list_queries("/api/issues/")
+        self.assertEqual(response.data["results"][0]["response_count"], 1)
+        self.assertEqual(len(response.data["results"][0]["attachments"]), 2)
+
+        self.add_issues(18)
+        large, response = self.count_list_queries("/api/issues/")
+        self.assertEqual(len(response.data["results"]), 20)
+        self.assertEqual(small, large)
+        # COUNT for the paginator, the page itself and the attachment prefetch
+        self.assertEqual(large, 3)
+
+    def test_my_issues_and_recent_issues_use_list_queryset(self):
+        self.add_issues(5)
+        self.client.force_authenticate(self.citizen)
+        with self.assertNumQueries(3):
+            self.client.get("/api/issues/my/")
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/dashboard/recent-issues/")
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(response.data[0]["current_handler_name"], "")
+
+    def add_timeline(self, issue, count):
+        for _ in range(count):
+            response = IssueResponse.objects.create(
+                issue=issue,
+                responder=self.handler,
+                response_type="response",
+                message="On it",
+            )
+            ResponseAttachment.objects.create(
+                response=response, file=SimpleUploadedFile("photo.jpg", b"12345")
+            )
+            IssueEscalation.objects.create(
+                issue=issue,
+                from_user=self.handler,
+                to_user=self.citizen,
+                from_level="grama_niladhari",
+                to_level="divisional_secretary",
+            )
+            PublicComment.objects.create(
+                issue=issue, commenter_name="Neighbour", comment="Same here"
+            )
+            IssueAttachment.objects.create(
+                issue=issue,
+                file=SimpleUploadedFile("video.mp4", b"123"),
+                attachment_type="video",
+            )
+
+    def test_issue_detail_query_count_is_independent_of_timeline(self):
+        with tempfile.TemporaryDirectory() as media_root, self.settings(
+            MEDIA_ROOT=media_root
+        ):
+            issue = create_issue(self.divisions, current_handler=self.handler)
+            self.add_timeline(issue, 1)
+            url = f"/api/issues/{issue.pk}/"
+            short, response = self.count_list_queries(url)
+
+            self.add_timeline(issue, 4)
+            long, response = self.count_list_queries(url)
+            self.assertEqual(short, long)
+            # Issue, attachments, responses, response attachments,
+            # escalations and comments
+            self.assertEqual(long, 6)
+            self.assertEqual(len(response.data["responses"]), 5)
+
+            # Sizes come from the database, not the storage
+            for attachment in ResponseAttachment.objects.all():
+                attachment.file.delete(save=False)
+            response = self.client.get(url)
+            self.assertEqual(
+                response.data["responses"][0]["attachments"][0]["file_size"], 5
+            )
+            self.assertEqual(response.data["attachments"][0]["file_size"], 3)
+
+
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.divisions = create_divisions()
+        for index in range(25):
+            create_issue(self.divisions, title=f"Issue {index}")
+
+    def test_cursor_pages_are_stable_when_new_issues_arrive(self):
+        first = self.client.get("/api/issues/?pagination=cursor")
+        self.assertNotIn("count", first.data)
+        self.assertEqual(len(first.data["results"]), 20)
+        self.assertIsNone(first.data["previous"])
+
+        create_issue(self.divisions, title="Newest")
+        second = self.client.get(first.data["next"])
+        titles = [issue["title"] for issue in second.data["results"]]
+        self.assertEqual(titles, [f"Issue {index}" for index in range(4, -1, -1)])
+        self.assertIsNone(second.data["next"])
+
+        previous = self.client.get(second.data["previous"])
+        self.assertEqual(
+            [issue["id"] for issue in previous.data["results"]],
+            [issue["id"] for issue in first.data["results"]],
+        )
+
+    def test_page_mode_can_skip_count(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/issues/?count=false")
+        self.assertNotIn("count", response.data)
+        self.assertIn("page=2", response.data["next"])
+
+        response = self.client.get("/api/issues/?count=false&page=2")
+        self.assertEqual(len(response.data["results"]), 5)
+        self.assertIsNone(response.data["next"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/api/issues/?cursor=garbage")
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_mode_only_lists_newest_first(self):
+        response = self.client.get(
+            "/api/issues/?pagination=cursor&ordering=-created_at"
+        )
+        self.assertEqual(response.status_code, 200)
+        for query in ["ordering=priority", "ordering=created_at", "search=road"]:
+            with self.subTest(query=query):
+                response = self.client.get(f"/api/issues/?pagination=cursor&{query}")
+                self.assertEqual(response.status_code, 400)
+
+
+class FullTextSearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.divisions = create_divisions()
+        self.official = User.objects.create_user(
+            username="gn", password="x", user_type="grama_niladhari"
+        )
+
+    def search(self, query):
+        response = self.client.get("/api/issues/", {"search": query})
+        return [issue["title"] for issue in response.data["results"]]
+
+    def test_search_matches_sinhala_tamil_and_english_text(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_issue(
+                self.divisions,
+                title="මාර්ගය කැඩී ඇත",
+                description="ශ්‍රී ලංකා",
+                language="si",
+            )
+            create_issue(
+                self.divisions,
+                title="வீதி உடைந்துள்ளது",
+                description="-",
+                language="ta",
+            )
+            create_issue(self.divisions, title="Broken streetlight")
+
+        self.assertEqual(self.search("කැඩ"), ["මාර්ගය කැඩී ඇත"])
+        self.assertEqual(self.search("ශ්‍රී"), ["මාර්ගය කැඩී ඇත"])
+        self.assertEqual(self.search("உடை"), ["வீதி உடைந்துள்ளது"])
+        self.assertEqual(self.search("STREET"), ["Broken streetlight"])
+        # Vowel signs stay inside the word, so a trailing syllable is no match
+        self.assertEqual(self.search("ඩී"), [])
+
+    def test_search_ranks_title_matches_and_indexes_timeline(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            body_match = create_issue(
+                self.divisions, title="Garbage", description="Near the water tank"
+            )
+            create_issue(self.divisions, title="Water leak", description="Pipe burst")
+        self.assertEqual(self.search("water"), ["Water leak", "Garbage"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            IssueResponse.objects.create(
+                issue=body_match,
+                responder=self.official,
+                response_type="response",
+                message="Council truck dispatched",
+            )
+            PublicComment.objects.create(
+                issue=body_match, commenter_name="X", comment="unmoderated spam"
+            )
+        self.assertEqual(self.search("truck"), ["Garbage"])
+        self.assertEqual(self.search("spam"), [])
+        self.assertEqual(self.search(body_match.reference_number), ["Garbage"])
+
+
+class IssueIndexUsageTests(TestCase):
+    """EXPLAIN the hot issue queries and check they are served by an index"""
+
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.jurisdiction = {
+            "province": province,
+            "district": district,
+            "ds_division": ds_division,
+            "grama_niladhari_division": gn_division,
+        }
+
+    def make_user(self, user_type, **kwargs):
+        return User.objects.create_user(
+            username=user_type, password="x", user_type=user_type, **kwargs
+        )
+
+    def assert_uses_index(self, queryset, index_name, ordered=True):
+        plan = queryset[:20].explain()
+        issue_lines = [line for line in plan.splitlines() if " main_issue " in line]
+        self.assertEqual(len(issue_lines), 1, plan)
+        self.assertIn("USING", issue_lines[0])
+        self.assertIn(index_name, issue_lines[0].split())
+        if ordered:
+            # The index also yields the -created_at order
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def view_queryset(self, view_class, user):
+        view = view_class()
+        view.request = SimpleNamespace(user=user)
+        return view.get_queryset().order_by("-created_at")
+
+    def test_official_issue_lists_use_jurisdiction_indexes(self):
+        for user_type, index_name in (
+            ("grama_niladhari", "issue_gn_level_created_idx"),
+            ("divisional_secretary", "issue_ds_level_created_idx"),
+            ("district_secretary", "issue_dist_level_created_idx"),
+            ("provincial_ministry", "issue_prov_level_created_idx"),
+            ("national_ministry", "issue_level_created_idx"),
+        ):
+            with self.subTest(user_type=user_type):
+                user = self.make_user(user_type, **self.jurisdiction)
+                listed = self.view_queryset(IssueListView, user)
+                self.assert_uses_index(listed, index_name)
+                recent = DashboardRecentIssuesView().get_jurisdiction_queryset(user)
+                self.assert_uses_index(recent.order_by("-created_at"), index_name)
+
+    def test_citizen_and_public_feeds_use_indexes(self):
+        citizen = self.make_user("citizen")
+        self.assert_uses_index(
+            self.view_queryset(MyIssuesView, citizen), "issue_reporter_created_idx"
+        )
+        self.assert_uses_index(
+            self.view_queryset(IssueListView, AnonymousUser()), "issue_created_idx"
+        )
+
+    def test_escalation_scan_uses_deadline_index(self):
+        self.assert_uses_index(
+            get_overdue_issues(timezone.now()), "issue_escalation_due_idx", False
+        )
+
+
+class EscalateIssuesCommandTests(TestCase):
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.gn = User.objects.create_user(
+            username="gn",
+            password="x",
+            user_type="grama_niladhari",
+            is_approved=True,
+            grama_niladhari_division=gn_division,
+        )
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+        )
+        self.overdue = timezone.now() - timedelta(hours=1)
+
+    def escalate(self, *args):
+        out = StringIO()
+        call_command("escalate_issues", *args, stdout=out)
+        return out.getvalue()
+
+    def test_invalid_batch_size_or_interval_fails(self):
+        for args in [
+            ["--batch-size", "0"],
+            ["--dry-run", "--batch-size", "0"],
+            ["--scheduler", "--resync-interval", "0"],
+            ["--resync-interval", "-5"],
+        ]:
+            with self.subTest(args=args), self.assertRaises(CommandError):
+                self.escalate(*args)
+
+    def test_overdue_issues_are_escalated_in_batches(self):
+        issues = [
+            create_issue(
+                self.divisions,
+                current_handler=self.gn,
+                next_escalation_date=self.overdue,
+            )
+            for _ in range(5)
+        ]
+        not_due = create_issue(self.divisions)
+        # No approved district secretary exists, so this one is deferred
+        at_ds = create_issue(
+            self.divisions,
+            current_level="divisional_secretary",
+            status="in_progress",
+            next_escalation_date=self.overdue,
+        )
+
+        output = self.escalate("--batch-size", "2")
+        self.assertIn("Successfully escalated 5 issues in 3 batches", output)
+
+        for issue in issues:
+            issue.refresh_from_db()
+            self.assertEqual(issue.current_level, "divisional_secretary")
+            self.assertEqual(issue.current_handler, self.ds)
+            self.assertEqual(issue.status, "escalated")
+            self.assertEqual(issue.escalation_count, 1)
+            self.assertGreater(issue.next_escalation_date, timezone.now())
+        escalation = IssueEscalation.objects.get(issue=issues[0])
+        self.assertEqual(escalation.from_user, self.gn)
+        self.assertEqual(escalation.from_level, "grama_niladhari")
+
+        not_due.refresh_from_db()
+        self.assertEqual(not_due.current_level, "grama_niladhari")
+        at_ds.refresh_from_db()
+        self.assertEqual(at_ds.current_level, "divisional_secretary")
+        self.assertGreater(at_ds.next_escalation_date, timezone.now())
+        self.assertEqual(IssueEscalation.objects.count(), 5)
+
+    def test_dry_run_changes_nothing(self):
+        create_issue(self.divisions, next_escalation_date=self.overdue)
+        output = self.escalate("--dry-run")
+        self.assertIn("grama_niladhari -> divisional_secretary", output)
+        self.assertFalse(IssueEscalation.objects.exists())
+
+
+class ConditionalUpdateTests(TestCase):
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+        )
+
+    def test_stale_writer_loses(self):
+        issue = create_issue(self.divisions)
+        first = Issue.objects.get(pk=issue.pk)
+        second = Issue.objects.get(pk=issue.pk)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(first.update_if_current(status="in_progress"))
+        (update,) = [
+            q["sql"] for q in queries if q["sql"].startswith('UPDATE "main_issue"')
+        ]
+        # Only the changed fields are written
+        self.assertNotIn('"title"', update)
+        self.assertEqual(first.version, 1)
+
+        self.assertFalse(second.update_if_current(status="resolved"))
+        self.assertEqual(second.status, "pending")
+        issue.refresh_from_db()
+        self.assertEqual((issue.status, issue.version), ("in_progress", 1))
+
+        # A full save also moves the version on
+        issue.save()
+        self.assertFalse(first.update_if_current(status="resolved"))
+
+    def test_escalation_skips_issues_changed_meanwhile(self):
+        overdue = timezone.now() - timedelta(hours=1)
+        first, second = [
+            create_issue(self.divisions, next_escalation_date=overdue) for _ in range(2)
+        ]
+
+        def respond_to_second(line):
+            # An official responds while the batch is being escalated
+            if first.reference_number in line:
+                issue = Issue.objects.get(pk=second.pk)
+                issue.update_if_current(status="in_progress")
+
+        result = escalate_overdue(log=respond_to_second)
+        self.assertEqual((result["escalated"], result["conflicts"]), (1, 1))
+
+        second.refresh_from_db()
+        self.assertEqual(
+            (second.status, second.current_level), ("in_progress", "grama_niladhari")
+        )
+        self.assertFalse(IssueEscalation.objects.filter(issue=second).exists())
+        self.assertEqual(IssueEscalation.objects.get().issue_id, first.id)
+
+
+class IssueStateMachineTests(SimpleTestCase):
+    now = timezone.now()
+    windows = state_machine.DEFAULT_ESCALATION_DAYS
+
+    def make_issue(self, status, level, **kwargs):
+        fields = {
+            "id": 1,
+            "status": status,
+            "current_level": level,
+            "escalation_count": 0,
+            "pending_extension_count": 0,
+            "max_pending_extensions": 2,
+        }
+        fields.update(kwargs)
+        return SimpleNamespace(**fields)
+
+    def states(self):
+        for action in state_machine.ACTIONS:
+            for status in state_machine.STATUSES:
+                for level in state_machine.LEVELS:
+                    yield action, status, level
+
+    def test_every_state_either_moves_or_is_rejected(self):
+        valid = 0
+        for action, status, level in self.states():
+            issue = self.make_issue(status, level)
+            with self.subTest(action=action, status=status, level=level):
+                if (action, status, level) not in state_machine.TRANSITIONS:
+                    with self.assertRaises(state_machine.InvalidTransition):
+                        state_machine.plan(issue, action, self.now, self.windows, 5, 2)
+                    continue
+                valid += 1
+                changes = state_machine.plan(
+                    issue, action, self.now, self.windows, 5, 2
+                )
+                new_level = changes.get("current_level", level)
+                self.assertIn(changes["status"], state_machine.STATUSES)
+                self.assertNotEqual(changes["status"], "closed")
+
+                # Issues only ever move one level up, counting each move
+                if new_level != level:
+                    self.assertIn(
+                        action, [state_machine.ESCALATE, state_machine.AUTO_ESCALATE]
+                    )
+                    self.assertEqual(new_level, state_machine.get_next_level(level))
+                    self.assertEqual(changes["escalation_count"], 1)
+                    self.assertEqual(changes["current_handler_id"], 5)
+                else:
+                    self.assertNotIn("escalation_count", changes)
+
+                # Only resolved issues stop the escalation timer
+                deadline = changes["next_escalation_date"]
+                if changes["status"] == "resolved":
+                    self.assertIsNone(deadline)
+                    self.assertEqual(changes["resolved_at"], self.now)
+                else:
+                    self.assertGreater(deadline, self.now)
+        self.assertEqual(len(state_machine.TRANSITIONS), valid)
+
+    def test_closed_issues_never_move(self):
+        for action, status, level in self.states():
+            if status == "closed":
+                self.assertNotIn((action, status, level), state_machine.TRANSITIONS)
+
+    def test_escalation_status_is_the_same_on_every_path(self):
+        for status in ["pending", "in_progress", "escalated", "resolved"]:
+            for level in state_machine.LEVELS[:-1]:
+                transition = state_machine.get_transition(
+                    state_machine.ESCALATE, status, level
+                )
+                expected = "pending" if level == "national_ministry" else "escalated"
+                self.assertEqual(transition.status, expected)
+                if state_machine.escalates_automatically(status, level):
+                    self.assertEqual(
+                        state_machine.get_transition(
+                            state_machine.AUTO_ESCALATE, status, level
+                        ),
+                        transition,
+                    )
+        with self.assertRaises(state_machine.InvalidTransition):
+            state_machine.get_transition(
+                state_machine.ESCALATE, "pending", "prime_minister"
+            )
+
+    def test_only_watched_states_escalate_automatically(self):
+        for status in state_machine.STATUSES:
+            for level in state_machine.LEVELS:
+                self.assertEqual(
+                    state_machine.escalates_automatically(status, level),
+                    status in state_machine.AUTO_ESCALATION_STATUSES
+                    and level in state_machine.AUTO_ESCALATION_LEVELS,
+                )
+
+    def test_deadlines_follow_the_level_reached(self):
+        windows = {level: i + 1 for i, level in enumerate(state_machine.LEVELS)}
+        for level in state_machine.LEVELS[:-1]:
+            issue = self.make_issue("pending", level)
+            next_level = state_machine.get_next_level(level)
+            changes = state_machine.plan(
+                issue, state_machine.ESCALATE, self.now, windows, 5
+            )
+            self.assertEqual(
+                changes["next_escalation_date"],
+                self.now + timedelta(days=windows[next_level]),
+            )
+            changes = state_machine.plan(
+                issue, state_machine.RESPOND, self.now, windows
+            )
+            self.assertEqual(
+                changes["next_escalation_date"],
+                self.now + timedelta(days=windows[level]),
+            )
+
+        issue = self.make_issue("in_progress", "grama_niladhari")
+        changes = state_machine.plan(issue, state_machine.DEFER, self.now, windows)
+        self.assertEqual(changes["status"], "in_progress")
+        self.assertEqual(
+            changes["next_escalation_date"], self.now + state_machine.RETRY_DELAY
+        )
+        changes = state_machine.plan(
+            issue, state_machine.EXTEND, self.now, windows, additional_days=4
+        )
+        self.assertEqual(changes["pending_extension_count"], 1)
+        self.assertEqual(changes["next_escalation_date"], self.now + timedelta(days=4))
+
+    def test_response_types_map_to_actions(self):
+        for response_type, additional_days, action in [
+            ("response", None, state_machine.RESPOND),
+            ("pending", None, state_machine.PEND),
+            ("pending", 3, state_machine.EXTEND),
+            ("resolved", None, state_machine.RESOLVE),
+            ("escalate", None, state_machine.ESCALATE),
+        ]:
+            self.assertEqual(
+                state_machine.get_response_action(response_type, additional_days),
+                action,
+            )
+
+    def test_planning_a_large_batch(self):
+        levels = state_machine.AUTO_ESCALATION_LEVELS
+        issues = [
+            self.make_issue(
+                state_machine.AUTO_ESCALATION_STATUSES[i % 2],
+                levels[i % len(levels)],
+                id=i,
+                escalation_count=i % 3,
+            )
+            for i in range(100000)
+        ]
+        handler_ids = {issue.id: issue.id + 1 for issue in issues}
+
+        started = time.monotonic()
+        planned = state_machine.plan_many(
+            issues, state_machine.AUTO_ESCALATE, self.now, self.windows, handler_ids
+        )
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(len(planned), len(issues))
+        for issue, changes in planned[:: len(levels) * 2 + 1]:
+            self.assertEqual(changes["current_handler_id"], issue.id + 1)
+            self.assertEqual(changes["escalation_count"], issue.escalation_count + 1)
+            self.assertEqual(
+                changes["current_level"],
+                state_machine.get_next_level(issue.current_level),
+            )
+        # A pure table lookup per issue; generous so slow CI machines pass
+        self.assertLess(elapsed, 5)
+
+
+class IssueTransitionTests(TestCase):
+    def setUp(self):
+        # The rows created here are rolled back without a signal
+        self.addCleanup(system_settings.invalidate)
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        jurisdiction = {
+            "is_approved": True,
+            "province": province,
+            "district": district,
+            "ds_division": ds_division,
+        }
+        self.gn = User.objects.create_user(
+            username="gn",
+            password="x",
+            user_type="grama_niladhari",
+            grama_niladhari_division=gn_division,
+            **jurisdiction,
+        )
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            **jurisdiction,
+        )
+        self.national = User.objects.create_user(
+            username="national", password="x", user_type="national_ministry"
+        )
+        self.pm = User.objects.create_user(
+            username="pm", password="x", user_type="prime_minister", is_approved=True
+        )
+
+    def respond(self, user, issue, response_type, **data):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(
+            f"/api/issues/{issue.id}/respond/",
+            {"response_type": response_type, "message": "Noted", **data},
+        )
+
+    def test_windows_are_read_from_system_settings(self):
+        SystemSettings.objects.create(key="escalation_days.grama_niladhari", value="5")
+        windows = state_machine.get_escalation_windows()
+        self.assertEqual(windows["grama_niladhari"], 5)
+        self.assertEqual(windows["prime_minister"], 7)
+
+        issue = create_issue(self.divisions, current_handler=self.gn)
+        before = timezone.now()
+        self.assertEqual(self.respond(self.gn, issue, "response").status_code, 201)
+        issue.refresh_from_db()
+        self.assertEqual(issue.status, "in_progress")
+        self.assertGreaterEqual(issue.next_escalation_date, before + timedelta(days=5))
+
+    def test_manual_and_automatic_escalation_agree(self):
+        province = self.divisions[0]
+        provincial = User.objects.create_user(
+            username="provincial",
+            password="x",
+            user_type="provincial_ministry",
+            is_approved=True,
+            province=province,
+        )
+        self.national.is_approved = True
+        self.national.save()
+        # One issue escalated by its handler, one by the overdue job
+        manual, automatic = [
+            create_issue(
+                self.divisions,
+                current_level="provincial_ministry",
+                current_handler=provincial,
+                next_escalation_date=timezone.now() - timedelta(hours=1),
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual(self.respond(provincial, manual, "escalate").status_code, 201)
+        self.assertEqual(escalate_overdue()["escalated"], 1)
+
+        manual.refresh_from_db()
+        automatic.refresh_from_db()
+        for issue in [manual, automatic]:
+            self.assertEqual(
+                (issue.status, issue.current_level, issue.current_handler),
+                ("escalated", "national_ministry", self.national),
+            )
+            self.assertEqual(issue.escalation_count, 1)
+            self.assertEqual(
+                issue.next_escalation_date.date(),
+                (timezone.now() + timedelta(days=7)).date(),
+            )
+
+        # The top level is reached as pending, as there is nowhere further
+        self.assertEqual(
+            self.respond(self.national, manual, "escalate").status_code, 201
+        )
+        manual.refresh_from_db()
+        self.assertEqual(
+            (manual.status, manual.current_level, manual.current_handler),
+            ("pending", "prime_minister", self.pm),
+        )
+
+    def test_invalid_response_is_rejected(self):
+        issue = create_issue(
+            self.divisions, current_level="prime_minister", current_handler=self.pm
+        )
+        response = self.respond(self.pm, issue, "escalate")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IssueResponse.objects.filter(issue=issue).exists())
+
+        issue.refresh_from_db()
+        self.assertEqual(self.respond(self.pm, issue, "resolved").status_code, 201)
+        self.assertEqual(self.respond(self.pm, issue, "resolved").status_code, 400)
+        issue.refresh_from_db()
+        self.assertEqual((issue.status, issue.current_handler), ("resolved", self.pm))
+
+    def test_escalating_a_large_batch(self):
+        overdue = timezone.now() - timedelta(hours=1)
+        province, district, ds_division, gn_division = self.divisions
+        Issue.objects.bulk_create(
+            Issue(
+                reference_number=f"LOAD{i:06d}",
+                reporter_name="Citizen",
+                title="Broken road",
+                description="The main road is broken",
+                province=province,
+                district=district,
+                ds_division=ds_division,
+                grama_niladhari_division=gn_division,
+                status=state_machine.AUTO_ESCALATION_STATUSES[i % 2],
+                current_handler=self.gn,
+                next_escalation_date=overdue,
+            )
+            for i in range(400)
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            result = escalate_overdue(batch_size=500)
+        self.assertEqual(result["escalated"], 400)
+        # One conditional UPDATE per issue and a fixed number of others
+        updates = [q for q in queries if q["sql"].startswith('UPDATE "main_issue"')]
+        self.assertEqual(len(updates), 400)
+        self.assertLess(len(queries) - len(updates), 40)
+        self.assertEqual(
+            Issue.objects.filter(
+                current_level="divisional_secretary", status="escalated"
+            ).count(),
+            400,
+        )
+
+
+class SystemSettingsTests(TestCase):
+    def setUp(self):
+        self.addCleanup(system_settings.invalidate)
+        system_settings.invalidate()
+
+    def test_settings_are_loaded_once_until_changed(self):
+        SystemSettings.objects.create(key="max_pending_extensions", value="4")
+        with self.assertNumQueries(1):
+            self.assertEqual(system_settings.get_int("max_pending_extensions", 2), 4)
+            state_machine.get_escalation_windows()
+            OTPVerification.get_expiry_minutes("sms")
+
+        setting = SystemSettings.objects.get(key="max_pending_extensions")
+        setting.value = "3"
+        setting.save()
+        self.assertEqual(system_settings.get_int("max_pending_extensions", 2), 3)
+        setting.delete()
+        self.assertEqual(system_settings.get_int("max_pending_extensions", 2), 2)
+
+    def test_unusable_values_fall_back_to_the_default(self):
+        SystemSettings.objects.create(key="otp_expiry_minutes.sms", value="soon")
+        SystemSettings.objects.create(key="otp_expiry_minutes.email", value="0")
+        SystemSettings.objects.create(key="otp_expiry_minutes.google_auth", value=" 2 ")
+        with self.assertLogs("main.system_settings", "WARNING"):
+            self.assertEqual(OTPVerification.get_expiry_minutes("sms"), 10)
+            self.assertEqual(OTPVerification.get_expiry_minutes("email"), 10)
+        self.assertEqual(OTPVerification.get_expiry_minutes("google_auth"), 2)
+
+        user = User.objects.create_user(username="citizen", password="x")
+        before = timezone.now()
+        otp = OTPVerification.objects.create(user=user, otp_type="google_auth")
+        self.assertLessEqual(otp.expires_at, timezone.now() + timedelta(minutes=2))
+        self.assertGreaterEqual(otp.expires_at, before + timedelta(minutes=2))
+
+    def test_new_issues_take_the_configured_extension_limit(self):
+        SystemSettings.objects.create(key="max_pending_extensions", value="1")
+        divisions = create_divisions()
+        province, district, ds_division, gn_division = divisions
+        gn = User.objects.create_user(
+            username="gn",
+            password="x",
+            user_type="grama_niladhari",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+            grama_niladhari_division=gn_division,
+        )
+        issue = create_issue(divisions, current_handler=gn)
+        self.assertEqual(issue.max_pending_extensions, 1)
+
+        client = APIClient()
+        client.force_authenticate(gn)
+        # Extensions are counted, the limit is not enforced
+        for _ in range(2):
+            response = client.post(
+                f"/api/issues/{issue.id}/respond/",
+                {
+                    "response_type": "pending",
+                    "message": "Waiting for materials",
+                    "additional_days": 5,
+                },
+            )
+            self.assertEqual(response.status_code, 201)
+        issue.refresh_from_db()
+        self.assertEqual(issue.pending_extension_count, 2)
+
+
+class EscalationSchedulerTests(TestCase):
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+        )
+        self.now = timezone.now()
+        self.scheduler = scheduler.EscalationScheduler()
+
+    def test_only_due_issues_are_escalated(self):
+        due = create_issue(
+            self.divisions, next_escalation_date=self.now - timedelta(minutes=1)
+        )
+        later = create_issue(
+            self.divisions, next_escalation_date=self.now + timedelta(hours=1)
+        )
+        self.scheduler.load(self.now)
+        self.assertEqual(self.scheduler.next_deadline(), due.next_escalation_date)
+
+        self.assertEqual(self.scheduler.run_pending(self.now), 1)
+        due.refresh_from_db()
+        later.refresh_from_db()
+        self.assertEqual(due.current_level, "divisional_secretary")
+        self.assertEqual(later.current_level, "grama_niladhari")
+        self.assertEqual(self.scheduler.next_deadline(), later.next_escalation_date)
+        self.assertEqual(self.scheduler.run_pending(self.now), 0)
+
+    def test_saved_deadlines_reach_the_running_scheduler(self):
+        issue = create_issue(self.divisions)
+        self.scheduler.load(self.now)
+        scheduler._scheduler = self.scheduler
+        try:
+            sooner = self.now + timedelta(minutes=5)
+            with self.captureOnCommitCallbacks(execute=True):
+                issue.next_escalation_date = sooner
+                issue.save()
+            self.assertEqual(self.scheduler.next_deadline(), sooner)
+
+            # Resolved issues no longer escalate
+            with self.captureOnCommitCallbacks(execute=True):
+                issue.status = "resolved"
+                issue.save()
+            self.assertIsNone(self.scheduler.next_deadline())
+        finally:
+            scheduler._scheduler = None
+
+    def test_resync_reads_changes_from_other_processes(self):
+        issue = create_issue(self.divisions)
+        self.scheduler.load(self.now - timedelta(minutes=10))
+        sooner = self.now + timedelta(minutes=1)
+        # update() skips signals, like a write from another process
+        Issue.objects.filter(pk=issue.pk).update(
+            next_escalation_date=sooner, updated_at=self.now
+        )
+        self.scheduler.resync(self.now)
+        self.assertEqual(self.scheduler.next_deadline(), sooner)
+
+    def test_scheduler_recovers_from_a_failed_tick(self):
+        due = create_issue(
+            self.divisions, next_escalation_date=self.now - timedelta(minutes=1)
+        )
+        calls = []
+
+        def escalate(*args, **kwargs):
+            calls.append(kwargs["issue_ids"])
+            if len(calls) == 1:
+                raise DatabaseError("database is down")
+            self.scheduler.stop()
+            return escalate_overdue(*args, **kwargs)
+
+        patches = [
+            mock.patch.object(scheduler, "escalate_overdue", escalate),
+            mock.patch.object(scheduler, "ERROR_BACKOFF", 0),
+            # It would close the test case's connection
+            mock.patch.object(scheduler, "close_old_connections"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        with self.assertLogs("main.scheduler", "ERROR"):
+            self.scheduler.run()
+
+        # The issue taken off the heap by the failed tick was read again
+        self.assertEqual(calls, [[due.id], [due.id]])
+        due.refresh_from_db()
+        self.assertEqual(due.current_level, "divisional_secretary")
+
+    def test_one_process_runs_the_scheduler(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f"{directory.name}/scheduler.lock"
+        with open(path, "a") as held, self.settings(
+            ESCALATION_SCHEDULER_IN_PROCESS=True, ESCALATION_SCHEDULER_LOCK_FILE=path
+        ), mock.patch.object(scheduler, "_lock_file", None), mock.patch.object(
+            scheduler, "start_background_scheduler"
+        ) as start:
+            # Another process holds the lock
+            fcntl.flock(held, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertIsNone(scheduler.autostart())
+            self.assertFalse(start.called)
+
+            fcntl.flock(held, fcntl.LOCK_UN)
+            scheduler.autostart()
+            self.assertTrue(start.called)
+            scheduler._lock_file.close()
+
+
+class RoutingTableTests(TestCase):
+    def setUp(self):
+        routing.invalidate()
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.officials = [
+            User.objects.create_user(
+                username=f"ds{i}",
+                password="x",
+                user_type="divisional_secretary",
+                is_approved=True,
+                province=province,
+                district=district,
+                ds_division=ds_division,
+            )
+            for i in range(2)
+        ]
+        self.issue = create_issue(self.divisions)
+
+    def test_officials_take_turns_without_queries(self):
+        routing.get_table()
+        with self.assertNumQueries(0):
+            picked = [
+                routing.pick_handler("divisional_secretary", self.issue)
+                for _ in range(4)
+            ]
+        first, second = [official.pk for official in self.officials]
+        self.assertEqual(sorted(picked), [first, first, second, second])
+        self.assertIsNone(routing.pick_handler("district_secretary", self.issue))
+
+    def test_routing_changes_invalidate_the_table(self):
+        table = routing.get_table()
+        official = self.officials[0]
+
+        official.last_login = timezone.now()
+        official.save()
+        self.assertIs(routing.get_table(), table)
+
+        official.is_approved = False
+        official.save()
+        picked = {
+            routing.pick_handler("divisional_secretary", self.issue) for _ in range(3)
+        }
+        self.assertEqual(picked, {self.officials[1].pk})
+
+        self.officials[1].delete()
+        self.assertIsNone(routing.pick_handler("divisional_secretary", self.issue))
+
+    def test_other_processes_see_invalidations(self):
+        table = routing.get_table()
+        official = self.officials[0]
+        # Revoked in another process, which bumps the shared version but
+        # cannot clear this process's table
+        User.objects.filter(pk=official.pk).update(is_approved=False)
+        cache.delete(routing.VERSION_CACHE_KEY)
+        picked = {
+            routing.pick_handler("divisional_secretary", self.issue) for _ in range(3)
+        }
+        self.assertEqual(picked, {self.officials[1].pk})
+        self.assertIsNot(routing.get_table(), table)
+
+
+class DashboardStatsTests(TestCase):
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        self.gn = User.objects.create_user(
+            username="gn",
+            password="x",
+            user_type="grama_niladhari",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+            grama_niladhari_division=gn_division,
+        )
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            is_approved=True,
+            province=province,
+            district=district,
+            ds_division=ds_division,
+        )
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+        self.client = APIClient()
+
+    def get_stats(self, user):
+        self.client.force_authenticate(user)
+        return self.client.get("/api/dashboard/stats/").json()
+
+    def assert_counters_match_issues(self):
+        counted = set(
+            stats.IssueStatCounter.objects.exclude(count=0).values_list(
+                "scope", "scope_id", "status", "count"
+            )
+        )
+        stats.rebuild()
+        rebuilt = set(
+            stats.IssueStatCounter.objects.values_list(
+                "scope", "scope_id", "status", "count"
+            )
+        )
+        self.assertEqual(counted, rebuilt)
+
+    def test_counters_follow_issue_changes(self):
+        issues = [
+            create_issue(
+                self.divisions, reporter_user=self.citizen, current_handler=self.gn
+            )
+            for _ in range(3)
+        ]
+        issues[0].status = "resolved"
+        issues[0].save()
+        # A copy loaded without the counted fields still moves its counters
+        partial = Issue.objects.only("id", "status").get(pk=issues[1].pk)
+        partial.current_handler = self.ds
+        partial.save()
+        issues[2].next_escalation_date = timezone.now() - timedelta(minutes=1)
+        issues[2].save()
+        escalate_overdue()
+        create_issue(self.divisions).delete()
+        self.assert_counters_match_issues()
+
+        self.get_stats(self.gn)  # Warm the cached active user count
+        # The counters and the official's own issues
+        with self.assertNumQueries(2):
+            gn_stats = self.get_stats(self.gn)
+        self.assertEqual(
+            gn_stats,
+            {
+                "total_issues": 3,
+                "pending_issues": 1,
+                "resolved_issues": 1,
+                "my_issues": 1,
+                "escalated_issues": 1,
+                "active_users": 3,
+            },
+        )
+        ds_stats = self.get_stats(self.ds)
+        self.assertEqual(ds_stats["my_issues"], 2)
+        citizen_stats = self.get_stats(self.citizen)
+        self.assertEqual(citizen_stats["total_issues"], 3)
+        self.assertEqual(citizen_stats["my_issues"], 3)
+
+    def test_stale_copies_do_not_skew_the_counters(self):
+        issue = create_issue(self.divisions, current_handler=self.gn)
+        first = Issue.objects.get(pk=issue.pk)
+        second = Issue.objects.get(pk=issue.pk)
+        first.status = "in_progress"
+        first.save()
+        second.status = "resolved"
+        second.save()
+        self.assert_counters_match_issues()
+
+        # Refreshed after another save, and saved again
+        Issue.objects.get(pk=issue.pk).update_if_current(status="pending")
+        second.refresh_from_db()
+        second.status = "closed"
+        second.save()
+        self.assert_counters_match_issues()
+
+    def test_counters_do_not_go_negative(self):
+        stats.apply_deltas({("all", 0, "pending"): -1})
+        stats.apply_deltas({("all", 0, "pending"): 1})
+        stats.apply_deltas({("all", 0, "pending"): -2})
+        self.assertEqual(
+            stats.IssueStatCounter.objects.get(scope="all", status="pending").count,
+            0,
+        )
+
+    def test_my_issues_are_those_handled_within_the_jurisdiction(self):
+        province, district, ds_division, gn_division = self.divisions
+        elsewhere = GramaNiladhariDivision.objects.create(
+            name_en="Polhena",
+            name_si="පොල්හේන",
+            name_ta="பொல்ஹேன",
+            ds_division=ds_division,
+        )
+        create_issue(self.divisions, current_handler=self.gn)
+        create_issue(
+            (province, district, ds_division, elsewhere), current_handler=self.gn
+        )
+        self.assertEqual(self.get_stats(self.gn)["my_issues"], 1)
+
+
+class DivisionTreeTests(TestCase):
+    def setUp(self):
+        self.province, self.district, self.ds_division, self.gn_division = (
+            create_divisions()
+        )
+        self.client = APIClient()
+
+    def test_lists_are_served_from_memory(self):
+        self.client.get("/api/divisions/provinces/")
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                f"/api/divisions/gn-divisions/?ds_division={self.ds_division.pk}"
+            )
+        self.assertEqual(response.status_code, 200)
+        [gn_division] = response.json()["results"]
+        self.assertEqual(gn_division["name_si"], "මිරිස්ස")
+        self.assertEqual(gn_division["province_name"], "Southern")
+
+        response = self.client.get(
+            f"/api/divisions/districts/?province={self.province.pk + 1}"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional_requests_and_invalidation(self):
+        response = self.client.get("/api/divisions/provinces/")
+        etag = response["ETag"]
+        self.assertIn("Last-Modified", response)
+        response = self.client.get("/api/divisions/provinces/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.province.name_en = "Southern Province"
+        self.province.save()
+        response = self.client.get("/api/divisions/districts/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(
+            response.json()["results"][0]["province_name"], "Southern Province"
+        )
+
+    def test_search(self):
+        response = self.client.get("/api/divisions/search/?q=මිරි")
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "type": "gn_division",
+                    "id": self.gn_division.pk,
+                    "name_en": "Mirissa",
+                    "name_si": "මිරිස්ස",
+                    "name_ta": "மிரிஸ்ஸ",
+                    "ds_division": "Weligama",
+                    "district": "Matara",
+                    "province": "Southern",
+                }
+            ],
+        )
+        response = self.client.get("/api/divisions/search/?q=ma&type=district")
+        self.assertEqual([row["id"] for row in response.json()], [self.district.pk])
+
+    def test_search_ranking(self):
+        names = ["Kamburupitiya", "Akuressa Kamburugamuwa", "Thihagoda Kamburu"]
+        for name in names:
+            DSDivision.objects.create(
+                name_en=name, name_si=name, name_ta=name, district=self.district
+            )
+        tree = divisions.get_tree()
+        ranked = [row["name_en"] for _, row in tree.search("kamburu")]
+        # Whole-name prefix, then word prefixes ordered by the matching word
+        self.assertEqual(
+            ranked, ["Kamburupitiya", "Thihagoda Kamburu", "Akuressa Kamburugamuwa"]
+        )
+        self.assertEqual(
+            [row["name_en"] for _, row in tree.search("uru")][:1], ["Kamburupitiya"]
+        )
+        # Misspelt queries still find the division
+        self.assertEqual(
+            [row["name_en"] for _, row in tree.search("Mirisa")], ["Mirissa"]
+        )
+
+
+def make_png(width, height):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), "red").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def make_mp4(width, height):
+    def box(box_type, payload):
+        return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+    tkhd = bytes(76) + struct.pack(">II", width << 16, height << 16)
+    return box(b"ftyp", b"isom" + bytes(4)) + box(
+        b"moov", box(b"trak", box(b"tkhd", tkhd))
+    )
+
+
+class AttachmentMetadataTests(TestCase):
+    def setUp(self):
+        self.issue = create_issue(create_divisions())
+
+    def test_metadata_is_recorded_on_upload(self):
+        png = make_png(40, 30)
+        with tempfile.TemporaryDirectory() as media_root, self.settings(
+            MEDIA_ROOT=media_root
+        ):
+            image = IssueAttachment.objects.create(
+                issue=self.issue,
+                # The name and declared type do not decide the MIME type
+                file=SimpleUploadedFile("photo.bin", png, "application/pdf"),
+                attachment_type="image",
+            )
+            video = IssueAttachment.objects.create(
+                issue=self.issue,
+                file=SimpleUploadedFile("clip.mp4", make_mp4(1280, 720)),
+                attachment_type="video",
+            )
+
+        image.refresh_from_db()
+        self.assertEqual(image.file_size, len(png))
+        self.assertEqual(image.mime_type, "image/png")
+        self.assertEqual((image.width, image.height), (40, 30))
+        self.assertEqual(image.checksum, hashlib.sha256(png).hexdigest())
+        video.refresh_from_db()
+        self.assertEqual(video.mime_type, "video/mp4")
+        self.assertEqual((video.width, video.height), (1280, 720))
+
+        # The stored files are gone, rendering only reads the rows
+        response = APIClient().get("/api/issues/")
+        attachments = response.data["results"][0]["attachments"]
+        self.assertEqual({a["file_type"] for a in attachments}, {"image", "video"})
+
+
+class MimeTypeSniffingTests(SimpleTestCase):
+    def test_iso_bmff_brands(self):
+        def ftyp(brand):
+            return struct.pack(">I4s4s", 24, b"ftyp", brand) + bytes(16)
+
+        cases = {
+            b"heic": "image/heic",
+            b"mif1": "image/heif",
+            b"avif": "image/avif",
+            b"qt  ": "video/quicktime",
+            b"isom": "video/mp4",
+            b"mp42": "video/mp4",
+        }
+        for brand, mime_type in cases.items():
+            with self.subTest(brand=brand):
+                self.assertEqual(
+                    attachments.sniff_mime_type(ftyp(brand), "x.mp4"), mime_type
+                )
+
+    def test_bmp_needs_a_valid_header(self):
+        buffer = BytesIO()
+        Image.new("RGB", (4, 4)).save(buffer, "BMP")
+        bmp = buffer.getvalue()
+        self.assertEqual(attachments.sniff_mime_type(bmp[:32], "x"), "image/bmp")
+        self.assertEqual(
+            attachments.sniff_mime_type(b"BM, the initials of a text file", "x.txt"),
+            "text/plain",
+        )
+
+
+class AttachmentBlobTests(TestCase):
+    def setUp(self):
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+        self.issue = create_issue(create_divisions(), reporter_user=self.citizen)
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=self.media_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_identical_uploads_share_a_blob(self):
+        png = make_png(20, 20)
+        first = IssueAttachment.objects.create(
+            issue=self.issue,
+            file=SimpleUploadedFile("a.png", png),
+            attachment_type="image",
+        )
+        second = IssueAttachment.objects.create(
+            issue=self.issue,
+            file=SimpleUploadedFile("b.png", png),
+            attachment_type="image",
+        )
+
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(first.blob, blob)
+        self.assertEqual(second.file.name, blob.file.name)
+        self.assertEqual(second.checksum, hashlib.sha256(png).hexdigest())
+        self.assertTrue(blob.file.storage.exists(blob.file.name))
+
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(AttachmentBlob.objects.exists())
+        self.assertFalse(blob.file.storage.exists(blob.file.name))
+
+    def test_losing_a_store_race_leaves_no_file(self):
+        png = make_png(20, 20)
+        winner = AttachmentBlob.objects.store(SimpleUploadedFile("a.png", png))
+        storage = winner.file.storage
+        directory = os.path.dirname(winner.file.name)
+
+        # The other request had not committed its blob when this one looked
+        exists = FileSystemStorage.exists
+        checks = []
+
+        def first_check_misses(storage, name):
+            checks.append(name)
+            return len(checks) > 1 and exists(storage, name)
+
+        with mock.patch.object(
+            FileSystemStorage, "exists", first_check_misses
+        ), mock.patch("django.db.models.QuerySet.first", return_value=None):
+            blob = AttachmentBlob.objects.store(SimpleUploadedFile("b.png", png))
+
+        self.assertEqual(blob.pk, winner.pk)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(
+            storage.listdir(directory)[1], [os.path.basename(winner.file.name)]
+        )
+
+    def test_upload_is_hashed_while_streaming(self):
+        client = APIClient()
+        client.force_authenticate(self.citizen)
+        png = make_png(20, 20)
+        response = client.post(
+            f"/api/issues/{self.issue.id}/upload/",
+            {"file": SimpleUploadedFile("photo.png", png)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 201)
+        attachment = IssueAttachment.objects.get()
+        self.assertEqual(attachment.checksum, hashlib.sha256(png).hexdigest())
+        self.assertEqual(attachment.blob.file_size, len(png))
+
+    def test_uploads_over_the_limits_are_refused(self):
+        client = APIClient()
+        client.force_authenticate(self.citizen)
+        url = f"/api/issues/{self.issue.id}/upload/"
+
+        with self.settings(ATTACHMENT_MAX_FILE_SIZE=1024):
+            response = client.post(
+                url,
+                {"file": SimpleUploadedFile("big.bin", b"x" * 4096)},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 413)
+
+        # Refused from the Content-Length before the body is read
+        with self.settings(ATTACHMENT_MAX_REQUEST_SIZE=1024):
+            response = client.post(
+                url,
+                {"file": SimpleUploadedFile("big.bin", b"x" * 4096)},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(IssueAttachment.objects.exists())
+        self.assertFalse(AttachmentBlob.objects.exists())
+
+
+class ThumbnailTests(TestCase):
+    def setUp(self):
+        self.issue = create_issue(create_divisions())
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings = self.settings(MEDIA_ROOT=self.media_root.name, THUMBNAIL_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_thumbnails_are_rendered_after_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            attachment = IssueAttachment.objects.create(
+                issue=self.issue,
+                file=SimpleUploadedFile("photo.png", make_png(2000, 1000)),
+                attachment_type="image",
+            )
+
+        blob = AttachmentBlob.objects.get()
+        self.assertEqual(set(blob.thumbnails), {"small", "medium", "preview"})
+        with blob.file.storage.open(blob.thumbnails["small"]) as file:
+            self.assertEqual(Image.open(file).size, (160, 80))
+
+        response = APIClient().get("/api/issues/")
+        data = response.data["results"][0]["attachments"][0]
+        self.assertTrue(data["thumbnail_url"].endswith(blob.thumbnails["medium"]))
+        self.assertEqual(set(data["thumbnails"]), {"small", "medium", "preview"})
+
+        # Thumbnails go with the last reference to the blob
+        with self.captureOnCommitCallbacks(execute=True):
+            attachment.delete()
+        for name in blob.thumbnails.values():
+            self.assertFalse(blob.file.storage.exists(name))
+
+    def test_unreadable_files_have_no_thumbnails(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            IssueAttachment.objects.create(
+                issue=self.issue,
+                file=SimpleUploadedFile("broken.png", b"\x89PNG\r\n\x1a\nbroken"),
+                attachment_type="image",
+            )
+
+        self.assertEqual(AttachmentBlob.objects.get().thumbnails, {})
+        response = APIClient().get("/api/issues/")
+        data = response.data["results"][0]["attachments"][0]
+        self.assertIsNone(data["thumbnail_url"])
+
+    def test_command_renders_missing_thumbnails(self):
+        IssueAttachment.objects.create(
+            issue=self.issue,
+            file=SimpleUploadedFile("photo.png", make_png(40, 30)),
+            attachment_type="image",
+        )
+        self.assertEqual(AttachmentBlob.objects.get().thumbnails, {})
+
+        call_command("generate_thumbnails", stdout=StringIO())
+        self.assertEqual(len(AttachmentBlob.objects.get().thumbnails), 3)
+
+    def test_transparency_is_rendered_white(self):
+        buffer = BytesIO()
+        image = Image.new("RGBA", (200, 100), (0, 0, 0, 0))
+        image.paste((0, 0, 255, 255), (50, 25, 150, 75))
+        image.save(buffer, "PNG")
+        with self.captureOnCommitCallbacks(execute=True):
+            IssueAttachment.objects.create(
+                issue=self.issue,
+                file=SimpleUploadedFile("logo.png", buffer.getvalue()),
+                attachment_type="image",
+            )
+
+        blob = AttachmentBlob.objects.get()
+        with blob.file.storage.open(blob.thumbnails["small"]) as file:
+            thumbnail = Image.open(file)
+            corner = thumbnail.getpixel((0, 0))
+            middle = thumbnail.getpixel((80, 40))
+        self.assertTrue(all(value > 245 for value in corner))
+        self.assertLess(middle[0], 10)
+
+    def test_thumbnails_of_a_blob_released_while_rendering_are_deleted(self):
+        attachment = IssueAttachment.objects.create(
+            issue=self.issue,
+            file=SimpleUploadedFile("photo.png", make_png(40, 30)),
+            attachment_type="image",
+        )
+        blob = AttachmentBlob.objects.get()
+        args, directory = thumbnails.get_job(blob)
+        names = attachments.render_thumbnails(*args)
+        storage = blob.file.storage
+        self.assertTrue(storage.exists(f"{directory}/{names['small']}"))
+
+        # Released before the render is recorded
+        with self.captureOnCommitCallbacks(execute=True):
+            attachment.delete()
+        self.assertEqual(
+            thumbnails.record_thumbnails(blob.pk, blob.checksum, directory, names),
+            {},
+        )
+        for name in names.values():
+            self.assertFalse(storage.exists(f"{directory}/{name}"))
+
+    def test_command_moves_legacy_attachments_into_blobs(self):
+        png = make_png(40, 30)
+        storage = FileSystemStorage()
+        name = storage.save("issue_attachments/old.png", BytesIO(png))
+        attachment = IssueAttachment.objects.create(
+            issue=self.issue, file=name, attachment_type="image"
+        )
+        self.assertIsNone(attachment.blob)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("generate_thumbnails", "--legacy", stdout=StringIO())
+
+        attachment.refresh_from_db()
+        blob = attachment.blob
+        self.assertEqual(attachment.file.name, blob.file.name)
+        self.assertEqual(attachment.checksum, hashlib.sha256(png).hexdigest())
+        self.assertEqual((attachment.width, attachment.height), (40, 30))
+        self.assertEqual(blob.ref_count, 1)
+        self.assertEqual(len(blob.thumbnails), 3)
+        self.assertFalse(storage.exists(name))
+
+
+@override_settings(NOTIFICATION_WORKERS=0)
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.divisions = create_divisions()
+        province, district, ds_division, gn_division = self.divisions
+        jurisdiction = {
+            "is_approved": True,
+            "province": province,
+            "district": district,
+            "ds_division": ds_division,
+        }
+        self.gn = User.objects.create_user(
+            username="gn",
+            password="x",
+            user_type="grama_niladhari",
+            grama_niladhari_division=gn_division,
+            **jurisdiction,
+        )
+        self.ds = User.objects.create_user(
+            username="ds",
+            password="x",
+            user_type="divisional_secretary",
+            **jurisdiction,
+        )
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+
+    def test_response_notifies_the_reporter(self):
+        issue = create_issue(
+            self.divisions, reporter_user=self.citizen, current_handler=self.gn
+        )
+        client = APIClient()
+        client.force_authenticate(self.gn)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                f"/api/issues/{issue.id}/respond/",
+                {"response_type": "resolved", "message": "Repaired"},
+            )
+        self.assertEqual(response.status_code, 201)
+
+        notification = Notification.objects.get()
+        self.assertEqual(notification.user, self.citizen)
+        self.assertEqual(notification.notification_type, "issue_resolved")
+        self.assertEqual(notification.issue, issue)
+
+    def test_escalation_notifies_in_one_insert(self):
+        overdue = timezone.now() - timedelta(hours=1)
+        for _ in range(3):
+            create_issue(
+                self.divisions,
+                reporter_user=self.citizen,
+                current_handler=self.gn,
+                next_escalation_date=overdue,
+            )
+        # No district secretary to escalate to, so its handler is reminded
+        stuck = create_issue(
+            self.divisions,
+            current_level="divisional_secretary",
+            current_handler=self.ds,
+            next_escalation_date=overdue,
+        )
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            escalate_overdue()
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks:
+                callback()
+        inserts = [q for q in queries if q["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 2)
+
+        escalated = Notification.objects.filter(notification_type="issue_escalated")
+        self.assertEqual(escalated.filter(user=self.citizen).count(), 3)
+        self.assertEqual(escalated.filter(user=self.ds).count(), 3)
+        self.assertIn("Divisional Secretary", escalated.first().message)
+        reminder = Notification.objects.get(notification_type="reminder")
+        self.assertEqual((reminder.user, reminder.issue), (self.ds, stuck))
+
+    def test_queued_events_are_coalesced(self):
+        issue = create_issue(self.divisions, current_handler=self.gn)
+        dispatcher = notifications.NotificationDispatcher()
+        delivered = []
+        dispatcher.worker = BackgroundWorker("test", delivered.extend)
+        event = notifications.Event("new_issue", issue.id, None)
+
+        self.assertTrue(dispatcher.enqueue(event))
+        self.assertFalse(dispatcher.enqueue(event))
+        dispatcher.flush()
+        dispatcher.worker.stop()
+        self.assertEqual(delivered, [event])
+
+
+class NotificationInboxTests(TestCase):
+    def setUp(self):
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+        self.issue = create_issue(create_divisions(), reporter_user=self.citizen)
+        self.other_issue = create_issue(create_divisions())
+        self.client = APIClient()
+        self.client.force_authenticate(self.citizen)
+        cache.clear()
+
+    def add_notifications(self, issue, count):
+        return [
+            Notification.objects.create(
+                user=self.citizen,
+                notification_type="issue_response",
+                title="Update",
+                message="Update",
+                issue=issue,
+            )
+            for _ in range(count)
+        ]
+
+    def unread_count(self):
+        response = self.client.get("/api/notifications/unread-count/")
+        return response.data["unread_count"]
+
+    def test_unread_count_is_cached(self):
+        self.add_notifications(self.issue, 3)
+        self.assertEqual(self.unread_count(), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.unread_count(), 3)
+        self.add_notifications(self.issue, 1)
+        self.assertEqual(self.unread_count(), 4)
+
+    def test_bulk_mark_read_is_one_update(self):
+        first, second, third = self.add_notifications(self.issue, 3)
+        self.add_notifications(self.other_issue, 2)
+
+        with self.assertNumQueries(1):
+            notifications.mark_read(self.citizen, ids=[first.id, second.id])
+        self.assertEqual(self.unread_count(), 3)
+
+        response = self.client.post(
+            "/api/notifications/mark-read/", {"issue": self.issue.id}, format="json"
+        )
+        self.assertEqual(response.data, {"updated": 1, "unread_count": 2})
+
+        response = self.client.post(
+            "/api/notifications/mark-read/",
+            {"before": timezone.now().isoformat()},
+            format="json",
+        )
+        self.assertEqual(response.data, {"updated": 2, "unread_count": 0})
+
+        response = self.client.post("/api/notifications/mark-read/", {}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_mark_single_notification_read(self):
+        (notification,) = self.add_notifications(self.issue, 1)
+        url = f"/api/notifications/{notification.id}/read/"
+        self.assertEqual(self.client.post(url).status_code, 200)
+        # Marking it again is not an error
+        self.assertEqual(self.client.post(url).status_code, 200)
+        self.assertEqual(self.unread_count(), 0)
+
+        other = User.objects.create_user(username="other", password="x")
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.post(url).status_code, 404)
+
+    def test_unread_count_uses_index(self):
+        plan = Notification.objects.filter(user=self.citizen, is_read=False).explain()
+        self.assertIn("notification_unread_idx", plan)
+
+
+class BackgroundWorkerTests(SimpleTestCase):
+    def test_items_are_handled_in_batches(self):
+        batches = []
+        worker = BackgroundWorker("test", batches.append, batch_size=10, linger=1)
+        for i in range(25):
+            worker.put(i)
+        worker.flush()
+        worker.stop()
+        self.assertEqual([item for batch in batches for item in batch], list(range(25)))
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertLess(len(batches), 25)
+
+
+class CountingEmailBackend(locmem.EmailBackend):
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return super().open()
+
+
+class FlakySMSBackend(otp_delivery.FileSMSBackend):
+    """Fails its first send"""
+
+    failures = 1
+
+    def send(self, recipient, body):
+        if FlakySMSBackend.failures:
+            FlakySMSBackend.failures -= 1
+            raise ConnectionError("SMS API unavailable")
+        super().send(recipient, body)
+
+
+@override_settings(OTP_DELIVERY_WORKERS=1)
+class OTPDeliveryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.sms_file = f"{directory.name}/sms.log"
+        self.user = User.objects.create_user(
+            username="citizen",
+            password="x",
+            email="citizen@example.com",
+            phone="+94771234567",
+        )
+
+    def read_sms(self):
+        try:
+            with open(self.sms_file, encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    @override_settings(EMAIL_BACKEND="main.tests.CountingEmailBackend")
+    def test_emails_are_sent_in_the_background_over_one_connection(self):
+        CountingEmailBackend.opened = 0
+        otps = [
+            OTPVerification.objects.create(user=self.user, otp_type="email")
+            for _ in range(3)
+        ]
+        client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/api/auth/resend-otp/", {"otp_id": otps[0].id})
+            self.assertEqual(response.status_code, 200)
+            # Nothing is sent before the response
+            self.assertEqual(mail.outbox, [])
+            for otp in otps[1:]:
+                otp_delivery.send_otp(otp)
+        otp_delivery.delivery_queue.flush()
+
+        self.assertEqual(len(mail.outbox), 3)
+        otps[0].refresh_from_db()
+        self.assertEqual(mail.outbox[0].subject, "GovSol - Your New OTP Code")
+        self.assertIn(otps[0].otp_code, mail.outbox[0].body)
+        self.assertIn("expire in 10 minutes", mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, ["citizen@example.com"])
+        self.assertEqual(CountingEmailBackend.opened, 1)
+
+    def test_failed_sms_is_retried(self):
+        FlakySMSBackend.failures = 1
+        otp = OTPVerification.objects.create(user=self.user, otp_type="sms")
+        with self.settings(
+            SMS_BACKEND="main.tests.FlakySMSBackend", SMS_FILE_PATH=self.sms_file
+        ), mock.patch.object(otp_delivery, "RETRY_DELAYS", [0.01]):
+            with self.assertLogs("main.otp_delivery", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    otp_delivery.send_otp(otp)
+                otp_delivery.delivery_queue.flush()
+
+            deadline = time.monotonic() + 5
+            while not self.read_sms() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            otp_delivery.delivery_queue.flush()
+
+        sent = self.read_sms()
+        self.assertIn("SMS to +94771234567", sent)
+        self.assertIn(f"Your GovSol OTP code is: {otp.otp_code}", sent)
+        self.assertEqual(sent.count("SMS to"), 1)
+
+    @override_settings(OTP_DELIVERY_WORKERS=0)
+    def test_inline_delivery(self):
+        otp = OTPVerification.objects.create(user=self.user, otp_type="sms")
+        with self.settings(
+            SMS_BACKEND="main.otp_delivery.FileSMSBackend",
+            SMS_FILE_PATH=self.sms_file,
+        ):
+            with self.captureOnCommitCallbacks(execute=True):
+                otp_delivery.send_otp(otp, resend=True)
+        self.assertIn(f"Your new GovSol OTP code is: {otp.otp_code}", self.read_sms())
+
+
+@override_settings(QR_CODE_WORKERS=0)
+class QRCodeTests(TestCase):
+    uri = "otpauth://totp/GovSol:official%40example.com?secret=JBSWY3DPEHPK3PXP"
+
+    def test_svg_draws_every_dark_module(self):
+        code = qrcode.QRCode(
+            border=4, error_correction=qrcode.constants.ERROR_CORRECT_M
+        )
+        code.add_data(self.uri)
+        code.make(fit=True)
+        matrix = code.get_matrix()
+
+        svg = ElementTree.fromstring(qr_codes.render_svg(self.uri))
+        self.assertEqual(svg.get("viewBox"), f"0 0 {len(matrix)} {len(matrix)}")
+        path = svg.find("{http://www.w3.org/2000/svg}path").get("d")
+        drawn = set()
+        for x, y, length in re.findall(r"M(\d+) (\d+)\.5h(\d+)", path):
+            drawn.update((int(y), int(x) + i) for i in range(int(length)))
+        dark = {
+            (y, x)
+            for y, row in enumerate(matrix)
+            for x, value in enumerate(row)
+            if value
+        }
+        self.assertEqual(drawn, dark)
+
+    def test_codes_are_rendered_in_the_pool(self):
+        expected = qr_codes.to_data_uri(qr_codes.render_svg(self.uri))
+        with mock.patch.object(qr_codes, "_executor", None):
+            with self.settings(QR_CODE_WORKERS=1):
+                try:
+                    self.assertEqual(qr_codes.get_qr_code(self.uri), expected)
+                    self.assertIsNotNone(qr_codes._executor)
+                finally:
+                    if qr_codes._executor is not None:
+                        qr_codes._executor.shutdown()
+
+    def test_setup_otp_returns_svg(self):
+        user = User.objects.create_user(
+            username="official", password="x", email="official@example.com"
+        )
+        GoogleAuthUser.objects.create(
+            user=user, google_id="g-1", google_email="official@example.com"
+        )
+        attempt = LoginAttempt.objects.create(
+            email="official@example.com",
+            google_id="g-1",
+            ip_address="127.0.0.1",
+            is_successful=True,
+        )
+        response = APIClient().post(
+            "/api/auth/setup-otp/",
+            {"session_id": attempt.id, "otp_type": "google_auth"},
+        )
+        self.assertEqual(response.status_code, 200)
+        otp = OTPVerification.objects.get(id=response.data["otp_id"])
+        self.assertEqual(
+            response.data["qr_code"], qr_codes.get_qr_code(otp.get_qr_code_url())
+        )
+        svg = base64.b64decode(response.data["qr_code"].split(",", 1)[1])
+        self.assertTrue(svg.startswith(b"<svg"))
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        rates = {"auth_ip": "5/min", "auth_account": "3/min", "auth_session": "3/min"}
+        rest_framework = {**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        override = self.settings(REST_FRAMEWORK=rest_framework)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+
+    def test_account_is_throttled_before_any_query(self):
+        for _ in range(3):
+            response = self.client.post(
+                "/api/auth/check-email/", {"email": "Someone@example.com"}
+            )
+            self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.post(
+                "/api/auth/check-email/", {"email": " someone@example.com"}
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+        response = self.client.post(
+            "/api/auth/check-email/", {"email": "other@example.com"}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch("sys.stdout", new_callable=StringIO)
+    def test_session_is_throttled(self, stdout):
+        payload = {"session_id": 1, "otp_id": 1, "otp_code": "000000"}
+        for _ in range(3):
+            response = self.client.post("/api/auth/verify-otp/", payload)
+            self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(0):
+            response = self.client.post("/api/auth/verify-otp/", payload)
+        self.assertEqual(response.status_code, 429)
+
+        response = self.client.post(
+            "/api/auth/verify-otp/", {**payload, "session_id": 2}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_ip_is_throttled_across_accounts(self):
+        for i in range(5):
+            response = self.client.post(
+                "/api/auth/login/", {"username": f"user{i}", "password": "x"}
+            )
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            "/api/auth/login/", {"username": "user9", "password": "x"}
+        )
+        self.assertEqual(response.status_code, 429)
+
+        response = self.client.post(
+            "/api/auth/login/",
+            {"username": "user9", "password": "x"},
+            REMOTE_ADDR="10.0.0.2",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch.object(throttles.SlidingWindowThrottle, "timer", lambda self: 60.0)
+    def test_forwarded_for_is_trusted_only_from_proxies(self):
+        usernames = iter(range(100))
+
+        def login(forwarded_for, **extra):
+            return self.client.post(
+                "/api/auth/login/",
+                {"username": f"user{next(usernames)}", "password": "x"},
+                HTTP_X_FORWARDED_FOR=forwarded_for,
+                **extra,
+            ).status_code
+
+        # Spoofed values share the bucket of the address that sent them
+        statuses = [login(f"10.1.0.{i}") for i in range(6)]
+        self.assertEqual(statuses, [400] * 5 + [429])
+
+        # Behind one proxy, the right-most entry is the one it added
+        rest_framework = {**settings.REST_FRAMEWORK, "NUM_PROXIES": 1}
+        with self.settings(REST_FRAMEWORK=rest_framework):
+            statuses = [
+                login(f"10.1.0.{i}, 192.0.2.1", REMOTE_ADDR="10.0.0.9")
+                for i in range(6)
+            ]
+            self.assertEqual(statuses, [400] * 5 + [429])
+            self.assertEqual(login("192.0.2.2", REMOTE_ADDR="10.0.0.9"), 400)
+
+    def test_window_slides(self):
+        request = SimpleNamespace(META={"REMOTE_ADDR": "10.0.0.1"})
+        start = 1_000_000 * 60
+
+        def allowed(at):
+            with mock.patch.object(
+                throttles.SlidingWindowThrottle, "timer", lambda self: start + at
+            ):
+                throttle = throttles.IPThrottle()
+                return throttle.allow_request(request, None), throttle
+
+        self.assertEqual([allowed(30)[0] for _ in range(6)], [True] * 5 + [False])
+        # A quarter into the next window, 3.75 of the previous 5 still count
+        self.assertEqual([allowed(75)[0] for _ in range(3)], [True, True, False])
+        # Until 2 of the previous 5 count
+        self.assertAlmostEqual(allowed(75)[1].wait(), 9)
+        # Three quarters in, 1.25 still count
+        self.assertEqual([allowed(105)[0] for _ in range(4)], [True] * 2 + [False] * 2)
+
+
+class GoogleTokenTests(TestCase):
+    audience = "client-id"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Small keys, generating them dominates the run time
+        cls.server = KeyServer(key_count=1, bits=1024).start()
+        cls.addClassCleanup(cls.server.stop)
+
+    def setUp(self):
+        self.verifier = google_tokens.TokenVerifier(self.audience, self.server.url)
+        self.fetched = self.server.requests
+
+    def fetches(self):
+        return self.server.requests - self.fetched
+
+    def test_benchmark_needs_a_token(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark_google_auth", "--tokens", "0", stdout=StringIO())
+
+    def test_keys_are_fetched_once(self):
+        tokens = [self.server.sign(self.audience, sub=str(i)) for i in range(20)]
+        for token in tokens + tokens:
+            self.assertEqual(
+                self.verifier.verify(token)["sub"],
+                str(tokens.index(token)),
+            )
+        self.assertEqual(self.fetches(), 1)
+        self.assertEqual(len(self.verifier.verified), 20)
+
+    def test_rotated_keys_are_fetched(self):
+        self.verifier.verify(self.server.sign(self.audience))
+        # A while later, Google starts signing with a new key
+        self.verifier.certificates.fetched_at -= google_tokens.MIN_REFRESH_INTERVAL
+        key_id = self.server.add_key()
+        self.addCleanup(self.server.certs.pop, key_id)
+        self.addCleanup(self.server.signers.pop, key_id)
+        self.verifier.verify(self.server.sign(self.audience, key_id=key_id))
+        self.assertEqual(self.fetches(), 2)
+
+        # Unknown key ids do not make every request fetch the keys
+        header = json.dumps({"alg": "RS256", "typ": "JWT", "kid": "unknown"})
+        header = base64.urlsafe_b64encode(header.encode()).decode().rstrip("=")
+        token = self.server.sign(self.audience)
+        with self.assertRaises(ValueError):
+            self.verifier.verify(header + token[token.index(".") :])
+        self.assertEqual(self.fetches(), 2)
+
+    def test_invalid_tokens_are_rejected(self):
+        invalid = [
+            self.server.sign("someone-else"),
+            self.server.sign(self.audience, iss="https://evil.example.com"),
+            self.server.sign(self.audience, lifetime=-600),
+            self.server.sign(self.audience)[:-4] + "AAAA",
+            "not-a-token",
+        ]
+        for token in invalid:
+            with self.subTest(token=token[:20]), self.assertRaises(ValueError):
+                self.verifier.verify(token)
+        self.assertEqual(self.verifier.verified, {})
+
+    def test_keys_are_kept_when_a_refresh_fails(self):
+        token = self.server.sign(self.audience)
+        self.verifier.verify(token)
+        self.verifier.verified.clear()
+        # The certificate endpoint goes away and the keys expire
+        self.verifier.certificates.url = "http://127.0.0.1:9/certs"
+        self.verifier.certificates.expires_at = 0
+        self.assertEqual(self.verifier.verify(token)["aud"], self.audience)
+
+    def test_google_login(self):
+        client = APIClient()
+        with self.settings(
+            GOOGLE_OAUTH2_CLIENT_ID=self.audience,
+            GOOGLE_OAUTH2_CERTS_URL=self.server.url,
+        ):
+            response = client.post(
+                "/api/auth/google/",
+                {"credential": self.server.sign(self.audience, name="Citizen")},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data["user"]["email"], "citizen@example.com")
+            session = LoginAttempt.objects.get()
+            self.assertEqual(response.data["session_id"], session.id)
+
+            response = client.post(
+                "/api/auth/google/", {"credential": self.server.sign("other")}
+            )
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(LOGIN_AUDIT_WORKERS=0)
+    def test_google_login_to_existing_account_is_audited(self):
+        User.objects.create_user(
+            username="citizen", password="x", email="citizen@example.com"
+        )
+        with self.settings(
+            GOOGLE_OAUTH2_CLIENT_ID=self.audience,
+            GOOGLE_OAUTH2_CERTS_URL=self.server.url,
+        ), mock.patch("sys.stdout", new_callable=StringIO):
+            response = APIClient().post(
+                "/api/auth/google/", {"credential": self.server.sign(self.audience)}
+            )
+        self.assertEqual(response.status_code, 400)
+        attempt = LoginAttempt.objects.get()
+        self.assertEqual(attempt.email, "citizen@example.com")
+        self.assertEqual(attempt.ip_address, "127.0.0.1")
+        self.assertFalse(attempt.is_successful)
+
+
+class LoginAuditTests(TestCase):
+    def attempt(self, ip_address, days_ago, **fields):
+        attempt = LoginAttempt.objects.create(
+            email="citizen@example.com", ip_address=ip_address, **fields
+        )
+        LoginAttempt.objects.filter(id=attempt.id).update(
+            attempt_time=timezone.now() - timedelta(days=days_ago)
+        )
+        return attempt
+
+    def test_attempts_are_written_in_batches(self):
+        worker = BackgroundWorker("login-audit-test", login_audit.write, batch_size=500)
+        self.addCleanup(worker.stop)
+        with mock.patch.object(login_audit, "worker", worker), mock.patch.object(
+            LoginAttempt.objects, "bulk_create"
+        ) as bulk_create:
+            # Queued before the thread starts, so they are one batch
+            with mock.patch.object(worker, "start"):
+                for i in range(3):
+                    login_audit.record("citizen@example.com", f"10.0.0.{i}")
+            worker.start()
+            login_audit.flush()
+        written = [a for call in bulk_create.call_args_list for a in call.args[0]]
+        self.assertEqual(
+            [a.ip_address for a in written], ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
+        )
+        self.assertEqual(bulk_create.call_count, 1)
+
+    def test_session_is_verified_once(self):
+        attempt = self.attempt("10.0.0.1", 0, is_successful=True)
+        self.assertTrue(login_audit.mark_otp_verified(attempt))
+        self.assertFalse(login_audit.mark_otp_verified(attempt))
+        attempt.refresh_from_db()
+        self.assertTrue(attempt.otp_verified)
+
+    def test_old_attempts_are_folded_into_summaries(self):
+        old = (timezone.localdate() - timedelta(days=40)).isoformat()
+        for _ in range(3):
+            self.attempt("10.0.0.1", 40)
+        self.attempt("10.0.0.1", 40, is_successful=True, otp_verified=True)
+        self.attempt("10.0.0.2", 40, is_successful=True)
+        self.attempt("10.0.0.1", 35)
+        kept = self.attempt("10.0.0.1", 5)
+        # Left by an earlier run
+        LoginAttemptSummary.objects.create(day=old, ip_address="10.0.0.2", attempts=2)
+
+        SystemSettings.objects.create(key="login_attempt_retention_days", value="30")
+        self.addCleanup(system_settings.invalidate)
+        out = StringIO()
+        call_command("compact_login_attempts", stdout=out)
+        self.assertIn("Folded 6 login attempts", out.getvalue())
+
+        self.assertEqual(
+            list(LoginAttempt.objects.values_list("id", flat=True)), [kept.id]
+        )
+        summaries = {
+            (str(s.day), s.ip_address): (s.attempts, s.successful, s.otp_verified)
+            for s in LoginAttemptSummary.objects.all()
+        }
+        day = (timezone.localdate() - timedelta(days=35)).isoformat()
+        self.assertEqual(
+            summaries,
+            {
+                (old, "10.0.0.1"): (4, 1, 1),
+                (old, "10.0.0.2"): (3, 1, 0),
+                (day, "10.0.0.1"): (1, 0, 0),
+            },
+        )
+
+        # Nothing is left to fold
+        self.assertEqual(login_audit.compact(), 0)
+        self.assertEqual(login_audit.compact(days=1), 1)
+
+    def test_invalid_retention_fails(self):
+        with self.assertRaises(CommandError):
+            call_command("compact_login_attempts", "--days", "0", stdout=StringIO())
+
+
+class LiveEventTests(TestCase):
+    def setUp(self):
+        self.citizen = User.objects.create_user(username="citizen", password="x")
+        self.issue = create_issue(create_divisions(), reporter_user=self.citizen)
+
+    def resolve_issue(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.issue.status = "resolved"
+            self.issue.save()
+
+    def read_stream(self, path, **extra):
+        """The first event after the stream opened and the issue was resolved"""
+
+        async def read():
+            response = await AsyncClient().get(path, **extra)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            content = aiter(response.streaming_content)
+            try:
+                retry = await asyncio.wait_for(anext(content), 5)
+                self.assertTrue(retry.startswith(b"retry:"))
+                await sync_to_async(self.resolve_issue)()
+                return (await asyncio.wait_for(anext(content), 5)).decode()
+            finally:
+                await content.aclose()
+
+        return async_to_sync(read)()
+
+    def test_issue_stream_receives_status_changes(self):
+        message = self.read_stream(f"/api/issues/{self.issue.id}/events/")
+        self.assertIn("event: status\n", message)
+        data = json.loads(message.split("data: ")[1])
+        self.assertEqual((data["issue"], data["status"]), (self.issue.id, "resolved"))
+
+    def test_user_stream_needs_a_token(self):
+        response = async_to_sync(AsyncClient().get)("/api/events/")
+        self.assertEqual(response.status_code, 401)
+
+        token = str(AccessToken.for_user(self.citizen))
+        message = self.read_stream(f"/api/events/?token={token}")
+        self.assertIn("event: status\n", message)
+
+    def test_missed_events_are_replayed(self):
+        broker = events.LocalBroker()
+        first = broker.publish(["issue:1"], "status", {"status": "pending"})
+        broker.publish(["issue:2"], "status", {"status": "pending"})
+        broker.publish(["issue:1"], "status", {"status": "resolved"})
+
+        async def replay():
+            subscription = broker.subscribe(["issue:1"], last_event_id=first)
+            message = await subscription.get(timeout=1)
+            broker.unsubscribe(subscription)
+            return message, await subscription.get(timeout=0)
+
+        message, rest = async_to_sync(replay)()
+        self.assertIn('"resolved"', message)
+        self.assertIsNone(rest)
+        self.assertEqual(broker.subscribers, {})
+
+    def test_streams_need_the_asgi_server(self):
+        response = self.client.get(f"/api/issues/{self.issue.id}/events/")
+        self.assertEqual(response.status_code, 501)
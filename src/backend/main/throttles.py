@@ -0,0 +1,124 @@
+"""
+Rate limits for the login endpoints.
+
+Password and OTP checks, email lookups and Google sign-ins accept
+anonymous requests, and each attempt costs a password hash or a
+LoginAttempt row. The throttles here run before the view, so a
+credential-stuffing burst is turned away with a 429 before any query or
+hash.
+
+Each throttle counts requests per client IP, per account (the email or
+username posted) or per login session, in a sliding window: the count of
+the current fixed window plus the previous window's count weighted by how
+much of it still overlaps the last ``duration`` seconds. That takes two
+counters per key, read with one get_many() and bumped with incr(), rather
+than the list of timestamps DRF's own throttles rewrite on every request.
+
+The client IP is the one DRF's get_ident() trusts: REMOTE_ADDR, or behind
+NUM_PROXIES reverse proxies the address the outermost of them saw, read
+from the right of X-Forwarded-For. The left of that header is whatever
+the client sent, so counting by it would give each forged value its own
+budget.
+
+Rates are the ``auth_ip``, ``auth_account`` and ``auth_session`` entries
+of DEFAULT_THROTTLE_RATES. Counters live in the default cache; with the
+local memory cache each process counts on its own, so a shared cache such
+as Redis makes the limits apply across processes.
+"""
+
+import hashlib
+
+from rest_framework.settings import api_settings
+from rest_framework.throttling import SimpleRateThrottle
+
+
+class SlidingWindowThrottle(SimpleRateThrottle):
+    cache_format = "throttle:{scope}:{ident}"
+
+    def get_rate(self):
+        # Read on every request rather than at import, so that changes to
+        # REST_FRAMEWORK, as the tests make, take effect
+        return api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+
+    def get_ident_value(self, request):
+        """What to count requests by, or None to not throttle the request"""
+        raise NotImplementedError
+
+    def get_cache_key(self, request, view):
+        ident = self.get_ident_value(request)
+        if not ident:
+            return None
+        # Hashed, as the cache may not accept whatever a client posts
+        ident = hashlib.sha256(ident.encode()).hexdigest()[:32]
+        return self.cache_format.format(scope=self.scope, ident=ident)
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        now = self.timer()
+        window, offset = divmod(now, self.duration)
+        current_key = f"{self.key}:{int(window)}"
+        previous_key = f"{self.key}:{int(window) - 1}"
+        counts = self.cache.get_many([current_key, previous_key])
+        self.current = counts.get(current_key, 0)
+        self.previous = counts.get(previous_key, 0)
+        self.elapsed = offset / self.duration
+
+        if self.previous * (1 - self.elapsed) + self.current >= self.num_requests:
+            return False
+
+        # Kept for two windows, while it is the current or previous one
+        if not self.cache.add(current_key, 1, self.duration * 2):
+            try:
+                self.cache.incr(current_key)
+            except ValueError:
+                # Expired between add() and incr()
+                self.cache.set(current_key, 1, self.duration * 2)
+        return True
+
+    def wait(self):
+        # Until the previous window's weight has fallen enough, or else
+        # until the current window is over
+        remaining = (1 - self.elapsed) * self.duration
+        allowance = self.num_requests - self.current
+        if self.previous and allowance > 0:
+            remaining = min(
+                remaining,
+                (1 - allowance / self.previous - self.elapsed) * self.duration,
+            )
+        return max(remaining, 0)
+
+
+def get_field(request, name):
+    """A posted string field, or None"""
+    data = request.data if hasattr(request.data, "get") else {}
+    value = data.get(name)
+    if isinstance(value, int):
+        value = str(value)
+    return value.strip() if isinstance(value, str) else None
+
+
+class IPThrottle(SlidingWindowThrottle):
+    scope = "auth_ip"
+
+    def get_ident_value(self, request):
+        return self.get_ident(request)
+
+
+class AccountThrottle(SlidingWindowThrottle):
+    scope = "auth_account"
+
+    def get_ident_value(self, request):
+        account = get_field(request, "email") or get_field(request, "username")
+        return account and account.lower()
+
+
+class SessionThrottle(SlidingWindowThrottle):
+    scope = "auth_session"
+
+    def get_ident_value(self, request):
+        return get_field(request, "session_id")
@@ -0,0 +1,140 @@
+"""
+Background thumbnail pipeline for attachment blobs.
+
+Every new image or video blob is handed to schedule() once its row is
+committed (see signals.py). The resizing runs in a pool of
+THUMBNAIL_WORKERS processes, so neither the upload request nor the web
+process's GIL pays for decoding multi-megabyte photos. When a worker
+finishes, the names of the variants are stored on the blob and the
+serializers start returning thumbnail URLs instead of null; until then,
+clients fall back to the original file.
+
+Thumbnails are stored once per blob, named after its checksum, so
+attachments sharing a file share its thumbnails too. With THUMBNAIL_WORKERS
+= 0 they are rendered inline, which is what the tests and
+``manage.py generate_thumbnails`` use. Attachments uploaded before blobs
+have none until ``manage.py generate_thumbnails --legacy`` moves their
+files into blobs with adopt().
+"""
+
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+
+from .attachments import render_thumbnails
+from .models import AttachmentBlob
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIRECTORY = "thumbnails"
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Spawned rather than forked: the web process has threads and
+            # open database connections that a forked child must not share
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def has_thumbnails(mime_type):
+    return mime_type.startswith(("image/", "video/"))
+
+
+def get_job(blob):
+    """Arguments of render_thumbnails() for a blob"""
+    storage = blob.file.storage
+    directory = f"{THUMBNAIL_DIRECTORY}/{blob.checksum[:2]}"
+    return (
+        storage.path(blob.file.name),
+        blob.mime_type,
+        storage.path(directory),
+        blob.checksum,
+    ), directory
+
+
+def record_thumbnails(blob_id, checksum, directory, names):
+    thumbnails = {variant: f"{directory}/{name}" for variant, name in names.items()}
+    if AttachmentBlob.objects.filter(pk=blob_id).update(thumbnails=thumbnails):
+        return thumbnails
+    # The blob was released while rendering. Its thumbnails are named after
+    # its checksum, so keep them if the same content was stored again.
+    if not AttachmentBlob.objects.filter(checksum=checksum).exists():
+        for name in thumbnails.values():
+            default_storage.delete(name)
+    return {}
+
+
+def generate(blob):
+    """Render the thumbnails of a blob in this process"""
+    args, directory = get_job(blob)
+    blob.thumbnails = record_thumbnails(
+        blob.pk, blob.checksum, directory, render_thumbnails(*args)
+    )
+    return blob.thumbnails
+
+
+def finish(blob_id, checksum, directory, future):
+    # Runs on the executor's management thread
+    try:
+        names = future.result()
+    except Exception:
+        logger.exception("Rendering thumbnails of blob %s failed", blob_id)
+        return
+    try:
+        record_thumbnails(blob_id, checksum, directory, names)
+    finally:
+        connection.close()
+
+
+def adopt(attachment):
+    """
+    Move the file of an attachment uploaded before blobs into a blob, so
+    that it gets thumbnails. Returns the blob, or None if the file is gone.
+    """
+    old_name = attachment.file.name
+    storage = attachment.file.storage
+    try:
+        with transaction.atomic():
+            with attachment.file.open("rb") as file:
+                blob = AttachmentBlob.objects.store(file.file)
+            changes = {
+                field: getattr(blob, field)
+                for field in ("file_size", "mime_type", "width", "height", "checksum")
+            }
+            type(attachment).objects.filter(pk=attachment.pk).update(
+                blob=blob, file=blob.file.name, **changes
+            )
+    except (OSError, ValueError):
+        # File missing from storage
+        return None
+    if old_name != blob.file.name:
+        transaction.on_commit(lambda: storage.delete(old_name))
+    return blob
+
+
+def schedule(blob_id):
+    """Render the thumbnails of a newly stored blob in the background"""
+    blob = AttachmentBlob.objects.filter(pk=blob_id).first()
+    if blob is None or not has_thumbnails(blob.mime_type):
+        return
+    if not settings.THUMBNAIL_WORKERS:
+        generate(blob)
+        return
+    args, directory = get_job(blob)
+    future = get_executor().submit(render_thumbnails, *args)
+    future.add_done_callback(partial(finish, blob_id, blob.checksum, directory))
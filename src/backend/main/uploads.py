@@ -0,0 +1,89 @@
+"""
+Streaming upload handling for attachments.
+
+Views that take attachments are wrapped in hashed_uploads(), which makes
+HashingUploadHandler the only upload handler of their requests; other
+uploads keep Django's defaults. Every file is streamed chunk by chunk
+into a temporary file and hashed on the way, so memory use per upload
+stays at one chunk. Requests over ATTACHMENT_MAX_REQUEST_SIZE are refused
+from their Content-Length before any of the body is read, and a file is
+cut off as soon as it grows past ATTACHMENT_MAX_FILE_SIZE.
+
+The SHA-256 computed here is used by AttachmentBlob to store identical
+files once.
+"""
+
+import functools
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class UploadTooLarge(APIException, RequestDataTooBig):
+    # An APIException so DRF views answer 413; outside DRF, Django turns the
+    # RequestDataTooBig into a 400
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Upload too large."
+    default_code = "upload_too_large"
+
+
+def format_size(size):
+    return f"{size / (1024 * 1024):g} MB"
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_file_size = settings.ATTACHMENT_MAX_FILE_SIZE
+        self.max_request_size = settings.ATTACHMENT_MAX_REQUEST_SIZE
+        self.request_bytes = 0
+
+    def handle_raw_input(
+        self, input_data, META, content_length, boundary, encoding=None
+    ):
+        if content_length > self.max_request_size:
+            raise UploadTooLarge(
+                f"Uploads are limited to {format_size(self.max_request_size)} "
+                "per request."
+            )
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.checksum = hashlib.sha256()
+        self.file_bytes = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file_bytes += len(raw_data)
+        self.request_bytes += len(raw_data)
+        if self.file_bytes > self.max_file_size:
+            raise UploadTooLarge(
+                f"{self.file_name} is larger than the "
+                f"{format_size(self.max_file_size)} limit per file."
+            )
+        if self.request_bytes > self.max_request_size:
+            raise UploadTooLarge(
+                f"Uploads are limited to {format_size(self.max_request_size)} "
+                "per request."
+            )
+        self.checksum.update(raw_data)
+        super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.checksum.hexdigest()
+        return file
+
+
+def hashed_uploads(view):
+    """Stream the files posted to ``view`` through HashingUploadHandler"""
+
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        request.upload_handlers = [HashingUploadHandler(request)]
+        return view(request, *args, **kwargs)
+
+    return wrapped
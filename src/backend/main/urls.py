@@ -21,9 +21,12 @@ from .views import (
     DashboardRecentIssuesView,
     NotificationListView,
     mark_notification_read,
+    mark_notifications_read,
+    unread_notification_count,
     search_administrative_divisions,
     upload_issue_attachment,
 )
+from .event_views import issue_events, user_events
 from .auth_views import google_auth, setup_otp, verify_otp, resend_otp, setup_password, verify_password, update_username, test_existing_user_error, check_email_exists
 
 # TODO: App urls
@@ -93,6 +96,9 @@ urlpatterns = [
         name="issue-comment",
     ),
     path("issues/<int:issue_id>/upload/", upload_issue_attachment, name="issue-upload"),
+    # Live updates (server-sent events, served under ASGI)
+    path("issues/<int:issue_id>/events/", issue_events, name="issue-events"),
+    path("events/", user_events, name="user-events"),
     # Dashboard and notifications
     path("dashboard/stats/", DashboardStatsView.as_view(), name="dashboard-stats"),
     path(
@@ -101,6 +107,16 @@ urlpatterns = [
         name="dashboard-recent-issues",
     ),
     path("notifications/", NotificationListView.as_view(), name="notification-list"),
+    path(
+        "notifications/unread-count/",
+        unread_notification_count,
+        name="notification-unread-count",
+    ),
+    path(
+        "notifications/mark-read/",
+        mark_notifications_read,
+        name="notification-mark-read",
+    ),
     path(
         "notifications/<int:notification_id>/read/",
         mark_notification_read,
@@ -3,13 +3,13 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework import generics, status, permissions, filters, serializers
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from django.utils.decorators import method_decorator
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.db.models import Q, Count
+from django.core.cache import cache
 from django.http import JsonResponse
-from django.utils import timezone
-from datetime import timedelta
 
 # TODO: Create views
 
@@ -49,8 +49,17 @@ from .serializers import (
     IssueResponseSerializer,
     PublicCommentSerializer,
     NotificationSerializer,
+    NotificationMarkReadSerializer,
     EscalatedIssueSerializer,
 )
+from . import divisions, notifications, routing, state_machine, stats
+from .pagination import FeedPagination
+from .search import FullTextSearchFilter
+from .throttles import AccountThrottle, IPThrottle
+from .uploads import hashed_uploads
+
+ACTIVE_USERS_CACHE_KEY = "dashboard:active_users"
+ACTIVE_USERS_CACHE_TIMEOUT = 60  # seconds
 
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
@@ -101,6 +110,7 @@ class UserRegistrationView(generics.CreateAPIView):
 
 class UserLoginView(APIView):
     permission_classes = [permissions.AllowAny]
+    throttle_classes = [IPThrottle, AccountThrottle]
 
     def post(self, request):
         serializer = UserLoginSerializer(data=request.data)
@@ -118,7 +128,7 @@ class UserLoginView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -144,44 +154,89 @@ class UserProfileView(generics.RetrieveUpdateAPIView):
 
 
 # Administrative division views
-class ProvinceListView(generics.ListAPIView):
+@method_decorator(
+    condition(
+        etag_func=divisions.get_etag, last_modified_func=divisions.get_last_modified
+    ),
+    name="get",
+)
+class DivisionListView(generics.ListAPIView):
+    """List divisions from the in-memory division tree"""
+
+    permission_classes = [permissions.AllowAny]
+    # DivisionTree attribute holding the rows, and the optional parent filter
+    tree_attribute = None
+    parent_field = None
+
+    def list(self, request, *args, **kwargs):
+        tree = divisions.get_tree()
+        rows = getattr(tree, self.tree_attribute)
+
+        parent = (
+            request.query_params.get(self.parent_field) if self.parent_field else None
+        )
+        if parent:
+            try:
+                parent_id = int(parent)
+            except ValueError:
+                parent_id = None
+            if parent_id not in tree.ids[self.parent_field]:
+                return Response(
+                    {
+                        self.parent_field: [
+                            "Select a valid choice. That choice is not one of the available choices."
+                        ]
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            rows = tree.children[self.parent_field].get(parent_id, ())
+
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(rows)
+
+
+class ProvinceListView(DivisionListView):
     queryset = Province.objects.all().order_by("name_en")
     serializer_class = ProvinceSerializer
-    permission_classes = [permissions.AllowAny]
+    tree_attribute = "provinces"
 
 
-class DistrictListView(generics.ListAPIView):
-    queryset = District.objects.all().order_by("name_en")
+class DistrictListView(DivisionListView):
+    queryset = District.objects.select_related("province").order_by("name_en")
     serializer_class = DistrictSerializer
-    permission_classes = [permissions.AllowAny]
-    filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["province"]
+    tree_attribute = "districts"
+    parent_field = "province"
 
 
-class DSDivisionListView(generics.ListAPIView):
-    queryset = DSDivision.objects.all().order_by("name_en")
+class DSDivisionListView(DivisionListView):
+    queryset = DSDivision.objects.select_related("district__province").order_by(
+        "name_en"
+    )
     serializer_class = DSDivisionSerializer
-    permission_classes = [permissions.AllowAny]
-    filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["district"]
+    tree_attribute = "ds_divisions"
+    parent_field = "district"
 
 
-class GramaNiladhariDivisionListView(generics.ListAPIView):
-    queryset = GramaNiladhariDivision.objects.all().order_by("name_en")
+class GramaNiladhariDivisionListView(DivisionListView):
+    queryset = GramaNiladhariDivision.objects.select_related(
+        "ds_division__district__province"
+    ).order_by("name_en")
     serializer_class = GramaNiladhariDivisionSerializer
-    permission_classes = [permissions.AllowAny]
-    filter_backends = [DjangoFilterBackend]
-    filterset_fields = ["ds_division"]
+    tree_attribute = "gn_divisions"
+    parent_field = "ds_division"
 
 
 # Issue management views
 class IssueListView(generics.ListAPIView):
     serializer_class = IssueListSerializer
     permission_classes = [permissions.AllowAny]  # Public can view issues
+    pagination_class = FeedPagination
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
         filters.OrderingFilter,
+        FullTextSearchFilter,
     ]
     filterset_fields = [
         "status",
@@ -196,7 +251,7 @@ class IssueListView(generics.ListAPIView):
     ordering = ["-created_at"]
 
     def get_queryset(self):
-        queryset = Issue.objects.all()
+        queryset = Issue.objects.for_list()
 
         # If user is authenticated and not citizen, filter by their jurisdiction and level
         if (
@@ -248,7 +303,7 @@ class IssueListView(generics.ListAPIView):
 
 
 class IssueDetailView(generics.RetrieveAPIView):
-    queryset = Issue.objects.all()
+    queryset = Issue.objects.for_detail()
     serializer_class = IssueDetailSerializer
     permission_classes = [permissions.AllowAny]
 
@@ -265,6 +320,7 @@ class IssueDetailView(generics.RetrieveAPIView):
             return super().get_object()
 
 
+@method_decorator(hashed_uploads, name="dispatch")
 class IssueCreateView(generics.CreateAPIView):
     queryset = Issue.objects.all()
     serializer_class = IssueCreateSerializer
@@ -310,13 +366,14 @@ class IssueCreateView(generics.CreateAPIView):
 class MyIssuesView(generics.ListAPIView):
     serializer_class = IssueListSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FeedPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ["status", "priority"]
     ordering_fields = ["created_at", "updated_at"]
     ordering = ["-created_at"]
 
     def get_queryset(self):
-        return Issue.objects.filter(reporter_user=self.request.user)
+        return Issue.objects.for_list().filter(reporter_user=self.request.user)
 
 
 class EscalatedIssuesView(generics.ListAPIView):
@@ -380,6 +437,7 @@ class EscalatedIssuesView(generics.ListAPIView):
         return (escalated_issues | jurisdiction_escalated).distinct()
 
 
+@method_decorator(hashed_uploads, name="dispatch")
 class IssueResponseView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
@@ -400,59 +458,63 @@ class IssueResponseView(APIView):
 
         serializer = IssueResponseSerializer(data=request.data)
         if serializer.is_valid():
-            response = serializer.save(issue=issue, responder=user)
-
-            # Handle file attachments if any
-            attachments = request.FILES.getlist("attachments")
-            for attachment_file in attachments:
-                ResponseAttachment.objects.create(
-                    response=response, file=attachment_file
-                )
-
-            # Handle different response types
-            if response.response_type == "resolved":
-                issue.status = "resolved"
-                issue.resolved_at = timezone.now()
-                issue.current_handler = user
-                issue.next_escalation_date = None  # Stop escalation timer
-                issue.save()
-            elif response.response_type == "pending":
-                issue.status = "pending"
-                if response.additional_days:
-                    issue.next_escalation_date = timezone.now() + timedelta(
-                        days=response.additional_days
+            with transaction.atomic():
+                response = serializer.save(issue=issue, responder=user)
+
+                # Handle file attachments if any
+                attachments = request.FILES.getlist("attachments")
+                for attachment_file in attachments:
+                    ResponseAttachment.objects.create(
+                        response=response, file=attachment_file
                     )
-                    issue.pending_extension_count += 1
-                else:
-                    # Reset escalation timer for normal pending responses
-                    escalation_days = (
-                        7
-                        if user.user_type in ["national_ministry", "prime_minister"]
-                        else 3
+
+                try:
+                    applied = self.apply_response(issue, response, user)
+                except state_machine.InvalidTransition as e:
+                    transaction.set_rollback(True)
+                    return Response(
+                        {"error": str(e)}, status=status.HTTP_400_BAD_REQUEST
                     )
-                    issue.next_escalation_date = timezone.now() + timedelta(
-                        days=escalation_days
+                if not applied:
+                    # Someone else changed the issue since it was loaded
+                    transaction.set_rollback(True)
+                    return Response(
+                        {
+                            "error": "The issue was updated by someone else, "
+                            "reload it and try again"
+                        },
+                        status=status.HTTP_409_CONFLICT,
                     )
-                issue.save()
-            elif response.response_type == "escalate":
-                self.escalate_issue(issue, user)
-            elif response.response_type == "response":
-                # For regular responses, reset the escalation timer
-                issue.status = "in_progress"
-                escalation_days = (
-                    7
-                    if user.user_type in ["national_ministry", "prime_minister"]
-                    else 3
-                )
-                issue.next_escalation_date = timezone.now() + timedelta(
-                    days=escalation_days
-                )
-                issue.save()
 
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def apply_response(self, issue, response, user):
+        """
+        Move the issue to the state the response asks for with a
+        conditional UPDATE. Returns False if the issue changed meanwhile,
+        and raises InvalidTransition if its state does not allow it.
+        """
+        action = state_machine.get_response_action(
+            response.response_type, response.additional_days
+        )
+        if action == state_machine.ESCALATE:
+            return self.escalate_issue(issue, user)
+
+        if not state_machine.apply(
+            issue,
+            action,
+            handler_id=user.pk if action == state_machine.RESOLVE else None,
+            additional_days=response.additional_days,
+        ):
+            return False
+        if action == state_machine.RESOLVE:
+            notifications.notify("issue_resolved", issue, actor=user)
+        else:
+            notifications.notify("issue_response", issue, actor=user)
+        return True
+
     def can_respond_to_issue(self, user, issue):
         """Check if user can respond to the issue based on their role, jurisdiction, and issue level"""
         if user.user_type == "admin":
@@ -485,61 +547,39 @@ class IssueResponseView(APIView):
         return False
 
     def escalate_issue(self, issue, from_user):
-        """Escalate issue to next level"""
-        escalation_hierarchy = {
-            "grama_niladhari": "divisional_secretary",
-            "divisional_secretary": "district_secretary",
-            "district_secretary": "provincial_ministry",
-            "provincial_ministry": "national_ministry",
-            "national_ministry": "prime_minister",
-        }
-
+        """
+        Escalate issue to next level. Returns False if the issue changed
+        since it was loaded.
+        """
         current_level = issue.current_level
-        next_level = escalation_hierarchy.get(current_level)
-
-        if next_level:
-            # Find appropriate user at next level
-            next_users = User.objects.filter(user_type=next_level, is_approved=True)
-
-            # Filter by jurisdiction for lower levels
-            if next_level in [
-                "divisional_secretary",
-                "district_secretary",
-                "provincial_ministry",
-            ]:
-                if next_level == "divisional_secretary":
-                    next_users = next_users.filter(
-                        province=issue.province,
-                        district=issue.district,
-                        ds_division=issue.ds_division,
-                    )
-                elif next_level == "district_secretary":
-                    next_users = next_users.filter(
-                        province=issue.province, district=issue.district
-                    )
-                elif next_level == "provincial_ministry":
-                    next_users = next_users.filter(province=issue.province)
-
-            next_user = next_users.first()
-
-            if next_user:
-                # Create escalation record
-                IssueEscalation.objects.create(
-                    issue=issue,
-                    from_user=from_user,
-                    to_user=next_user,
-                    from_level=current_level,
-                    to_level=next_level,
-                    reason=f"Escalated from {current_level}",
-                )
+        # Raises InvalidTransition at the top level
+        state_machine.get_transition(
+            state_machine.ESCALATE, issue.status, current_level
+        )
+        next_level = state_machine.get_next_level(current_level)
 
-                # Update issue
-                issue.current_handler = next_user
-                issue.current_level = next_level
-                issue.escalation_count += 1
-                issue.status = "escalated"
-                issue.next_escalation_date = timezone.now() + timedelta(days=3)
-                issue.save()
+        # Find appropriate user at next level
+        next_user_id = routing.pick_handler(next_level, issue)
+        if not next_user_id:
+            return True
+
+        # Guarded by the version, so a concurrent escalation by the
+        # escalate_issues command cannot move the issue up twice
+        if not state_machine.apply(
+            issue, state_machine.ESCALATE, handler_id=next_user_id
+        ):
+            return False
+
+        IssueEscalation.objects.create(
+            issue=issue,
+            from_user=from_user,
+            to_user_id=next_user_id,
+            from_level=current_level,
+            to_level=next_level,
+            reason=f"Escalated from {current_level}",
+        )
+        notifications.notify("issue_escalated", issue, actor=from_user)
+        return True
 
 
 class PublicCommentView(generics.CreateAPIView):
@@ -588,65 +628,49 @@ class DashboardStatsView(APIView):
 
         if user.user_type == "citizen":
             # Stats for citizens
-            my_issues = Issue.objects.filter(reporter_user=user)
-            stats = {
-                "total_issues": my_issues.count(),
-                "pending_issues": my_issues.filter(
-                    status__in=["pending", "in_progress"]
-                ).count(),
-                "resolved_issues": my_issues.filter(
-                    status__in=["resolved", "closed"]
-                ).count(),
-                "my_issues": my_issues.count(),
-                "escalated_issues": my_issues.filter(status="escalated").count(),
-                "active_users": user.__class__.objects.filter(is_active=True).count(),
-            }
+            counts = stats.get_dashboard_counts("reporter", user.id)
+            my_issues = counts["total"]
         else:
             # Stats for government officials
-            queryset = self.get_jurisdiction_queryset(user)
-            my_assigned = (
-                queryset.filter(current_handler=user)
-                if user.user_type != "admin"
-                else Issue.objects.all()
-            )
-            stats = {
-                "total_issues": queryset.count(),
-                "pending_issues": queryset.filter(
-                    status__in=["pending", "in_progress"]
-                ).count(),
-                "resolved_issues": queryset.filter(
-                    status__in=["resolved", "closed"]
-                ).count(),
-                "my_issues": my_assigned.count(),
-                "escalated_issues": queryset.filter(status="escalated").count(),
-                "active_users": user.__class__.objects.filter(is_active=True).count(),
-            }
-
-        return Response(stats)
-
-    def get_jurisdiction_queryset(self, user):
-        """Get issues based on user's jurisdiction"""
-        queryset = Issue.objects.all()
-
-        if user.user_type == "grama_niladhari" and user.grama_niladhari_division:
-            queryset = queryset.filter(
-                province=user.province,
-                district=user.district,
-                ds_division=user.ds_division,
-                grama_niladhari_division=user.grama_niladhari_division,
-            )
-        elif user.user_type == "divisional_secretary" and user.ds_division:
-            queryset = queryset.filter(
-                province=user.province,
-                district=user.district,
-                ds_division=user.ds_division,
-            )
-        elif user.user_type == "district_secretary" and user.district:
-            queryset = queryset.filter(province=user.province, district=user.district)
-        elif user.user_type == "provincial_ministry" and user.province:
-            queryset = queryset.filter(province=user.province)
-
-        return queryset
+            scope, scope_id = self.get_jurisdiction_scope(user)
+            if user.user_type == "admin":
+                counts = stats.get_dashboard_counts(scope, scope_id)
+                my_issues = counts["total"]
+            else:
+                counts = stats.get_dashboard_counts(scope, scope_id)
+                # Issues assigned to them within their jurisdiction
+                my_issues = stats.count_handled(user.id, scope, scope_id)
+
+        stats_data = {
+            "total_issues": counts["total"],
+            "pending_issues": counts["pending"],
+            "resolved_issues": counts["resolved"],
+            "my_issues": my_issues,
+            "escalated_issues": counts["escalated"],
+            "active_users": self.get_active_users(),
+        }
+        return Response(stats_data)
+
+    def get_jurisdiction_scope(self, user):
+        """Get the issue counter scope of the user's jurisdiction"""
+        if user.user_type == "grama_niladhari" and user.grama_niladhari_division_id:
+            return "gn_division", user.grama_niladhari_division_id
+        elif user.user_type == "divisional_secretary" and user.ds_division_id:
+            return "ds_division", user.ds_division_id
+        elif user.user_type == "district_secretary" and user.district_id:
+            return "district", user.district_id
+        elif user.user_type == "provincial_ministry" and user.province_id:
+            return "province", user.province_id
+        return "all", 0
+
+    def get_active_users(self):
+        # Counting the user table on every poll is wasteful, the figure only
+        # needs to be roughly current
+        return cache.get_or_set(
+            ACTIVE_USERS_CACHE_KEY,
+            lambda: User.objects.filter(is_active=True).count(),
+            ACTIVE_USERS_CACHE_TIMEOUT,
+        )
 
 
 class DashboardRecentIssuesView(APIView):
@@ -657,7 +681,7 @@ class DashboardRecentIssuesView(APIView):
 
         if user.user_type == "citizen":
             # Recent issues for citizens - their own issues
-            queryset = Issue.objects.filter(reporter_user=user)
+            queryset = Issue.objects.for_list().filter(reporter_user=user)
         else:
             # Recent issues for government officials - their jurisdiction
             queryset = self.get_jurisdiction_queryset(user)
@@ -669,7 +693,7 @@ class DashboardRecentIssuesView(APIView):
 
     def get_jurisdiction_queryset(self, user):
         """Get issues based on user's jurisdiction and hierarchical level"""
-        queryset = Issue.objects.all()
+        queryset = Issue.objects.for_list()
 
         if user.user_type == "grama_niladhari" and user.grama_niladhari_division:
             queryset = queryset.filter(
@@ -708,6 +732,7 @@ class DashboardRecentIssuesView(APIView):
 class NotificationListView(generics.ListAPIView):
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FeedPagination
     ordering = ["-created_at"]
 
     def get_queryset(self):
@@ -717,19 +742,47 @@ class NotificationListView(generics.ListAPIView):
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def mark_notification_read(request, notification_id):
-    try:
-        notification = Notification.objects.get(id=notification_id, user=request.user)
-        notification.is_read = True
-        notification.save()
-        return Response({"message": "Notification marked as read"})
-    except Notification.DoesNotExist:
-        return Response(
-            {"error": "Notification not found"}, status=status.HTTP_404_NOT_FOUND
-        )
+    if not notifications.mark_read(request.user, ids=[notification_id]):
+        # Either already read or not the user's
+        if not Notification.objects.filter(
+            id=notification_id, user=request.user
+        ).exists():
+            return Response(
+                {"error": "Notification not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+    return Response({"message": "Notification marked as read"})
+
+
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+def mark_notifications_read(request):
+    """Mark notifications read by id list, by issue and/or up to a time"""
+    serializer = NotificationMarkReadSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+    updated = notifications.mark_read(
+        request.user,
+        ids=data.get("ids"),
+        issue_id=data.get("issue"),
+        before=data.get("before"),
+    )
+    return Response(
+        {
+            "updated": updated,
+            "unread_count": notifications.get_unread_count(request.user),
+        }
+    )
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def unread_notification_count(request):
+    return Response({"unread_count": notifications.get_unread_count(request.user)})
 
 
 @api_view(["GET"])
 @permission_classes([permissions.AllowAny])
+@condition(etag_func=divisions.get_etag, last_modified_func=divisions.get_last_modified)
 def search_administrative_divisions(request):
     """Search for administrative divisions"""
     query = request.GET.get("q", "")
@@ -740,83 +793,26 @@ def search_administrative_divisions(request):
     results = []
 
     if len(query) >= 2:  # Minimum 2 characters for search
-        if division_type in ["province", "all"]:
-            provinces = Province.objects.filter(
-                Q(name_en__icontains=query)
-                | Q(name_si__icontains=query)
-                | Q(name_ta__icontains=query)
-            )[:5]
-            for province in provinces:
-                results.append(
-                    {
-                        "type": "province",
-                        "id": province.id,
-                        "name_en": province.name_en,
-                        "name_si": province.name_si,
-                        "name_ta": province.name_ta,
-                    }
-                )
-
-        if division_type in ["district", "all"]:
-            districts = District.objects.filter(
-                Q(name_en__icontains=query)
-                | Q(name_si__icontains=query)
-                | Q(name_ta__icontains=query)
-            ).select_related("province")[:5]
-            for district in districts:
-                results.append(
-                    {
-                        "type": "district",
-                        "id": district.id,
-                        "name_en": district.name_en,
-                        "name_si": district.name_si,
-                        "name_ta": district.name_ta,
-                        "province": district.province.name_en,
-                    }
-                )
-
-        if division_type in ["ds_division", "all"]:
-            ds_divisions = DSDivision.objects.filter(
-                Q(name_en__icontains=query)
-                | Q(name_si__icontains=query)
-                | Q(name_ta__icontains=query)
-            ).select_related("district__province")[:5]
-            for ds_div in ds_divisions:
-                results.append(
-                    {
-                        "type": "ds_division",
-                        "id": ds_div.id,
-                        "name_en": ds_div.name_en,
-                        "name_si": ds_div.name_si,
-                        "name_ta": ds_div.name_ta,
-                        "district": ds_div.district.name_en,
-                        "province": ds_div.district.province.name_en,
-                    }
-                )
-
-        if division_type in ["gn_division", "all"]:
-            gn_divisions = GramaNiladhariDivision.objects.filter(
-                Q(name_en__icontains=query)
-                | Q(name_si__icontains=query)
-                | Q(name_ta__icontains=query)
-            ).select_related("ds_division__district__province")[:5]
-            for gn_div in gn_divisions:
-                results.append(
-                    {
-                        "type": "gn_division",
-                        "id": gn_div.id,
-                        "name_en": gn_div.name_en,
-                        "name_si": gn_div.name_si,
-                        "name_ta": gn_div.name_ta,
-                        "ds_division": gn_div.ds_division.name_en,
-                        "district": gn_div.ds_division.district.name_en,
-                        "province": gn_div.ds_division.district.province.name_en,
-                    }
-                )
+        for entry_type, row in divisions.get_tree().search(query, division_type):
+            result = {
+                "type": entry_type,
+                "id": row["id"],
+                "name_en": row["name_en"],
+                "name_si": row["name_si"],
+                "name_ta": row["name_ta"],
+            }
+            if entry_type == "gn_division":
+                result["ds_division"] = row["ds_division_name"]
+            if entry_type in ["ds_division", "gn_division"]:
+                result["district"] = row["district_name"]
+            if entry_type != "province":
+                result["province"] = row["province_name"]
+            results.append(result)
 
     return Response(results)
 
 
+@hashed_uploads
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def upload_issue_attachment(request, issue_id):
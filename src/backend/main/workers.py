@@ -0,0 +1,105 @@
+"""
+Background worker threads for work that should not hold up a request.
+
+A BackgroundWorker owns a queue and a few daemon threads. Each thread
+takes whatever has been queued, up to ``batch_size`` items, waiting at
+most ``linger`` seconds for a batch to fill, and passes the batch to
+``handle_batch`` in one call. Failures are logged and the batch is
+dropped, so callers that need retries handle them in ``handle_batch``.
+
+Threads are started on the first put() and given a few seconds to drain
+the queue when the process exits.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.db import close_old_connections, connection
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds the queue is given to drain when the process exits
+SHUTDOWN_TIMEOUT = 5
+
+_STOP = object()
+
+
+class BackgroundWorker:
+    def __init__(self, name, handle_batch, batch_size=100, linger=0.05, threads=1):
+        self.name = name
+        self.handle_batch = handle_batch
+        self.batch_size = batch_size
+        self.linger = linger
+        self.thread_count = threads
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        if not self.threads:
+            self.start()
+        self.queue.put(item)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.thread_count):
+                thread = threading.Thread(
+                    target=self.run, name=f"{self.name}-{i}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+        atexit.register(self.stop)
+
+    def next_batch(self):
+        item = self.queue.get()
+        if item is _STOP:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Leave it for the loop once this batch is handled
+                self.queue.task_done()
+                self.queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                self.queue.task_done()
+                connection.close()
+                return
+            close_old_connections()
+            try:
+                self.handle_batch(batch)
+            except Exception:
+                logger.exception("%s failed to handle %d items", self.name, len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        """Wait until everything queued so far has been handled"""
+        self.queue.join()
+
+    def stop(self, timeout=SHUTDOWN_TIMEOUT):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))